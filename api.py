@@ -0,0 +1,197 @@
+"""Read API over employees and payroll for integrations such as accounting and bank-file systems.
+
+Clients authenticate with a bearer token from create_api_token(). A token
+carries scopes limiting what it may read and can be revoked at any time. It
+is looked up by an HMAC of its value, keyed with API_TOKEN_KEY, so a leaked
+table of hashes cannot be used to check guessed tokens. Lists are
+keyset-paged: each page carries the cursor of its last row, and the next
+page starts strictly after it, so a deep page costs no more than the first
+one. A whole period can also be streamed as NDJSON, one payroll row per line.
+"""
+import hashlib
+import hmac
+import json
+import secrets
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import tuple_
+
+import auth_cache
+from archive import payroll_model
+from dashboard import PAGE_SIZE
+from models import db, ApiToken, Employee, Payroll
+
+TOKEN_PREFIX = 'pa_'
+SCOPES = ('employees:read', 'payroll:read')
+# last_used_at is only written when it is older than this
+LAST_USED_RESOLUTION = timedelta(minutes=1)
+# Rows fetched from the database per round trip when streaming
+FETCH_SIZE = 1000
+# NDJSON lines buffered before a chunk is handed to the response
+FLUSH_ROWS = 500
+
+EMPLOYEE_COLUMNS = (
+    Employee.id, Employee.kra_pin, Employee.first_name, Employee.middle_name,
+    Employee.last_name, Employee.basic_salary, Employee.user_id, Employee.created_at,
+)
+EMPLOYEE_FIELDS = ('id', 'kra_pin', 'first_name', 'middle_name', 'last_name', 'basic_salary',
+                   'owner_id', 'created_at')
+PAYROLL_COLUMNS = (
+    Payroll.period, Payroll.employee_id, Payroll.basic_salary, Payroll.benefits_total,
+    Payroll.gross_salary, Payroll.nssf, Payroll.shif, Payroll.ahl, Payroll.paye, Payroll.net_pay,
+    Payroll.rate_version, Payroll.calculated_at,
+)
+PAYROLL_FIELDS = ('period', 'employee_id', 'basic_salary', 'benefits_total', 'gross_salary', 'nssf',
+                  'shif', 'ahl', 'paye', 'net_pay', 'rate_version', 'calculated_at')
+
+
+def hash_token(token):
+    key = current_app.config['API_TOKEN_KEY'].encode('utf-8')
+    return hmac.new(key, token.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def create_api_token(user_id, name, scopes=None):
+    """Create a token for user_id. Returns (ApiToken, token); the token itself is not stored.
+
+    scopes defaults to every scope. Raises ValueError for an unknown scope.
+    """
+    scopes = list(scopes) if scopes else list(SCOPES)
+    unknown = [scope for scope in scopes if scope not in SCOPES]
+    if unknown:
+        raise ValueError(f"Unknown scope: {', '.join(unknown)}")
+    token = TOKEN_PREFIX + secrets.token_urlsafe(32)
+    api_token = ApiToken(user_id=user_id, name=name, token_hash=hash_token(token), scopes=' '.join(scopes))
+    db.session.add(api_token)
+    db.session.commit()
+    return api_token, token
+
+
+def token_info(api_token):
+    """JSON-ready view of a token, without its hash."""
+    return {
+        'id': api_token.id,
+        'name': api_token.name,
+        'scopes': api_token.scopes.split(),
+        'created_at': api_token.created_at.isoformat() if api_token.created_at else None,
+        'last_used_at': api_token.last_used_at.isoformat() if api_token.last_used_at else None,
+        'revoked_at': api_token.revoked_at.isoformat() if api_token.revoked_at else None,
+    }
+
+
+def list_api_tokens(user_id=None):
+    """Tokens newest first, only user_id's when given."""
+    query = ApiToken.query.order_by(ApiToken.id.desc())
+    if user_id is not None:
+        query = query.filter(ApiToken.user_id == user_id)
+    return query.all()
+
+
+def revoke_api_token(api_token):
+    """Stop a token from working. This process forgets it at once; other processes within AUTH_CACHE_TTL."""
+    if api_token.revoked_at is None:
+        api_token.revoked_at = datetime.utcnow()
+        db.session.commit()
+
+
+def _lookup(token_hash):
+    """(token id, user id, scopes) of a live token."""
+    api_token = ApiToken.query.filter_by(token_hash=token_hash).first()
+    if api_token is None or api_token.revoked_at is not None:
+        return None
+    # Only written on a cache miss, so at most about once per AUTH_CACHE_TTL
+    now = datetime.utcnow()
+    if api_token.last_used_at is None or now - api_token.last_used_at > LAST_USED_RESOLUTION:
+        api_token.last_used_at = now
+    db.session.commit()
+    return api_token.id, api_token.user_id, frozenset(api_token.scopes.split())
+
+
+def user_for_token(token, scope):
+    """The user a bearer token belongs to, or None if it is unknown or revoked.
+
+    Raises PermissionError when the token is valid but lacks scope. Repeat
+    requests with the same token are answered from the per-process cache,
+    with no query at all.
+    """
+    if not token or not token.startswith(TOKEN_PREFIX):
+        return None
+    token_hash = hash_token(token)
+    identity = auth_cache.tokens.get(token_hash)
+    if identity is None:
+        identity = _lookup(token_hash)
+        if identity is None:
+            return None
+        auth_cache.tokens.put(token_hash, identity)
+    _, user_id, scopes = identity
+    if scope not in scopes:
+        raise PermissionError(f'This token does not have the {scope} scope')
+    return auth_cache.load_user(user_id)
+
+
+def _as_dict(fields, row):
+    return {field: value.isoformat() if isinstance(value, datetime) else value
+            for field, value in zip(fields, row)}
+
+
+def _page(query, fields, limit, cursor):
+    """Fetch one row more than limit to learn whether there is a next page without counting."""
+    rows = query.limit(limit + 1).all()
+    next_after = cursor(rows[limit - 1]) if len(rows) > limit else None
+    return [_as_dict(fields, row) for row in rows[:limit]], next_after
+
+
+def employee_page(user_id=None, after=None, limit=PAGE_SIZE):
+    """One page of employees in id order after the employee id `after`. Returns (rows, next_after)."""
+    query = db.session.query(*EMPLOYEE_COLUMNS).order_by(Employee.id)
+    if user_id is not None:
+        query = query.filter(Employee.user_id == user_id)
+    if after:
+        query = query.filter(Employee.id > after)
+    return _page(query, EMPLOYEE_FIELDS, limit, lambda row: row[0])
+
+
+def _payroll_query(period=None, user_id=None):
+    """(query, model) for payroll rows in cursor order. Only a single period is looked up in the archive."""
+    model = payroll_model(period) if period is not None else Payroll
+    query = (db.session.query(*[getattr(model, column.key) for column in PAYROLL_COLUMNS])
+             .order_by(model.period, model.employee_id))
+    if period is not None:
+        query = query.filter(model.period == period)
+    if user_id is not None:
+        query = query.join(Employee, model.employee_id == Employee.id).filter(Employee.user_id == user_id)
+    return query, model
+
+
+def parse_payroll_cursor(after):
+    """Split a payroll cursor ('<period>:<employee id>') into its parts. Raises ValueError if malformed."""
+    period, sep, employee_id = (after or '').partition(':')
+    if not sep or len(period) != 7 or not employee_id:
+        raise ValueError('Invalid cursor')
+    return period, employee_id
+
+
+def payroll_page(period=None, user_id=None, after=None, limit=PAGE_SIZE):
+    """One page of payroll rows in (period, employee id) order. Returns (rows, next_after).
+
+    The cursor holds both parts of the sort key, so paging works across
+    periods as well as within one; it follows the (period, employee_id)
+    index either way.
+    """
+    query, model = _payroll_query(period, user_id)
+    if after:
+        query = query.filter(tuple_(model.period, model.employee_id) > parse_payroll_cursor(after))
+    return _page(query, PAYROLL_FIELDS, limit, lambda row: f'{row[0]}:{row[1]}')
+
+
+def iter_payroll_ndjson(period, user_id=None):
+    """Yield a period's payroll register as newline-delimited JSON, streamed from a server-side cursor."""
+    lines = []
+    query, _ = _payroll_query(period, user_id)
+    for row in query.yield_per(FETCH_SIZE):
+        lines.append(json.dumps(_as_dict(PAYROLL_FIELDS, row)) + '\n')
+        if len(lines) == FLUSH_ROWS:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
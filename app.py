@@ -1,46 +1,124 @@
 import os
-import csv
 import json
 import re
 import logging
+import time
 from datetime import datetime
-from io import StringIO, BytesIO
-from flask import Flask, request, render_template, redirect, url_for, flash, send_file
+from functools import wraps
+from io import BytesIO, TextIOWrapper
+import click
+from flask import Blueprint, Flask, current_app, g, request, render_template, redirect, url_for, flash, send_file, jsonify, Response, stream_with_context
 from flask_login import login_manager, login_user, login_required, logout_user,current_user, LoginManager
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.http import is_resource_modified
+from markupsafe import escape
 
 
 
 # Import modules
 from payroll_calculator import calculate_payroll
-from generate_pdf import generate_payslip_pdf
-from models import db, Employee, Payroll, User
+from employee_import import EMAIL_PATTERN, import_employees
+from payroll_run import PERIOD_PATTERN, run_payroll
+from statutory_rates import rate_version_for_period
+from payroll_recompute import recompute_payroll
+from simulation import simulate
+from payslip_export import payslip_records, iter_payslip_zip
+from payslip_cache import PayslipCache, payslip_cache_key
+from reports import has_payroll, has_ytd, iter_p10_csv, iter_p9_csv
+from dashboard import PAGE_SIZE, MAX_PAGE_SIZE, dashboard_page, dashboard_rows, employee_count
+from employee_search import MAX_RESULTS, rebuild_search_index, search_employees
+from models import db, ApiToken, Employee, Job, Payroll, User
+from migrations import upgrade_schema
+import metrics
+import profiler
+import jobs
+import api
+import auth_cache
+import database
+from archive import archivable_periods, archive_horizon, archive_period, ensure_open, lock_open, payroll_model
+from ytd import add_ytd_change, apply_ytd_deltas, rebuild_ytd, ytd_for_period
 from dotenv import load_dotenv
 
 load_dotenv()
 
-# Create Flask app
-app = Flask(__name__)
-app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
-app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
-
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
-# Initialize SQLAlchemy with the app
-db.init_app(app)
 
-# initializing login manager
+# Routes and CLI commands; create_app() registers them on an app
+bp = Blueprint('main', __name__, cli_group=None)
+
 login_manager = LoginManager()
-login_manager.login_view = "login"
-login_manager.init_app(app)
+login_manager.login_view = "main.login"
+
+# Rendered payslips, in memory and optionally on disk
+payslip_cache = PayslipCache(
+    max_items=int(os.getenv('PAYSLIP_CACHE_ITEMS', 256)),
+    directory=os.getenv('PAYSLIP_CACHE_DIR') or None,
+    max_disk_bytes=int(os.getenv('PAYSLIP_CACHE_MAX_BYTES', 256 * 1024 * 1024)),
+)
+
+
+def create_app(config=None):
+    """Build and configure the Flask app.
+
+    Nothing here touches the database, so importing and building the app
+    stays cheap; `flask migrate` creates and upgrades the schema. ReportLab
+    is only imported when the first payslip is rendered.
+    """
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.getenv('SQLALCHEMY_DATABASE_URI')
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['JOB_OUTPUT_DIR'] = os.getenv('JOB_OUTPUT_DIR') or os.path.join(app.instance_path, 'jobs')
+    if config:
+        app.config.update(config)
+    # Key for looking up API tokens by HMAC; changing it invalidates every token
+    app.config.setdefault('API_TOKEN_KEY', os.getenv('API_TOKEN_KEY') or app.config['SECRET_KEY'] or '')
+
+    # LOG_LEVEL=DEBUG brings back the detailed payslip logging; the default keeps hot paths quiet
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'INFO').upper())
+
+    # Initialize SQLAlchemy with the app, tuned for its backend and with a read-only bind
+    database.configure_app(app)
+    db.init_app(app)
+    login_manager.init_app(app)
+
+    # Request latency and SQL counts for /metrics
+    metrics.init_app(app)
+
+    # Admin-only request profiles (X-Profile: 1 or ?_profile=1)
+    profile_store = profiler.ProfileStore(
+        os.getenv('PROFILE_DIR') or os.path.join(app.instance_path, 'profiles'),
+        max_reports=int(os.getenv('PROFILE_MAX_REPORTS', 50)),
+        max_bytes=int(os.getenv('PROFILE_MAX_BYTES', 50 * 1024 * 1024)),
+    )
+    app.extensions['profile_store'] = profile_store
+    profiler.init_app(app, profile_store)
+
+    # Background jobs run on threads in each app process; JOB_WORKERS=0 leaves them to `flask run-jobs`
+    job_worker = jobs.JobWorker(app, threads=int(os.getenv('JOB_WORKERS', 2)))
+
+    @app.before_request
+    def _start_job_worker():
+        # Started on the first request rather than at import, so CLI commands and
+        # pre-fork master processes do not run jobs
+        job_worker.ensure_started()
+
+    with app.app_context():
+        database.init_engines(app)
+        for engine in (db.engine, db.engines[database.READ_BIND]):
+            metrics.instrument_engine(engine)
+            profiler.instrument_engine(engine)
+
+    app.register_blueprint(bp)
+    return app
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Served from a short-lived per-process cache rather than a query per request
+    return auth_cache.load_user(int(user_id))
 
 # Register
-@app.route('/register', methods=['GET', 'POST'])
+@bp.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         email = request.form.get('email').strip().lower()
@@ -53,7 +131,7 @@ def register():
 
         if User.query.filter_by(email=email).first():
             flash("Email already registered. Please login.", "error")
-            return redirect(url_for('login'))
+            return redirect(url_for('main.login'))
 
         user = User(email=email, full_name=name)
         user.set_password(password)
@@ -64,12 +142,12 @@ def register():
         db.session.add(user)
         db.session.commit()
         flash("Registration successful. Please log in.", "success")
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
 
     return render_template('register.html')
 
 # Login
-@app.route('/login', methods=['GET', 'POST'])
+@bp.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         email = request.form.get('email').strip().lower()
@@ -80,29 +158,79 @@ def login():
             return render_template('login.html')
         login_user(user)
         flash("Logged in successfully", "success")
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     return render_template('login.html')
 
 # Logout
-@app.route('/logout')
+@bp.route('/logout')
 @login_required
 def logout():
     logout_user()
     flash("You have been logged out.", "success")
-    return redirect(url_for('login'))
+    return redirect(url_for('main.login'))
+
+@bp.cli.command('migrate')
+def migrate_command():
+    """Create missing tables and apply pending schema migrations."""
+    applied = upgrade_schema(db.engine)
+    print(f"Applied migrations: {applied}" if applied else "Database is up to date")
+
+@bp.cli.command('run-jobs')
+@click.option('--threads', default=2, show_default=True, help='Jobs to run at the same time.')
+def run_jobs_command(threads):
+    """Run background jobs in the foreground until interrupted."""
+    print(f"Running jobs on {threads} threads")
+    jobs.JobWorker(current_app._get_current_object(), threads=threads).run()
+
+@bp.cli.command('rebuild-ytd')
+def rebuild_ytd_command():
+    """Recompute the year-to-date payroll totals from the payroll table."""
+    with db.engine.begin() as conn:
+        rows = rebuild_ytd(conn)
+    print(f"Rebuilt {rows} year-to-date rows")
+
+@bp.cli.command('rebuild-search')
+def rebuild_search_command():
+    """Refill the employee search index from the employees table."""
+    with db.engine.begin() as conn:
+        rows = rebuild_search_index(conn)
+    print(f"Indexed {rows} employees")
+
+@bp.cli.command('archive-payroll')
+@click.option('--period', help='Archive only this YYYY-MM period.')
+def archive_payroll_command(period):
+    """Move payroll periods older than ARCHIVE_AFTER_MONTHS to the archive table."""
+    periods = [period] if period else archivable_periods()
+    if not periods:
+        print(f"Nothing to archive before {archive_horizon()}")
+    for period in periods:
+        moved = 0
+        for step, rows, _ in archive_period(period):
+            if step == 'copy':
+                moved += rows
+        print(f"Archived {period}: {moved} rows")
+
+def _page_args():
+    """Keyset cursor and page size from the query string."""
+    after = request.args.get('after') or None
+    limit = request.args.get('limit', PAGE_SIZE, type=int)
+    return after, max(1, min(limit, MAX_PAGE_SIZE))
 
-# Create tables
-with app.app_context():
-    db.create_all()
+def _render_dashboard(period):
+    """Render one page of the employee table for the period."""
+    user_id = None if current_user.is_admin else current_user.id
+    after, limit = _page_args()
+    rows, next_after = dashboard_page(period, user_id, after, limit)
+    recent = [jobs.job_status(job) for job in jobs.recent_jobs(user_id, limit=5)]
+    # Carried in the page links only when it differs from the default, which url_for() then leaves out
+    page_limit = limit if limit != PAGE_SIZE else None
+    return render_template('index.html', rows=rows, period=period, after=after, next_after=next_after,
+                           limit=page_limit, employee_count=employee_count(user_id), jobs=recent)
 
-@app.route('/', methods=['GET', 'POST'])
+@bp.route('/', methods=['GET', 'POST'])
 @login_required
 def index():
     period = request.args.get('period', f"{datetime.now().strftime('%Y-%m')}")
-    if current_user.is_admin:
-        employees = Employee.query.all()
-    else:
-        employees = Employee.query.filter_by(user_id=current_user.id).all()
     
     # Handle form submission
     if request.method == 'POST':
@@ -112,34 +240,46 @@ def index():
         first_name = request.form.get('first_name', '').strip()
         middle_name = request.form.get('middle_name', '').strip()
         last_name = request.form.get('last_name', '').strip()
+        email = request.form.get('email', '').strip().lower()
         basic_salary_str = request.form.get('basic_salary', '').strip()
         
         # Validate required fields
         if not all([employee_id, kra_pin, first_name, last_name, basic_salary_str]):
             flash('Please fill all required fields (* marked).', 'error')
-            return render_template('index.html', employees=employees, period=period)
+            return _render_dashboard(period)
         
         # Validate salary
         try:
             basic_salary = float(basic_salary_str)
             if basic_salary < 0 :
                 flash('Salary cannot be negative', 'error')
-                return render_template('index.html', employees=employees, period=period)
+                return _render_dashboard(period)
         except ValueError:
             flash('Please enter a valid salary amount.', 'error')
-            return render_template('index.html', employees=employees, period=period)
+            return _render_dashboard(period)
         
         # Validate KRA PIN format
         if not re.match(r'^A\d{9}[A-Z]$', kra_pin):
             flash('Invalid KRA PIN format. Use: AXXXXXXXXXX', 'error')
-            return render_template('index.html', employees=employees, period=period)
+            return _render_dashboard(period)
+
+        if email and (len(email) > 255 or not EMAIL_PATTERN.match(email)):
+            flash('Please enter a valid email address.', 'error')
+            return _render_dashboard(period)
+
+        try:
+            ensure_open(period)
+            rate_version_for_period(period)
+        except ValueError as e:
+            flash(str(e), 'error')
+            return _render_dashboard(period)
         
         try:
             # Check if employee ID exists
             existing = Employee.query.filter_by(id=employee_id).first()
             if existing:
                 flash('Employee ID already exists! Please use a different ID.', 'error')
-                return render_template('index.html', employees=employees, period=period)
+                return _render_dashboard(period)
             
             # Create new employee
             employee = Employee(
@@ -148,6 +288,7 @@ def index():
                 first_name=first_name,
                 middle_name=middle_name or '',
                 last_name=last_name,
+                email=email or None,
                 basic_salary=basic_salary,
                 user_id=current_user.id
             )
@@ -189,138 +330,525 @@ def index():
                 ahl=float(payroll_data['ahl']),
                 paye=float(payroll_data['paye']),
               
-                net_pay=float(payroll_data['net_pay'])
+                net_pay=float(payroll_data['net_pay']),
+                basic_salary=basic_salary,
+                benefits_total=float(payroll_data['benefits_total']),
+                rate_version=payroll_data['rate_version']
             )
             db.session.add(payroll)
+            ytd_deltas = {}
+            add_ytd_change(ytd_deltas, employee_id, period, new={**payroll_data, 'basic_salary': basic_salary})
+            apply_ytd_deltas(ytd_deltas)
+            lock_open(period)
             db.session.commit()
             
             flash(f'Employee {first_name} {last_name} added successfully!<br>Net Pay: KSh {payroll_data["net_pay"]:,.0f}', 'success')
-            return redirect(url_for('index', period=period))
+            return redirect(url_for('main.index', period=period))
         
         except Exception as e:
             db.session.rollback()
             flash(f'Error adding employee: {str(e)}', 'error')
-            print(f"Debug error: {e}")
+            logger.error("Error adding employee: %s", e, exc_info=True)
     
-    return render_template('index.html', employees=employees, period=period)
+    return _render_dashboard(period)
+
+@bp.route('/dashboard/data')
+@login_required
+def dashboard_data():
+    """JSON page of the employee table, for loading large tenants page by page."""
+    period = request.args.get('period', f"{datetime.now().strftime('%Y-%m')}")
+    user_id = None if current_user.is_admin else current_user.id
+    after, limit = _page_args()
+    employees, next_after = dashboard_rows(period, user_id, after, limit)
+    for employee in employees:
+        employee['payslip_url'] = (url_for('main.generate_payslip', employee_id=employee['id'], period=period)
+                                   if employee['calculated'] else None)
+    return jsonify({'period': period, 'employees': employees, 'next_after': next_after})
+
+@bp.route('/employees/search')
+@login_required
+def search_employees_json():
+    """Type-ahead matches for the employee search box."""
+    query = request.args.get('q', '').strip()
+    period = request.args.get('period', f"{datetime.now().strftime('%Y-%m')}")
+    user_id = None if current_user.is_admin else current_user.id
+    limit = max(1, min(request.args.get('limit', MAX_RESULTS, type=int), MAX_RESULTS))
+    employees = search_employees(query, period, user_id, limit)
+    for employee in employees:
+        employee['payslip_url'] = (url_for('main.generate_payslip', employee_id=employee['id'], period=period)
+                                   if employee['calculated'] else None)
+    return jsonify({'query': query, 'period': period, 'employees': employees})
+
+def _wants_json():
+    """True when the client prefers JSON over an HTML page (API clients, curl)."""
+    best = request.accept_mimetypes.best_match(['application/json', 'text/html'])
+    return best == 'application/json'
+
+@bp.route('/import_employees', methods=['POST'])
+@login_required
+def import_employees_csv():
+    """Bulk import employees and their payroll from an uploaded CSV."""
+    period = request.form.get('period') or datetime.now().strftime('%Y-%m')
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        if _wants_json():
+            return jsonify({'error': 'No CSV file uploaded'}), 400
+        flash('Please choose a CSV file to import.', 'error')
+        return redirect(url_for('main.index', period=period))
+
+    try:
+        stream = TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+        report = import_employees(stream, period, current_user.id)
+    except Exception as e:
+        logger.error("Employee import failed: %s", e, exc_info=True)
+        if _wants_json():
+            return jsonify({'error': f'Import failed: {str(e)}'}), 500
+        flash(f'Import failed: {str(e)}', 'error')
+        return redirect(url_for('main.index', period=period))
+
+    if _wants_json():
+        return jsonify(report)
+
+    flash(f"Imported {report['imported']} employees for {period}.", 'success')
+    if report['errors']:
+        shown = report['errors'][:10]
+        lines = '<br>'.join(f"Row {error['row']}: {escape(error['error'])}" for error in shown)
+        more = len(report['errors']) - len(shown)
+        if more:
+            lines += f'<br>...and {more} more'
+        flash(f"{len(report['errors'])} rows were skipped:<br>{lines}", 'error')
+    return redirect(url_for('main.index', period=period))
+
+@bp.route('/run_payroll', methods=['POST'])
+@login_required
+def run_payroll_period():
+    """Calculate payroll for all of the user's employees (every employee for admins) for a period.
+
+    Runs larger than one job chunk are queued as a payroll_run job instead,
+    which spreads them over every job worker.
+    """
+    period = (request.form.get('period') or request.args.get('period') or '').strip()
+    user_id = None if current_user.is_admin else current_user.id
+    try:
+        if employee_count(user_id) > jobs.CHUNK_SIZE:
+            if not PERIOD_PATTERN.match(period):
+                raise ValueError('Period must be in YYYY-MM format')
+            ensure_open(period)
+            rate_version_for_period(period)
+            job = jobs.enqueue('payroll_run', {'period': period, 'owner': user_id}, current_user.id)
+            if _wants_json():
+                return jsonify(jobs.job_status(job)), 202
+            flash(f'Payroll for {period} is running in the background as job {job.id}. '
+                  f'Progress is shown under Background Jobs.', 'success')
+            return redirect(url_for('main.index', period=period))
+        summary = run_payroll(period, user_id)
+    except ValueError as e:
+        if _wants_json():
+            return jsonify({'error': str(e)}), 400
+        flash(str(e), 'error')
+        return redirect(url_for('main.index'))
+    except Exception as e:
+        logger.error("Payroll run for %s failed: %s", period, e, exc_info=True)
+        if _wants_json():
+            return jsonify({'error': f'Payroll run failed: {str(e)}'}), 500
+        flash(f'Payroll run failed: {str(e)}', 'error')
+        return redirect(url_for('main.index', period=period))
+
+    if _wants_json():
+        return jsonify(summary)
+    flash(f"Payroll for {period} calculated for {summary['employees']} employees "
+          f"({summary['created']} new, {summary['updated']} updated).", 'success')
+    return redirect(url_for('main.index', period=period))
+
+@bp.route('/recompute_payroll', methods=['POST'])
+@login_required
+def recompute_payroll_period():
+    """Recompute only the payroll rows of a period affected by salary, benefit or rate changes.
+
+    JSON clients can send {"period": ..., "salaries": {id: amount}, "benefits": {id: amount}}.
+    """
+    data = request.get_json(silent=True) or {}
+    period = (data.get('period') or request.form.get('period') or request.args.get('period') or '').strip()
+    user_id = None if current_user.is_admin else current_user.id
+    try:
+        report = recompute_payroll(period, user_id, data.get('salaries'), data.get('benefits'))
+    except ValueError as e:
+        if _wants_json():
+            return jsonify({'error': str(e)}), 400
+        flash(str(e), 'error')
+        return redirect(url_for('main.index'))
+    except Exception as e:
+        logger.error("Payroll recompute for %s failed: %s", period, e, exc_info=True)
+        if _wants_json():
+            return jsonify({'error': f'Recompute failed: {str(e)}'}), 500
+        flash(f'Recompute failed: {str(e)}', 'error')
+        return redirect(url_for('main.index', period=period))
+
+    if _wants_json():
+        return jsonify(report)
+    flash(f"Checked {report['checked']} payroll rows for {period}; {report['changed']} changed.", 'success')
+    return redirect(url_for('main.index', period=period))
+
+@bp.route('/payroll/simulate', methods=['POST'])
+@login_required
+def simulate_payroll():
+    """What-if totals for a period under a scenario, calculated in memory and never saved.
+
+    Takes JSON like {"period": "2025-03", "raise_percent": 5, "rates": {"shif": {"rate": 0.03}}}.
+    """
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'The request body must be a JSON object'}), 400
+    period = data.get('period') or request.args.get('period') or ''
+    if not isinstance(period, str):
+        return jsonify({'error': 'Period must be in YYYY-MM format'}), 400
+    scenario = {key: value for key, value in data.items() if key != 'period'}
+    user_id = None if current_user.is_admin else current_user.id
+    try:
+        return jsonify(simulate(period.strip(), scenario, user_id))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
-@app.route('/generate_payslip/<employee_id>/<period>')
+@bp.route('/generate_payslip/<employee_id>/<period>')
 def generate_payslip(employee_id, period):
     """Generate PDF payslip for specific employee."""
     try:
-        logger.debug(f"Attempting to generate payslip for employee_id: {employee_id}, period: {period}")
-        employee = Employee.query.get_or_404(employee_id)
-        payroll = Payroll.query.filter_by(employee_id=employee_id, period=period).first()
+        logger.debug("Attempting to generate payslip for employee_id: %s, period: %s", employee_id, period)
+        session = database.read_session()
+        employee = session.get(Employee, employee_id)
+        if employee is None:
+            flash('Employee not found.', 'error')
+            return redirect(url_for('main.index'))
+        # Archived periods are read from payroll_archive
+        payroll = session.query(payroll_model(period, session)).filter_by(employee_id=employee_id, period=period).first()
 
         if not payroll:
-            logger.warning(f"No payroll data found for employee {employee_id} in period {period}")
+            logger.warning("No payroll data found for employee %s in period %s", employee_id, period)
             flash('No payroll data found for this period. Please calculate payroll first.', 'error')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         
-        if not current_user.is_admin and payroll.employee.user_id != current_user.id:
+        if not current_user.is_admin and employee.user_id != current_user.id:
             flash('You are not authorized to view this payslip.', 'error')
-            return redirect(url_for('index'))
+            return redirect(url_for('main.index'))
         
-        # Generate PDF
-        pdf_buffer = generate_payslip_pdf(employee, payroll)
-        logger.debug(f"Payslip PDF generated for {employee_id}")
-        return send_file(
-            pdf_buffer,
+        ytd = ytd_for_period(employee_id, period)
+        # The cache key doubles as the ETag, so repeat downloads can be answered without the PDF.
+        # It is the only validator: calculated_at would miss edits to the employee
+        etag = payslip_cache_key(payroll, employee, ytd)
+        if not is_resource_modified(request.environ, etag=etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+
+        pdf = payslip_cache.get(etag)
+        if pdf is None:
+            # Imported on first use, so processes that never render a payslip never load ReportLab
+            from generate_pdf import generate_payslip_pdf
+            started = time.perf_counter()
+            pdf = generate_payslip_pdf(employee, payroll, ytd=ytd).getvalue()
+            metrics.observe_pdf_render(time.perf_counter() - started, len(pdf))
+            payslip_cache.put(etag, pdf)
+            logger.debug("Payslip PDF generated for %s", employee_id)
+        response = send_file(
+            BytesIO(pdf),
             as_attachment=True,
             download_name=f'payslip_{employee_id}_{period}.pdf',
-            mimetype='application/pdf'
+            mimetype='application/pdf',
+            etag=etag,
         )
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
     except Exception as e:
-        logger.error(f"Error generating payslip for {employee_id}: {str(e)}", exc_info=True)
+        logger.error("Error generating payslip for %s: %s", employee_id, e, exc_info=True)
         flash(f'Error generating payslip: {str(e)}', 'error')
-        return redirect(url_for('index'))
+        return redirect(url_for('main.index'))
     
-@app.route('/generate_p10/<period>')
+@bp.route('/generate_payslips/<period>')
+@login_required
+def generate_payslips_zip(period):
+    """Download every payslip for a period as one ZIP, optionally for a single owner."""
+    owner = request.args.get('owner', type=int)
+    if not current_user.is_admin:
+        if owner is not None and owner != current_user.id:
+            flash('You are not authorized to export these payslips.', 'error')
+            return redirect(url_for('main.index', period=period))
+        owner = current_user.id
+
+    if not has_payroll(period, owner):
+        flash('No payroll data for this period', 'error')
+        return redirect(url_for('main.index', period=period))
+
+    logger.debug("Exporting payslips for period %s, owner %s", period, owner)
+    archive = iter_payslip_zip(payslip_records(period, owner))
+    return Response(
+        stream_with_context(archive),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename=payslips_{period}.zip'}
+    )
+
+@bp.route('/generate_p10/<period>')
+@login_required
 def generate_p10(period):
     """Generate KRA P10 CSV report"""
     try:
-        if current_user.is_admin or Employee.user_id == current_user.id:
-            payroll_records = db.session.query(Payroll).join(Employee).filter(Payroll.period == period).all()
-        else:
-            payroll_records = db.session.query(Payroll).join(Employee).filter(
-                Payroll.period == period, Employee.user_id == current_user.id).all()
-        
-        if not payroll_records:
+        user_id = None if current_user.is_admin else current_user.id
+        if not has_payroll(period, user_id):
             flash('No payroll data for this period', 'error')
-            return redirect(url_for('index'))
-        
-        # Create CSV in memory
-        output = StringIO()
-        writer = csv.writer(output)
-        
-        # Header
-        writer.writerow([
-            'PIN', 'Names', 'Gross_Pay', 'PAYE', 'NSSF', 
-            'Other_Deductions', 'Taxable_Pay', 'Month_Year'
-        ])
-        
-        # Data rows
-        for payroll in payroll_records:
-            employee = payroll.employee
-            taxable_pay = payroll.gross_salary - payroll.nssf - payroll.ahl
-            writer.writerow([
-                employee.kra_pin,
-                f'"{employee.first_name} {employee.middle_name} {employee.last_name}".strip()',
-                f"{payroll.gross_salary:.2f}",
-                f"{payroll.paye:.2f}",
-                f"{payroll.nssf:.2f}",
-                "0.00",
-                f"{taxable_pay:.2f}",
-                period
-            ])
-        
-        # Summary row
-        total_gross = sum(p.gross_salary for p in payroll_records)
-        total_paye = sum(p.paye for p in payroll_records)
-        writer.writerow([
-            '', f'TOTAL ({len(payroll_records)} employees)',
-            f"{total_gross:.2f}", f"{total_paye:.2f}", '', '', '', ''
-        ])
-        
-        output.seek(0)
+            return redirect(url_for('main.index'))
+
         filename = f'P10_Report_{period}.csv'
-        
-        return send_file(
-            BytesIO(output.getvalue().encode('utf-8')),
-            as_attachment=True,
-            download_name=filename,
-            mimetype='text/csv'
+        return Response(
+            stream_with_context(iter_p10_csv(period, user_id)),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
         )
     except Exception as e:
         flash(f'Error generating P10 report: {str(e)}', 'error')
-        print(f"P10 Error: {e}")
-        return redirect(url_for('index'))
+        logger.error("P10 error for %s: %s", period, e, exc_info=True)
+        return redirect(url_for('main.index'))
+
+@bp.route('/generate_p9/<int:year>')
+@login_required
+def generate_p9(year):
+    """Generate the annual P9-style CSV from the year-to-date totals"""
+    try:
+        user_id = None if current_user.is_admin else current_user.id
+        if not has_ytd(year, user_id):
+            flash(f'No payroll data for {year}', 'error')
+            return redirect(url_for('main.index'))
+
+        filename = f'P9_Report_{year}.csv'
+        return Response(
+            stream_with_context(iter_p9_csv(year, user_id)),
+            mimetype='text/csv',
+            headers={'Content-Disposition': f'attachment; filename={filename}'}
+        )
+    except Exception as e:
+        flash(f'Error generating P9 report: {str(e)}', 'error')
+        logger.error("P9 error for %s: %s", year, e, exc_info=True)
+        return redirect(url_for('main.index'))
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    """Prometheus scrape endpoint. Set METRICS_TOKEN to require it as a bearer token."""
+    token = os.getenv('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    return Response(metrics.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/admin/profiles')
+@login_required
+def list_profiles():
+    """Saved request profiles, newest first."""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Admin access required'}), 403
+    return jsonify({'profiles': current_app.extensions['profile_store'].list()})
 
-@app.route('/clear_employees', methods=['POST'])
+@bp.route('/admin/profiles/<profile_id>')
+@login_required
+def download_profile(profile_id):
+    """Collapsed stacks for a flamegraph, or ?format=json for the metadata and SQL."""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Admin access required'}), 403
+    as_json = request.args.get('format') == 'json'
+    path = current_app.extensions['profile_store'].path(profile_id, 'json' if as_json else 'collapsed')
+    if path is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    if as_json:
+        return send_file(path, mimetype='application/json')
+    return send_file(path, mimetype='text/plain', as_attachment=True,
+                     download_name=f'profile_{profile_id}.collapsed')
+
+@bp.route('/jobs', methods=['POST'])
+@login_required
+def create_job():
+    """Queue a payroll run, payslip ZIP or emails, P10 export or archive to run in the background."""
+    data = request.get_json(silent=True) or request.form
+    kind = data.get('kind')
+    period = (data.get('period') or '').strip()
+    if kind not in ('payroll_run', 'payslips_zip', 'payslip_email', 'p10', 'archive_period'):
+        error = 'Unknown job kind'
+    elif not PERIOD_PATTERN.match(period):
+        error = 'Period must be in YYYY-MM format'
+    elif kind == 'archive_period' and not current_user.is_admin:
+        error = 'Only admins can archive periods'
+    elif kind == 'archive_period' and period >= archive_horizon():
+        error = f'Only periods before {archive_horizon()} can be archived'
+    else:
+        error = None
+    if error:
+        if _wants_json():
+            return jsonify({'error': error}), 400
+        flash(error, 'error')
+        return redirect(url_for('main.index'))
+
+    owner = None if current_user.is_admin else current_user.id
+    params = {'period': period} if kind == 'archive_period' else {'period': period, 'owner': owner}
+    job = jobs.enqueue(kind, params, current_user.id)
+    if _wants_json():
+        return jsonify(jobs.job_status(job)), 202
+    flash(f'Job {job.id} queued. Progress is shown under Background Jobs.', 'success')
+    return redirect(url_for('main.index', period=period))
+
+def _job_or_none(job_id):
+    """The job, if it exists and the current user may see it."""
+    job = db.session.get(Job, job_id)
+    if job is None or (not current_user.is_admin and job.user_id != current_user.id):
+        return None
+    return job
+
+@bp.route('/jobs')
+@login_required
+def list_jobs():
+    """The current user's latest jobs (everyone's for admins)."""
+    user_id = None if current_user.is_admin else current_user.id
+    limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+    return jsonify({'jobs': [jobs.job_status(job) for job in jobs.recent_jobs(user_id, limit)]})
+
+@bp.route('/jobs/<int:job_id>')
+@login_required
+def job_detail(job_id):
+    """Status and progress of one job, for polling."""
+    job = _job_or_none(job_id)
+    if job is None:
+        return jsonify({'error': 'Job not found'}), 404
+    status = jobs.job_status(job)
+    if status['result'] and status['result'].get('file'):
+        status['download_url'] = url_for('main.download_job_output', job_id=job.id)
+    return jsonify(status)
+
+@bp.route('/jobs/<int:job_id>/download')
+@login_required
+def download_job_output(job_id):
+    """The file produced by a finished export job."""
+    job = _job_or_none(job_id)
+    result = jobs.job_status(job)['result'] if job is not None else None
+    if not result or not result.get('file'):
+        flash('That job has no file to download.', 'error')
+        return redirect(url_for('main.index'))
+    path = os.path.join(current_app.config['JOB_OUTPUT_DIR'], result['file'])
+    if not os.path.exists(path):
+        flash('The job output is no longer available. Please run the job again.', 'error')
+        return redirect(url_for('main.index'))
+    return send_file(path, as_attachment=True, download_name=result['download_name'])
+
+@bp.route('/api/tokens', methods=['POST'])
+@login_required
+def create_api_token():
+    """Create a read API token for the current user. The token is only shown in this response."""
+    data = request.get_json(silent=True) or request.form
+    name = (data.get('name') or '').strip()
+    if not name:
+        return jsonify({'error': 'A token name is required'}), 400
+    scopes = data.get('scopes')
+    if isinstance(scopes, str):
+        scopes = scopes.split()
+    try:
+        api_token, token = api.create_api_token(current_user.id, name[:100], scopes)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({**api.token_info(api_token), 'token': token}), 201
+
+@bp.route('/api/tokens')
+@login_required
+def list_api_tokens():
+    """The current user's API tokens (everyone's for admins), without the tokens themselves."""
+    user_id = None if current_user.is_admin else current_user.id
+    return jsonify({'tokens': [api.token_info(api_token) for api_token in api.list_api_tokens(user_id)]})
+
+@bp.route('/api/tokens/<int:token_id>', methods=['DELETE'])
+@login_required
+def revoke_api_token(token_id):
+    """Revoke an API token."""
+    api_token = db.session.get(ApiToken, token_id)
+    if api_token is None or (not current_user.is_admin and api_token.user_id != current_user.id):
+        return jsonify({'error': 'Token not found'}), 404
+    api.revoke_api_token(api_token)
+    return jsonify(api.token_info(api_token))
+
+def api_token_required(scope):
+    """Authenticate an API request by a bearer token with scope and put its user in g.api_user."""
+    def decorator(fn):
+        @wraps(fn)
+        def wrapper(*args, **kwargs):
+            scheme, _, token = request.headers.get('Authorization', '').partition(' ')
+            try:
+                user = api.user_for_token(token.strip(), scope) if scheme.lower() == 'bearer' else None
+            except PermissionError as e:
+                return jsonify({'error': str(e)}), 403
+            if user is None:
+                return jsonify({'error': 'A valid API token is required'}), 401, {'WWW-Authenticate': 'Bearer'}
+            g.api_user = user
+            return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def _api_owner():
+    """Owner filter for an API request: ?owner= for admins, always the token's user otherwise."""
+    owner = request.args.get('owner', type=int)
+    if not g.api_user.is_admin:
+        if owner is not None and owner != g.api_user.id:
+            return None, (jsonify({'error': 'Not authorized for this owner'}), 403)
+        owner = g.api_user.id
+    return owner, None
+
+@bp.route('/api/v1/employees')
+@api_token_required('employees:read')
+def api_employees():
+    """Employees in id order, one keyset page at a time."""
+    owner, error = _api_owner()
+    if error:
+        return error
+    after, limit = _page_args()
+    employees, next_after = api.employee_page(owner, after, limit)
+    return jsonify({'employees': employees, 'next_after': next_after})
+
+@bp.route('/api/v1/payroll')
+@api_token_required('payroll:read')
+def api_payroll():
+    """Payroll rows one keyset page at a time, or a whole period as NDJSON with ?format=ndjson."""
+    owner, error = _api_owner()
+    if error:
+        return error
+    period = request.args.get('period') or None
+    if period is not None and not PERIOD_PATTERN.match(period):
+        return jsonify({'error': 'Period must be in YYYY-MM format'}), 400
+
+    if request.args.get('format') == 'ndjson':
+        if period is None:
+            return jsonify({'error': 'NDJSON export needs a period'}), 400
+        return Response(
+            stream_with_context(api.iter_payroll_ndjson(period, owner)),
+            mimetype='application/x-ndjson',
+        )
+
+    after, limit = _page_args()
+    try:
+        payroll, next_after = api.payroll_page(period, owner, after, limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'period': period, 'payroll': payroll, 'next_after': next_after})
+
+@bp.route('/clear_employees', methods=['POST'])
 @login_required
 def clear_employees():
+    """Delete the user's employees and their payroll (everyone's for admins) in a background job."""
+    owner = None if current_user.is_admin else current_user.id
     try:
-        if current_user.is_admin:
-            # Admin: Delete all records from the Payroll table.
-            deleted_count = db.session.query(Employee).delete()
-            entity_name = "payroll"
-        else:
-            # Regular User: Delete only payrolls for employees they own.
-            # This joins Payroll with Employee and filters by the current user's ID.
-            deleted_count = db.session.query(Payroll).join(Employee).filter(
-                Employee.user_id == current_user.id
-            ).delete(synchronize_session=False)
-            entity_name = "employee"
-        db.session.commit() 
-        flash("All employee records have been cleared.", "success")
+        job = jobs.enqueue('clear_employees', {'owner': owner}, current_user.id)
     except Exception as e:
         db.session.rollback()
         flash(f"Error clearing employee records: {str(e)}", "error")
-    return redirect(url_for('index'))
-
+        return redirect(url_for('main.index'))
+    flash(f"Clearing employee records in the background (job {job.id}).", "success")
+    return redirect(url_for('main.index'))
 
 
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
-        db.create_all()  # Ensure tables are created
+        upgrade_schema(db.engine)  # Ensure tables are created
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), debug=False)
\ No newline at end of file
@@ -0,0 +1,192 @@
+"""Archiving closed payroll periods.
+
+Once a period is more than ARCHIVE_AFTER_MONTHS old, its rows can be moved
+from the payroll table to payroll_archive. That keeps the hot table and its
+indexes down to recent periods. An archive runs in steps, each made of
+chunks that commit on their own, so it can resume after a crash:
+
+1. The period is recorded as 'archiving', which closes it to payroll writes.
+2. Its rows are copied to payroll_archive, keeping their ids.
+3. The period is marked 'archived', which switches reads to the archive.
+4. The rows are deleted from payroll.
+
+At every point, all of the period's rows are in the table that reads use.
+Writers check ensure_open() up front, and check again with lock_open()
+just before they commit. A write that is already under way when the period
+closes either commits before the archive starts or is rolled back. As a
+further guard, a row is only deleted from payroll once its archived copy
+matches it exactly. A row that does not match is copied again first.
+"""
+import os
+from datetime import datetime
+
+from sqlalchemy import and_, delete, func, insert, select, text
+from sqlalchemy.exc import IntegrityError
+
+from models import db, ArchivedPeriod, Payroll, PayrollArchive
+
+ARCHIVE_AFTER_MONTHS = int(os.getenv('ARCHIVE_AFTER_MONTHS', 24))
+# Arbitrary key for the Postgres advisory locks that order payroll writes against closing a period
+ADVISORY_LOCK_KEY = 7315002
+# Rows copied or deleted per transaction
+CHUNK_SIZE = 5000
+
+# The archive has the same columns as payroll
+_COLUMNS = [column.name for column in Payroll.__table__.columns]
+
+
+def archive_horizon(today=None):
+    """The oldest period that stays open; periods before it can be archived."""
+    today = today or datetime.utcnow()
+    months = today.year * 12 + today.month - 1 - ARCHIVE_AFTER_MONTHS
+    return f'{months // 12:04d}-{months % 12 + 1:02d}'
+
+
+def period_status(period, session=None):
+    """'archiving', 'archived', or None for an open period."""
+    session = session or db.session
+    return session.query(ArchivedPeriod.status).filter(ArchivedPeriod.period == period).scalar()
+
+
+def payroll_model(period, session=None):
+    """The model that holds a period's payroll rows for reading: PayrollArchive once archived, else Payroll."""
+    return PayrollArchive if period_status(period, session) == 'archived' else Payroll
+
+
+def ensure_open(period):
+    """Raise ValueError if the period has been closed by archiving."""
+    if period_status(period) is not None:
+        raise ValueError(f'Payroll for {period} is archived and can no longer be changed')
+
+
+def _period_lock(period, shared):
+    """Take the period's transaction-level advisory lock on Postgres.
+
+    Writers share it and closing a period takes it exclusively. On SQLite
+    the database's single write lock already orders them.
+    """
+    if db.session.get_bind().dialect.name != 'postgresql':
+        return
+    function = 'pg_advisory_xact_lock_shared' if shared else 'pg_advisory_xact_lock'
+    db.session.execute(text(f"SELECT {function}(:key, :period)"),
+                       {'key': ADVISORY_LOCK_KEY, 'period': int(period.replace('-', ''))})
+
+
+def lock_open(period):
+    """Check again, inside the current write transaction, that the period is still open.
+
+    Call it after the payroll writes and before the commit. The period then
+    cannot close until the transaction ends: archiving waits for it, and its
+    copy sees the committed rows. If the period closed while the writes were
+    being prepared, ValueError is raised and the caller rolls back.
+    """
+    _period_lock(period, shared=True)
+    ensure_open(period)
+
+
+def archivable_periods(today=None):
+    """Periods before the horizon that still have rows in the payroll table."""
+    query = (db.session.query(Payroll.period).filter(Payroll.period < archive_horizon(today))
+             .distinct().order_by(Payroll.period))
+    return [period for period, in query]
+
+
+def _start(period, today=None):
+    horizon = archive_horizon(today)
+    if period >= horizon:
+        raise ValueError(f'Only periods before {horizon} can be archived')
+    try:
+        # Waits for writers that have passed lock_open() to commit
+        _period_lock(period, shared=False)
+        db.session.add(ArchivedPeriod(period=period, status='archiving'))
+        db.session.commit()
+    except IntegrityError:
+        # Another worker started it first
+        db.session.rollback()
+
+
+def _copy_rows(ids):
+    """Copy payroll rows to the archive, replacing any copy they already have. Does not commit."""
+    payroll = Payroll.__table__
+    db.session.execute(delete(PayrollArchive).where(PayrollArchive.id.in_(ids)))
+    db.session.execute(insert(PayrollArchive).from_select(
+        _COLUMNS, select(*[payroll.c[name] for name in _COLUMNS]).where(payroll.c.id.in_(ids))
+    ))
+
+
+def _copy_chunk(period, after):
+    """Copy the next chunk of rows after employee id `after`. Returns (rows copied, last employee id)."""
+    query = select(Payroll.id, Payroll.employee_id).where(Payroll.period == period)
+    if after is not None:
+        query = query.where(Payroll.employee_id > after)
+    rows = db.session.execute(query.order_by(Payroll.employee_id).limit(CHUNK_SIZE)).all()
+    if not rows:
+        return 0, after
+    try:
+        _copy_rows([payroll_id for payroll_id, _ in rows])
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(rows), rows[-1][1]
+
+
+def _finish_copy(period):
+    archived = db.session.get(ArchivedPeriod, period)
+    archived.rows = db.session.query(func.count(PayrollArchive.id)).filter(PayrollArchive.period == period).scalar()
+    archived.status = 'archived'
+    archived.archived_at = datetime.utcnow()
+    db.session.commit()
+
+
+def _delete_chunk(period):
+    """Delete the next chunk of the period's rows from payroll. Returns the rows deleted.
+
+    A row whose archived copy is missing or differs from it is copied again
+    in the same transaction first, so a write the copy step missed is never
+    lost.
+    """
+    payroll, archive = Payroll.__table__, PayrollArchive.__table__
+    copied = and_(*[archive.c[name].is_not_distinct_from(payroll.c[name]) for name in _COLUMNS])
+    rows = db.session.execute(
+        select(payroll.c.id, archive.c.id.is_not(None) & copied)
+        .select_from(payroll.outerjoin(archive, archive.c.id == payroll.c.id))
+        .where(payroll.c.period == period).limit(CHUNK_SIZE)
+    ).all()
+    if not rows:
+        return 0
+    ids = [payroll_id for payroll_id, _ in rows]
+    stale = [payroll_id for payroll_id, matches in rows if not matches]
+    try:
+        if stale:
+            _copy_rows(stale)
+        db.session.execute(delete(Payroll).where(Payroll.id.in_(ids)))
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(ids)
+
+
+def archive_period(period, after=None, today=None):
+    """Archive a period, yielding (step, rows, after) after each committed chunk.
+
+    step is 'copy' or 'delete'. To resume an interrupted archive, pass the
+    last `after` yielded. Raises ValueError if the period is not old enough.
+    """
+    status = period_status(period)
+    if status is None:
+        _start(period, today)
+        status = period_status(period)
+    if status == 'archiving':
+        while True:
+            copied, after = _copy_chunk(period, after)
+            if not copied:
+                break
+            yield 'copy', copied, after
+        _finish_copy(period)
+    while True:
+        deleted = _delete_chunk(period)
+        if not deleted:
+            break
+        yield 'delete', deleted, after
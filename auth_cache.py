@@ -0,0 +1,91 @@
+"""Per-process caches for authentication, so most requests resolve their user without a query.
+
+Entries live for AUTH_CACHE_TTL seconds. Changes made in this process drop
+the affected entries straight away (see the mapper events below). Changes
+made by another worker process show up here within the TTL.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event
+
+from models import db, ApiToken, User
+
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', 30))
+AUTH_CACHE_ITEMS = int(os.getenv('AUTH_CACHE_ITEMS', 4096))
+
+
+class TTLCache:
+    """Thread-safe LRU mapping whose entries expire ttl seconds after they were stored."""
+
+    def __init__(self, ttl=AUTH_CACHE_TTL, max_items=AUTH_CACHE_ITEMS):
+        self.ttl = ttl
+        self.max_items = max_items
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._items[key]
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if self.ttl <= 0 or self.max_items <= 0:
+            return
+        with self._lock:
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+
+# User id -> detached User
+users = TTLCache()
+# API token hash -> (token id, user id, scopes) of a live token
+tokens = TTLCache()
+
+
+def load_user(user_id):
+    """The user with this id, attached to the current session, or None.
+
+    The cache holds a detached copy. merge(load=False) attaches it to this
+    request's session without a query, so relationships still lazy-load as
+    usual.
+    """
+    user = users.get(user_id)
+    if user is None:
+        user = db.session.get(User, user_id)
+        if user is None:
+            return None
+        db.session.expunge(user)
+        users.put(user_id, user)
+    return db.session.merge(user, load=False)
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def _forget_user(mapper, connection, target):
+    users.invalidate(target.id)
+
+
+@event.listens_for(ApiToken, 'after_update')
+@event.listens_for(ApiToken, 'after_delete')
+def _forget_token(mapper, connection, target):
+    tokens.invalidate(target.token_hash)
@@ -0,0 +1,190 @@
+"""Benchmark the payroll hot paths against synthetic workforces.
+
+    python benchmarks/run.py --sizes 1000 10000 100000 --output bench.json
+
+Each size runs in its own process against its own SQLite database, which is
+generated once per size and seed and reused on later runs (pass
+--regenerate to rebuild it). Results are written as JSON so runs from
+different commits can be compared.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+PERIOD = '2025-03'
+
+
+def _stats(samples):
+    samples_ms = [sample * 1000 for sample in samples]
+    return {
+        'runs': len(samples_ms),
+        'mean_ms': round(statistics.mean(samples_ms), 3),
+        'median_ms': round(statistics.median(samples_ms), 3),
+        'min_ms': round(min(samples_ms), 3),
+        'max_ms': round(max(samples_ms), 3),
+        'stdev_ms': round(statistics.stdev(samples_ms), 3) if len(samples_ms) > 1 else 0.0,
+    }
+
+
+def _time(fn, runs):
+    fn()  # warm up
+    samples = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return _stats(samples)
+
+
+def run_size(size, db_path, seed, regenerate):
+    """Run every benchmark for one workforce size. Must run in a fresh process."""
+    from workforce import ADMIN_EMAIL, PASSWORD, generate_workforce
+
+    database_uri = f'sqlite:///{db_path}'
+    if regenerate and os.path.exists(db_path):
+        os.remove(db_path)
+    results = {'employees': size}
+    if not os.path.exists(db_path):
+        start = time.perf_counter()
+        generate_workforce(database_uri, size, seed=seed)
+        results['generate_s'] = round(time.perf_counter() - start, 3)
+
+    os.environ['SQLALCHEMY_DATABASE_URI'] = database_uri
+    os.environ.setdefault('SECRET_KEY', 'benchmark')
+    os.environ.setdefault('JOB_WORKERS', '0')
+    sys.path.insert(0, REPO_DIR)
+
+    start = time.perf_counter()
+    from app import create_app
+    app = create_app()
+    results['import_app_ms'] = round((time.perf_counter() - start) * 1000, 3)
+
+    from migrations import upgrade_schema
+    from models import db, Employee, Payroll
+    from payroll_calculator import calculate_payroll, calculate_payroll_batch
+    from generate_pdf import generate_payslip_pdf
+
+    timings = {}
+    with app.app_context():
+        # A database generated by an older commit may be missing newer migrations
+        upgrade_schema(db.engine)
+        inputs = [
+            (basic_salary, benefits_total or 0.0)
+            for basic_salary, benefits_total in Payroll.query
+            .with_entities(Payroll.basic_salary, Payroll.benefits_total)
+            .filter(Payroll.period == PERIOD)
+        ]
+        sample = inputs[:1000]
+
+        def scalar_payroll():
+            for basic_salary, benefits_total in sample:
+                calculate_payroll({'basic_salary': basic_salary,
+                                   'benefits': [{'amount': benefits_total}]}, PERIOD)
+
+        timings['calculate_payroll_x1000'] = _time(scalar_payroll, 5)
+        timings['calculate_payroll_batch_all'] = _time(
+            lambda: calculate_payroll_batch([i[0] for i in inputs], [i[1] for i in inputs], PERIOD), 5)
+
+        pairs = (Payroll.query.join(Employee).filter(Payroll.period == PERIOD)
+                 .with_entities(Employee, Payroll).limit(20).all())
+        for renderer in ('platypus', 'canvas'):
+            timings[f'generate_payslip_pdf_{renderer}_x20'] = _time(
+                lambda: [generate_payslip_pdf(employee, payroll, renderer) for employee, payroll in pairs], 3)
+
+    client = app.test_client()
+
+    def login():
+        response = app.test_client().post('/login', data={'email': ADMIN_EMAIL, 'password': PASSWORD})
+        assert response.status_code == 302, response.status_code
+
+    timings['login'] = _time(login, 5)
+
+    client.post('/login', data={'email': ADMIN_EMAIL, 'password': PASSWORD})
+
+    def p10():
+        response = client.get(f'/generate_p10/{PERIOD}')
+        body = response.get_data()
+        assert response.status_code == 200 and body, response.status_code
+
+    def dashboard():
+        response = client.get(f'/?period={PERIOD}')
+        assert response.status_code == 200, response.status_code
+
+    timings['generate_p10'] = _time(p10, 3)
+    timings['index_dashboard'] = _time(dashboard, 10)
+
+    results['timings'] = timings
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--db-dir', default=os.path.join(tempfile.gettempdir(), 'payroll-bench'))
+    parser.add_argument('--regenerate', action='store_true', help='rebuild the databases even if they exist')
+    parser.add_argument('--output', help='write results here instead of stdout')
+    parser.add_argument('--single', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--result-file', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    os.makedirs(args.db_dir, exist_ok=True)
+
+    def db_path(size):
+        return os.path.join(args.db_dir, f'workforce_{size}_seed{args.seed}.db')
+
+    if args.single:
+        results = run_size(args.single, db_path(args.single), args.seed, args.regenerate)
+        with open(args.result_file, 'w') as f:
+            json.dump(results, f)
+        return
+
+    report = {
+        'commit': _git_commit(),
+        'timestamp': datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'sizes': [],
+    }
+    for size in args.sizes:
+        print(f'Benchmarking {size} employees...', file=sys.stderr)
+        with tempfile.NamedTemporaryFile(suffix='.json', delete=False) as f:
+            result_file = f.name
+        try:
+            command = [sys.executable, os.path.abspath(__file__), '--single', str(size),
+                       '--seed', str(args.seed), '--db-dir', args.db_dir, '--result-file', result_file]
+            if args.regenerate:
+                command.append('--regenerate')
+            subprocess.run(command, check=True, cwd=BENCH_DIR)
+            with open(result_file) as f:
+                report['sizes'].append(json.load(f))
+        finally:
+            os.remove(result_file)
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+"""Measure app startup time and the memory of a gunicorn deployment.
+
+    python benchmarks/startup.py --workers 4 --output startup.json
+
+Startup is timed in fresh processes. Three things are timed:
+- importing the app and building it with create_app();
+- the same followed by loading the payslip renderer, which create_app() leaves until the first payslip;
+- the schema check that `flask migrate` now runs, which used to run on every import.
+
+Memory is measured by starting gunicorn with the repo's gunicorn.conf.py,
+once with preload_app and once without. Every worker renders payslips
+first. Then the RSS and PSS of the master and its workers are summed from
+/proc (Linux only). PSS splits each shared page between the processes
+that map it, so the PSS total shows what copy-on-write sharing saves.
+"""
+import argparse
+import http.cookiejar
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+PERIOD = '2025-03'
+
+_STARTUP_SNIPPETS = {
+    'create_app': 'import app; app.create_app()',
+    'create_app_and_renderer': 'import app; app.create_app(); import generate_pdf',
+}
+_SCHEMA_SNIPPET = '''
+import time, app
+from migrations import upgrade_schema
+from models import db
+flask_app = app.create_app()
+with flask_app.app_context():
+    start = time.perf_counter()
+    upgrade_schema(db.engine)
+    print((time.perf_counter() - start) * 1000)
+'''
+
+
+def _env(database_uri, **extra):
+    env = dict(os.environ, SQLALCHEMY_DATABASE_URI=database_uri, SECRET_KEY='benchmark', JOB_WORKERS='0',
+               PAYSLIP_CACHE_ITEMS='0')
+    env.update(extra)
+    return env
+
+
+def _python_ms(code, env):
+    """Milliseconds a snippet takes in a fresh interpreter, measured inside it."""
+    timed = f'import time; _start = time.perf_counter()\n{code}\nprint((time.perf_counter() - _start) * 1000)'
+    output = subprocess.check_output([sys.executable, '-c', timed], cwd=REPO_DIR, env=env, text=True)
+    return float(output.split()[-1])
+
+
+def _summary(samples):
+    return {'runs': len(samples), 'median_ms': round(statistics.median(samples), 1),
+            'min_ms': round(min(samples), 1), 'max_ms': round(max(samples), 1)}
+
+
+def measure_startup(database_uri, runs):
+    env = _env(database_uri)
+    results = {name: _summary([_python_ms(code, env) for _ in range(runs)])
+               for name, code in _STARTUP_SNIPPETS.items()}
+    schema = [float(subprocess.check_output([sys.executable, '-c', _SCHEMA_SNIPPET], cwd=REPO_DIR,
+                                            env=env, text=True).split()[-1]) for _ in range(runs)]
+    results['schema_check'] = _summary(schema)
+    return results
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def _children(pid):
+    try:
+        with open(f'/proc/{pid}/task/{pid}/children') as f:
+            return [int(child) for child in f.read().split()]
+    except OSError:
+        return []
+
+
+def _memory_kb(pid):
+    """(RSS, PSS) of a process in kB."""
+    with open(f'/proc/{pid}/status') as f:
+        rss = next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        pss = next(int(line.split()[1]) for line in f if line.startswith('Pss:'))
+    return rss, pss
+
+
+def _wait_until_up(base_url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with urllib.request.urlopen(f'{base_url}/login', timeout=2) as response:
+                if response.status == 200:
+                    return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError('gunicorn did not start')
+
+
+def measure_gunicorn(database_uri, workers, preload, employee_ids):
+    port = _free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    env = _env(database_uri, GUNICORN_PRELOAD='1' if preload else '0', WEB_CONCURRENCY=str(workers))
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py',
+                               '--bind', f'127.0.0.1:{port}', '--log-level', 'warning'],
+                              cwd=REPO_DIR, env=env)
+    try:
+        _wait_until_up(base_url)
+        boot_ms = (time.perf_counter() - started) * 1000
+
+        from workforce import ADMIN_EMAIL, PASSWORD
+        opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()))
+        opener.open(f'{base_url}/login', urllib.parse.urlencode(
+            {'email': ADMIN_EMAIL, 'password': PASSWORD}).encode()).read()
+
+        def payslip(employee_id):
+            with opener.open(f'{base_url}/generate_payslip/{employee_id}/{PERIOD}') as response:
+                return response.read()
+
+        # Enough concurrent requests that every worker renders some
+        with ThreadPoolExecutor(max_workers=workers * 2) as pool:
+            list(pool.map(payslip, employee_ids))
+        time.sleep(0.5)
+
+        pids = [server.pid] + _children(server.pid)
+        memory = [_memory_kb(pid) for pid in pids]
+        return {
+            'preload': preload,
+            'workers': len(pids) - 1,
+            'boot_ms': round(boot_ms, 1),
+            'rss_total_mb': round(sum(rss for rss, _ in memory) / 1024, 1),
+            'pss_total_mb': round(sum(pss for _, pss in memory) / 1024, 1),
+            'pss_master_mb': round(memory[0][1] / 1024, 1),
+        }
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--runs', type=int, default=5, help='fresh processes per startup timing')
+    parser.add_argument('--employees', type=int, default=200)
+    parser.add_argument('--output', help='write results here instead of stdout')
+    args = parser.parse_args()
+
+    sys.path.insert(0, BENCH_DIR)
+    from workforce import generate_workforce
+
+    with tempfile.TemporaryDirectory() as tmp:
+        database_uri = f"sqlite:///{os.path.join(tmp, 'startup.db')}"
+        generate_workforce(database_uri, args.employees)
+        employee_ids = [f'EMP{n:07d}' for n in range(min(args.employees, args.workers * 20))]
+        report = {
+            'startup': measure_startup(database_uri, args.runs),
+            'gunicorn': [measure_gunicorn(database_uri, args.workers, preload, employee_ids)
+                         for preload in (False, True)],
+        }
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
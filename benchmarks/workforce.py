@@ -0,0 +1,88 @@
+"""Seeded generator for a synthetic workforce in a local SQLite database."""
+import os
+import random
+import sys
+from datetime import datetime
+
+from sqlalchemy import create_engine, insert
+from werkzeug.security import generate_password_hash
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import User, Employee, Payroll  # noqa: E402
+from migrations import upgrade_schema  # noqa: E402
+from payroll_calculator import calculate_payroll_batch  # noqa: E402
+from payroll_run import payroll_values  # noqa: E402
+from ytd import rebuild_ytd  # noqa: E402
+
+ADMIN_EMAIL = 'admin@bench.local'
+PASSWORD = 'benchmark'
+PERIODS = ('2025-02', '2025-03', '2025-04')
+
+FIRST_NAMES = ['Wanjiku', 'Otieno', 'Achieng', 'Kamau', 'Njeri', 'Kiprop', 'Mutua', 'Akinyi',
+               'Mwangi', 'Chebet', 'Omondi', 'Wairimu', 'Kipchoge', 'Nafula', 'Barasa', 'Atieno']
+LAST_NAMES = ['Mwangi', 'Odhiambo', 'Kariuki', 'Wekesa', 'Njoroge', 'Kilonzo', 'Cheruiyot', 'Owino',
+              'Kimani', 'Mutiso', 'Rotich', 'Onyango', 'Gitau', 'Nyaga', 'Langat', 'Ouma']
+BENEFIT_AMOUNTS = [0, 0, 2000, 3500, 5000, 8000, 12000, 20000]
+
+CHUNK_SIZE = 5000
+
+
+def _salary(rng):
+    # Right-skewed like a real payroll: most staff between 20k and 150k, a few executives
+    return round(min(max(rng.lognormvariate(11, 0.6), 15000), 1500000), -2)
+
+
+def generate_workforce(database_uri, employees, seed=42, users=10, periods=PERIODS):
+    """Create the schema and fill it with users, employees and payroll for each period.
+
+    The same seed and size always produce the same data. The first user is
+    an admin; employees are spread evenly across all users.
+    """
+    rng = random.Random(seed)
+    engine = create_engine(database_uri)
+    upgrade_schema(engine)
+
+    password_hash = generate_password_hash(PASSWORD)
+    with engine.begin() as conn:
+        conn.execute(insert(User), [
+            {
+                'id': i + 1,
+                'email': ADMIN_EMAIL if i == 0 else f'owner{i}@bench.local',
+                'full_name': 'Benchmark Admin' if i == 0 else f'Owner {i}',
+                'password_hash': password_hash,
+                'is_admin': i == 0,
+            }
+            for i in range(users)
+        ])
+
+        now = datetime.utcnow()
+        for start in range(0, employees, CHUNK_SIZE):
+            stop = min(start + CHUNK_SIZE, employees)
+            rows = []
+            for n in range(start, stop):
+                rows.append({
+                    'id': f'EMP{n:07d}',
+                    'kra_pin': f'A{n:09d}{chr(65 + n % 26)}',
+                    'first_name': rng.choice(FIRST_NAMES),
+                    'middle_name': rng.choice(FIRST_NAMES) if rng.random() < 0.4 else '',
+                    'last_name': rng.choice(LAST_NAMES),
+                    'basic_salary': _salary(rng),
+                    'user_id': n % users + 1,
+                    'created_at': now,
+                })
+            benefits = [rng.choice(BENEFIT_AMOUNTS) + rng.choice(BENEFIT_AMOUNTS) for _ in rows]
+            conn.execute(insert(Employee), rows)
+
+            basics = [row['basic_salary'] for row in rows]
+            for period in periods:
+                results = calculate_payroll_batch(basics, benefits, period)
+                payroll_rows = []
+                for i, row in enumerate(rows):
+                    values = payroll_values(results, i, basics[i], benefits[i])
+                    values.update(employee_id=row['id'], period=period, calculated_at=now)
+                    payroll_rows.append(values)
+                conn.execute(insert(Payroll), payroll_rows)
+        rebuild_ytd(conn)
+
+    engine.dispose()
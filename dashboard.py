@@ -0,0 +1,83 @@
+from sqlalchemy import and_, func
+
+from archive import payroll_model
+from database import read_session
+from models import Employee
+
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def _page_query(columns, period, user_id=None, after=None):
+    """Employees ordered by id, each outer-joined to its payroll for the period only.
+
+    columns is a function of the payroll model, which is the archive for an archived period.
+    """
+    session = read_session()
+    model = payroll_model(period, session)
+    query = (
+        session.query(*columns(model))
+        .select_from(Employee)
+        .outerjoin(model, and_(model.employee_id == Employee.id, model.period == period))
+        .order_by(Employee.id)
+    )
+    if user_id is not None:
+        query = query.filter(Employee.user_id == user_id)
+    if after:
+        query = query.filter(Employee.id > after)
+    return query
+
+
+def _split_page(rows, limit, key):
+    """Trim the look-ahead row and return (rows, cursor for the next page or None)."""
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return rows, key(rows[-1])
+    return rows, None
+
+
+def dashboard_page(period, user_id=None, after=None, limit=PAGE_SIZE):
+    """One keyset page of (Employee, Payroll or None) pairs after the given employee id."""
+    rows = _page_query(lambda model: (Employee, model), period, user_id, after).limit(limit + 1).all()
+    return _split_page(rows, limit, lambda row: row[0].id)
+
+
+def _row_columns(model):
+    return (Employee.id, Employee.kra_pin, Employee.first_name, Employee.middle_name,
+            Employee.last_name, Employee.basic_salary, model.gross_salary, model.net_pay)
+
+
+def _as_dicts(rows):
+    return [
+        {
+            'id': employee_id,
+            'name': ' '.join(name for name in (first_name, middle_name, last_name) if name and name.strip()),
+            'kra_pin': kra_pin,
+            'basic_salary': basic_salary,
+            'gross_salary': gross_salary,
+            'net_pay': net_pay,
+            'calculated': gross_salary is not None,
+        }
+        for employee_id, kra_pin, first_name, middle_name, last_name, basic_salary, gross_salary, net_pay in rows
+    ]
+
+
+def dashboard_rows(period, user_id=None, after=None, limit=PAGE_SIZE):
+    """Same page as dashboard_page, as plain dicts for the JSON table."""
+    rows = _page_query(_row_columns, period, user_id, after).limit(limit + 1).all()
+    rows, next_after = _split_page(rows, limit, lambda row: row[0])
+    return _as_dicts(rows), next_after
+
+
+def employee_rows(period, employee_ids):
+    """The given employees as dashboard_rows() dicts, in the order of employee_ids."""
+    rows = _as_dicts(_page_query(_row_columns, period).filter(Employee.id.in_(employee_ids)))
+    by_id = {row['id']: row for row in rows}
+    return [by_id[employee_id] for employee_id in employee_ids if employee_id in by_id]
+
+
+def employee_count(user_id=None):
+    query = read_session().query(func.count(Employee.id))
+    if user_id is not None:
+        query = query.filter(Employee.user_id == user_id)
+    return query.scalar()
@@ -0,0 +1,92 @@
+"""Engine settings for each database backend, and the read-only session.
+
+SQLite runs in WAL mode so that readers and the writer do not block each
+other across gunicorn workers. A writer that does find the database locked
+waits up to DB_BUSY_TIMEOUT_MS instead of failing at once. Postgres gets a
+sized, pre-pinged connection pool.
+
+Reports, payslips and dashboard pages read through read_session(). It uses
+a separate 'read' engine: READ_DATABASE_URI when set (a replica, which may
+lag the primary slightly), otherwise a second pool on the primary database.
+Its connections refuse writes, so a heavy export only ever holds a read
+transaction and never competes with payroll writes for the write lock.
+"""
+import os
+
+from flask.globals import app_ctx
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from models import db
+
+READ_BIND = 'read'
+
+_read_sessions = scoped_session(sessionmaker(autoflush=False), scopefunc=lambda: id(app_ctx._get_current_object()))
+
+
+def _backend(uri):
+    return make_url(uri).get_backend_name()
+
+
+def engine_options(uri, read_only=False):
+    """create_engine() arguments for a database URI."""
+    backend = _backend(uri)
+    options = {}
+    if backend == 'postgresql':
+        options.update(
+            pool_size=int(os.getenv('DB_POOL_SIZE', 5)),
+            max_overflow=int(os.getenv('DB_MAX_OVERFLOW', 10)),
+            pool_timeout=int(os.getenv('DB_POOL_TIMEOUT', 30)),
+            pool_recycle=int(os.getenv('DB_POOL_RECYCLE', 1800)),
+            # Replaces connections the server or a proxy closed while they sat in the pool
+            pool_pre_ping=True,
+        )
+        if read_only:
+            options['connect_args'] = {'options': '-c default_transaction_read_only=on'}
+    return options
+
+
+def _sqlite_pragmas(read_only):
+    pragmas = [
+        f"PRAGMA busy_timeout = {int(os.getenv('DB_BUSY_TIMEOUT_MS', 5000))}",
+        # NORMAL is durable across application crashes in WAL mode; only a power loss can drop the last commits
+        f"PRAGMA synchronous = {os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')}",
+    ]
+    if os.getenv('SQLITE_WAL', '1') == '1':
+        pragmas.insert(0, "PRAGMA journal_mode = WAL")
+    if read_only:
+        pragmas.append("PRAGMA query_only = ON")
+    return pragmas
+
+
+def configure_app(app):
+    """Set engine options for the primary database and add the read bind. Call before db.init_app()."""
+    uri = app.config['SQLALCHEMY_DATABASE_URI']
+    read_uri = os.getenv('READ_DATABASE_URI') or uri
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(uri)
+    app.config.setdefault('SQLALCHEMY_BINDS', {})[READ_BIND] = {
+        'url': read_uri, **engine_options(read_uri, read_only=True)
+    }
+
+
+def init_engines(app):
+    """Attach per-connection settings to both engines. Call inside an app context after db.init_app()."""
+    for engine, read_only in ((db.engine, False), (db.engines[READ_BIND], True)):
+        if engine.dialect.name == 'sqlite':
+            pragmas = _sqlite_pragmas(read_only)
+
+            @event.listens_for(engine, 'connect')
+            def _set_pragmas(dbapi_connection, connection_record, pragmas=pragmas):
+                cursor = dbapi_connection.cursor()
+                for pragma in pragmas:
+                    cursor.execute(pragma)
+                cursor.close()
+
+    _read_sessions.configure(bind=db.engines[READ_BIND])
+    app.teardown_appcontext(lambda exc: _read_sessions.remove())
+
+
+def read_session():
+    """The read-only session of the current app context."""
+    return _read_sessions()
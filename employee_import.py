@@ -0,0 +1,176 @@
+import csv
+import re
+
+from sqlalchemy import insert
+
+from archive import ensure_open, lock_open
+from models import db, Employee, Payroll
+from payroll_calculator import calculate_payroll_batch
+from payroll_run import payroll_values
+from ytd import add_ytd_change, apply_ytd_deltas
+
+KRA_PIN_PATTERN = re.compile(r'^A\d{9}[A-Z]$')
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+REQUIRED_COLUMNS = ('employee_id', 'kra_pin', 'first_name', 'last_name', 'basic_salary')
+EMPLOYEE_COLUMNS = REQUIRED_COLUMNS + ('middle_name', 'email')
+
+# Rows validated and inserted per round trip
+CHUNK_SIZE = 1000
+
+
+def _parse_row(row, benefit_columns):
+    """Validate one CSV row. Returns (employee dict, benefits total) or raises ValueError."""
+    values = {column: (row.get(column) or '').strip() for column in EMPLOYEE_COLUMNS}
+
+    missing = [column for column in REQUIRED_COLUMNS if not values[column]]
+    if missing:
+        raise ValueError(f"Missing required fields: {', '.join(missing)}")
+
+    if len(values['employee_id']) > 20:
+        raise ValueError('Employee ID must be at most 20 characters')
+
+    kra_pin = values['kra_pin'].upper()
+    if not KRA_PIN_PATTERN.match(kra_pin):
+        raise ValueError('Invalid KRA PIN format. Use: AXXXXXXXXXX')
+
+    email = values['email'].lower()
+    if email and (len(email) > 255 or not EMAIL_PATTERN.match(email)):
+        raise ValueError('Invalid email address')
+
+    try:
+        basic_salary = float(values['basic_salary'])
+    except ValueError:
+        raise ValueError('Invalid salary amount')
+    if basic_salary < 0:
+        raise ValueError('Salary cannot be negative')
+
+    # Every extra column is a benefit; blank cells mean no benefit
+    benefits_total = 0.0
+    for column in benefit_columns:
+        cell = (row.get(column) or '').strip()
+        if not cell:
+            continue
+        try:
+            amount = float(cell)
+        except ValueError:
+            raise ValueError(f'Invalid amount for benefit {column!r}')
+        if amount > 0:
+            benefits_total += amount
+
+    employee = {
+        'id': values['employee_id'],
+        'kra_pin': kra_pin,
+        'first_name': values['first_name'][:50],
+        'middle_name': values['middle_name'][:50],
+        'last_name': values['last_name'][:50],
+        'email': email or None,
+        'basic_salary': basic_salary,
+    }
+    return employee, benefits_total
+
+
+def _insert_chunk(chunk, period, user_id, report):
+    """Check a chunk against the database in one lookup per key and bulk insert the rest."""
+    if not chunk:
+        return
+
+    ids = [employee['id'] for _, employee, _ in chunk]
+    pins = [employee['kra_pin'] for _, employee, _ in chunk]
+    existing_ids = {row[0] for row in db.session.query(Employee.id).filter(Employee.id.in_(ids))}
+    existing_pins = {row[0] for row in db.session.query(Employee.kra_pin).filter(Employee.kra_pin.in_(pins))}
+
+    accepted = []
+    for row_number, employee, benefits_total in chunk:
+        if employee['id'] in existing_ids:
+            report['errors'].append({'row': row_number, 'employee_id': employee['id'],
+                                     'error': 'Employee ID already exists'})
+        elif employee['kra_pin'] in existing_pins:
+            report['errors'].append({'row': row_number, 'employee_id': employee['id'],
+                                     'error': 'KRA PIN already registered'})
+        else:
+            employee['user_id'] = user_id
+            accepted.append((employee, benefits_total))
+    if not accepted:
+        return
+
+    results = calculate_payroll_batch(
+        [employee['basic_salary'] for employee, _ in accepted],
+        [benefits_total for _, benefits_total in accepted],
+        period,
+    )
+    payroll_rows, ytd_deltas = [], {}
+    for i, (employee, benefits_total) in enumerate(accepted):
+        row = payroll_values(results, i, employee['basic_salary'], benefits_total)
+        row['employee_id'] = employee['id']
+        row['period'] = period
+        payroll_rows.append(row)
+        add_ytd_change(ytd_deltas, employee['id'], period, new=row)
+
+    db.session.execute(insert(Employee), [employee for employee, _ in accepted])
+    db.session.execute(insert(Payroll), payroll_rows)
+    apply_ytd_deltas(ytd_deltas)
+    report['imported'] += len(accepted)
+
+
+def import_employees(stream, period, user_id, chunk_size=CHUNK_SIZE):
+    """Import employees and their payroll for a period from a CSV text stream.
+
+    The CSV needs the columns in REQUIRED_COLUMNS, optionally middle_name and email, and
+    any further columns are read as benefit amounts. Rows are read one at a
+    time and inserted in chunks inside a single transaction. Returns a report
+    with the number imported and a list of per-row errors.
+    """
+    reader = csv.DictReader(stream)
+    report = {'imported': 0, 'errors': []}
+    try:
+        ensure_open(period)
+    except ValueError as e:
+        report['errors'].append({'row': None, 'employee_id': None, 'error': str(e)})
+        return report
+
+    fieldnames = [name.strip() for name in (reader.fieldnames or [])]
+    missing = [column for column in REQUIRED_COLUMNS if column not in fieldnames]
+    if missing:
+        report['errors'].append({'row': 1, 'employee_id': None,
+                                 'error': f"Missing columns: {', '.join(missing)}"})
+        return report
+    reader.fieldnames = fieldnames
+    benefit_columns = [name for name in fieldnames if name and name not in EMPLOYEE_COLUMNS]
+
+    seen_ids, seen_pins = set(), set()
+    chunk = []
+    try:
+        # Row 1 is the header
+        for row_number, row in enumerate(reader, start=2):
+            try:
+                employee, benefits_total = _parse_row(row, benefit_columns)
+            except ValueError as e:
+                report['errors'].append({'row': row_number, 'employee_id': (row.get('employee_id') or '').strip() or None,
+                                         'error': str(e)})
+                continue
+
+            if employee['id'] in seen_ids:
+                report['errors'].append({'row': row_number, 'employee_id': employee['id'],
+                                         'error': 'Duplicate employee ID in file'})
+                continue
+            if employee['kra_pin'] in seen_pins:
+                report['errors'].append({'row': row_number, 'employee_id': employee['id'],
+                                         'error': 'Duplicate KRA PIN in file'})
+                continue
+            seen_ids.add(employee['id'])
+            seen_pins.add(employee['kra_pin'])
+
+            chunk.append((row_number, employee, benefits_total))
+            if len(chunk) >= chunk_size:
+                _insert_chunk(chunk, period, user_id, report)
+                chunk = []
+
+        _insert_chunk(chunk, period, user_id, report)
+        lock_open(period)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return report
@@ -0,0 +1,253 @@
+"""Employee search for the dashboard's type-ahead box.
+
+Each employee's id, KRA PIN and names are indexed as one lower-cased text,
+padded with spaces so that word starts and ends form their own trigrams.
+On SQLite the text lives in the employee_search FTS5 table (trigram
+tokenizer), which triggers on employees keep in step with every insert,
+update and delete, including bulk imports and the clear job. Its entries
+are tied to employee ids through employee_search_ids, whose integer key is
+the FTS rowid. The employees table's own rowids can change in a VACUUM, so
+they are never used. On Postgres a pg_trgm GIN index over the same
+expression serves the lookups.
+
+The index finds up to CANDIDATES employees, which are then ranked here.
+A query word matches a word of the employee's text that it starts, or that
+is within a typo or two of it (see _max_edits). Typo candidates are looked
+up by the trigrams of the word and of its spellings with two neighbouring
+letters swapped. A swap breaks every trigram it touches, so 'jhon' shares
+none with 'john' until it is swapped back.
+"""
+from sqlalchemy import and_, func, literal_column, or_, text
+
+from dashboard import employee_rows
+from database import read_session
+from models import Employee
+
+
+def _search_text_sql(prefix=''):
+    return (f"lower(' ' || {prefix}id || ' ' || {prefix}kra_pin || ' ' || {prefix}first_name || ' ' || "
+            f"coalesce({prefix}middle_name, '') || ' ' || {prefix}last_name || ' ')")
+
+
+# The indexed text; the same expression on both backends, so Postgres can use its expression index
+SEARCH_TEXT_SQL = _search_text_sql()
+MIN_QUERY_LENGTH = 2
+MAX_RESULTS = 20
+# Candidates fetched from the index before ranking
+CANDIDATES = 200
+# Postgres word similarity a typo candidate needs; pg_trgm's default of 0.6 misses most one-letter typos
+FUZZY_SIMILARITY = 0.3
+
+
+def create_search_index(conn):
+    """Create the search index and fill it from the employees table. Safe to run again."""
+    if conn.dialect.name == 'postgresql':
+        conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_employees_search ON employees "
+            f"USING gin (({SEARCH_TEXT_SQL}) gin_trgm_ops)"
+        ))
+        return
+    new_text = _search_text_sql('new.')
+    conn.execute(text(
+        "CREATE VIRTUAL TABLE IF NOT EXISTS employee_search USING fts5(search_text, tokenize = 'trigram')"
+    ))
+    # An INTEGER PRIMARY KEY keeps its values through a VACUUM, unlike the rowids of employees
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS employee_search_ids ("
+        "id INTEGER PRIMARY KEY, employee_id VARCHAR(20) NOT NULL UNIQUE)"
+    ))
+    # A delete or update finds its entry through the employee id, without a scan
+    entry = "(SELECT id FROM employee_search_ids WHERE employee_id = {}.id)"
+    conn.execute(text(
+        f"CREATE TRIGGER IF NOT EXISTS employees_search_insert AFTER INSERT ON employees BEGIN "
+        f"INSERT INTO employee_search_ids (employee_id) VALUES (new.id); "
+        f"INSERT INTO employee_search (rowid, search_text) VALUES (last_insert_rowid(), {new_text}); END"
+    ))
+    conn.execute(text(
+        f"CREATE TRIGGER IF NOT EXISTS employees_search_delete AFTER DELETE ON employees BEGIN "
+        f"DELETE FROM employee_search WHERE rowid = {entry.format('old')}; "
+        f"DELETE FROM employee_search_ids WHERE employee_id = old.id; END"
+    ))
+    conn.execute(text(
+        f"CREATE TRIGGER IF NOT EXISTS employees_search_update "
+        f"AFTER UPDATE OF id, kra_pin, first_name, middle_name, last_name ON employees BEGIN "
+        f"UPDATE employee_search_ids SET employee_id = new.id WHERE employee_id = old.id; "
+        f"UPDATE employee_search SET search_text = {new_text} WHERE rowid = {entry.format('new')}; END"
+    ))
+    rebuild_search_index(conn)
+
+
+def recreate_search_index(conn):
+    """Drop the SQLite index and its triggers, then create them again as create_search_index() does."""
+    if conn.dialect.name == 'sqlite':
+        for trigger in ('employees_search_insert', 'employees_search_delete', 'employees_search_update'):
+            conn.execute(text(f"DROP TRIGGER IF EXISTS {trigger}"))
+        conn.execute(text("DROP TABLE IF EXISTS employee_search"))
+        conn.execute(text("DROP TABLE IF EXISTS employee_search_ids"))
+    create_search_index(conn)
+
+
+def rebuild_search_index(conn):
+    """Refill the SQLite index from the employees table. Returns the rows indexed."""
+    if conn.dialect.name == 'postgresql':
+        return 0
+    conn.execute(text("DELETE FROM employee_search"))
+    conn.execute(text("DELETE FROM employee_search_ids"))
+    conn.execute(text("INSERT INTO employee_search_ids (employee_id) SELECT id FROM employees"))
+    return conn.execute(text(
+        f"INSERT INTO employee_search (rowid, search_text) "
+        f"SELECT employee_search_ids.id, {_search_text_sql('employees.')} FROM employees "
+        f"JOIN employee_search_ids ON employee_search_ids.employee_id = employees.id"
+    )).rowcount
+
+
+def _words(query):
+    return [word for word in query.lower().split() if word]
+
+
+def _trigrams(word):
+    padded = f' {word} '
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _variants(term):
+    """The query word and, if it may have typos, each spelling of it with two neighbouring letters swapped."""
+    if not _max_edits(term):
+        return [term]
+    swapped = (term[:i] + term[i + 1] + term[i] + term[i + 2:] for i in range(len(term) - 1))
+    return list(dict.fromkeys([term, *swapped]))
+
+
+def _max_edits(term):
+    """Typos allowed in a query word: none in ids, PINs or words below 4 letters, one up to 7, then two."""
+    if len(term) < 4 or not term.isalpha():
+        return 0
+    return 1 if len(term) < 8 else 2
+
+
+def _edit_distance(a, b, limit):
+    """Levenshtein distance counting a swap of neighbours as one edit, or limit + 1 once it exceeds limit."""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    before, previous = None, list(range(len(b) + 1))
+    for i, char in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            cost = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char != other))
+            if i > 1 and j > 1 and char == b[j - 2] and a[i - 2] == other:
+                cost = min(cost, before[j - 2] + 1)
+            current.append(cost)
+        if min(current) > limit:
+            return limit + 1
+        before, previous = previous, current
+    return previous[-1]
+
+
+def _word_score(term, words):
+    """How well a query word matches the best word of an employee's text: 2 whole, 1 start, 0.5 typo, else 0."""
+    best = 0
+    limit = _max_edits(term)
+    for word in words:
+        if word == term:
+            return 2
+        if word.startswith(term):
+            best = 1
+        elif best < 0.5 and limit and (_edit_distance(term, word, limit) <= limit
+                                       or _edit_distance(term, word[:len(term)], limit) <= limit):
+            best = 0.5
+    return best
+
+
+def _score(terms, search_text):
+    """Sum of the word scores, or 0 unless every query word matches."""
+    words = search_text.split()
+    total = 0
+    for term in terms:
+        score = _word_score(term, words)
+        if not score:
+            return 0
+        total += score
+    return total
+
+
+def _escape_like(term):
+    return term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def _fts_string(value):
+    # FTS5 string literal: double quotes inside are doubled
+    return '"' + value.replace('"', '""') + '"'
+
+
+def _candidates(session, terms, user_id, fuzzy):
+    """(employee id, indexed text) of possible matches.
+
+    Without fuzzy, only employees with a word starting with each query word,
+    which the index finds exactly. With fuzzy, each query word, or one of
+    its _variants(), may instead share just a trigram with the employee's
+    text; those come most similar first.
+    """
+    if session.get_bind().dialect.name == 'postgresql':
+        search_text = literal_column(SEARCH_TEXT_SQL)
+        query = session.query(Employee.id, search_text)
+        if fuzzy:
+            session.execute(text("SELECT set_config('pg_trgm.word_similarity_threshold', :threshold, true)"),
+                            {'threshold': str(FUZZY_SIMILARITY)})
+            similarity = [func.greatest(*[func.word_similarity(variant, search_text) for variant in _variants(term)])
+                          for term in terms]
+            query = (query.filter(and_(*[or_(*[search_text.op('%>')(variant) for variant in _variants(term)])
+                                         for term in terms]))
+                     .order_by(sum(similarity[1:], similarity[0]).desc()))
+        else:
+            query = query.filter(and_(*[search_text.like(f'% {_escape_like(term)}%', escape='\\')
+                                        for term in terms]))
+        if user_id is not None:
+            query = query.filter(Employee.user_id == user_id)
+        return query.limit(CANDIDATES).all()
+
+    if fuzzy:
+        match = ' AND '.join(
+            '(' + ' OR '.join(_fts_string(trigram) for trigram in
+                              [f' {term}', *sorted(set().union(*map(_trigrams, _variants(term))))]) + ')'
+            for term in terms
+        )
+    else:
+        # A phrase matches as a substring, so a leading space anchors it to the start of a word
+        match = ' AND '.join(_fts_string(f' {term}') for term in terms)
+    sql = ("SELECT employees.id, employee_search.search_text FROM employee_search "
+           "JOIN employee_search_ids ON employee_search_ids.id = employee_search.rowid "
+           "JOIN employees ON employees.id = employee_search_ids.employee_id "
+           "WHERE employee_search MATCH :match")
+    if user_id is not None:
+        sql += " AND employees.user_id = :user_id"
+    if fuzzy:
+        sql += " ORDER BY employee_search.rank"
+    sql += " LIMIT :limit"
+    return session.execute(text(sql), {'match': match, 'user_id': user_id, 'limit': CANDIDATES}).all()
+
+
+def search_employees(query, period, user_id=None, limit=MAX_RESULTS):
+    """Employees matching a type-ahead query, best first, as dicts like dashboard_rows().
+
+    Every query word must start a word of the employee's id, KRA PIN or
+    names. Only when that finds fewer than limit employees are near misses
+    (small typos) looked up as well. Queries shorter than MIN_QUERY_LENGTH
+    return nothing.
+    """
+    terms = _words(query)
+    if len(''.join(terms)) < MIN_QUERY_LENGTH:
+        return []
+    session = read_session()
+    scores = {}
+    for fuzzy in (False, True):
+        if fuzzy and (len(scores) >= limit or not any(_max_edits(term) for term in terms)):
+            break
+        for employee_id, search_text in _candidates(session, terms, user_id, fuzzy):
+            score = _score(terms, search_text)
+            if score:
+                scores[employee_id] = score
+    ids = sorted(scores, key=lambda employee_id: (-scores[employee_id], employee_id))[:limit]
+    if not ids:
+        return []
+    return employee_rows(period, ids)
@@ -2,20 +2,187 @@ from reportlab.lib.pagesizes import A4
 from reportlab.lib import colors
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import mm
+from reportlab.lib.rl_accel import fp_str
 from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+from reportlab.pdfgen import canvas
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
 from io import BytesIO
 from datetime import datetime
 import logging
+import os
 
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger(__name__)
 
-def generate_payslip_pdf(employee, payroll):
-    """Generate PDF payslip."""
+# Bump whenever the payslip layout changes so cached PDFs are re-rendered
+TEMPLATE_VERSION = '2'
+
+RENDERERS = ('canvas', 'platypus')
+# Both renderers draw the same payslip; canvas skips flowable layout and is several times faster
+DEFAULT_RENDERER = os.getenv('PAYSLIP_RENDERER', 'canvas')
+
+# Canvas layout, worked out once from what the platypus layout produces.
+# y values are baselines in points from the bottom of an A4 page.
+_PAGE_TOP = A4[1] - 15 * mm
+_LEFT = 20 * mm + 6  # page margin plus the platypus frame padding
+_TABLE_WIDTH = 200
+_ROW_HEIGHT = 18
+_LABEL_X = _LEFT + 6
+_VALUE_X = _LEFT + int(_TABLE_WIDTH * 0.45) + 6
+_AMOUNT_RIGHT = _LEFT + _TABLE_WIDTH - 6
+_EARNINGS_AMOUNT_RIGHT = _LEFT + _TABLE_WIDTH - 4
+
+
+def _table_rows(offset, count, baseline=5.5):
+    """(row bottom, text baseline) for each row, top row first, of a table ending offset points below the top margin."""
+    bottom = _PAGE_TOP - offset
+    return tuple((bottom + _ROW_HEIGHT * i, bottom + _ROW_HEIGHT * i + baseline)
+                 for i in reversed(range(count)))
+
+
+_TITLE_Y = _PAGE_TOP - 22
+_EMPLOYEE_ROWS = _table_rows(128, 5)
+_SECTION_Y = _PAGE_TOP - 154
+_EARNINGS_ROWS = _table_rows(268, 6)
+_DEDUCTION_ROWS = _table_rows(364, 5)
+_NET_ROW = _table_rows(388, 1, baseline=4.5)[0]
+_FOOTER_Y = _PAGE_TOP - 402
+# With a Year to Date section, which pushes the footer down
+_YTD_SECTION_Y = _PAGE_TOP - 414
+_YTD_TABLE_ROWS = _table_rows(528, 6)
+_YTD_FOOTER_Y = _PAGE_TOP - 542
+
+_STRIPE = colors.HexColor('#F7F7F8')
+_TOTAL_BACKGROUND = colors.HexColor('#efefef')
+_FOOTER_TEXT = ("This is a computer-generated payslip. No signature required. | "
+                "For queries contact HR Department.")
+
+_EMPLOYEE_LABELS = ('Employee ID:', 'KRA PIN:', 'Name:', 'Period:', 'Generated:')
+_EARNINGS_LABELS = ('Basic Salary', 'Total Benefits', 'Gross Salary', '(Less) NSSF Deduction',
+                    '(Less) Housing Levy Deduction', '(Less) SHIF Deduction')
+_DEDUCTION_LABELS = ('Net Paye ', 'NSSF Deduction', 'Housing Levy Deduction', 'SHIF Deduction')
+# (label, ytd.YTD_COLUMNS key) for the year-to-date section
+_YTD_ROWS = (('Gross Pay', 'gross_salary'), ('PAYE', 'paye'), ('NSSF', 'nssf'), ('SHIF', 'shif'),
+             ('Housing Levy', 'ahl'), ('Net Pay', 'net_pay'))
+
+
+def _static_layer(ytd=False):
+    """PDF operators for everything that is the same on every payslip: shading, rules and labels.
+
+    Font resource names are handed out in order of first use, so this uses
+    the fonts in the same order as _canvas_payslip: Helvetica (the canvas
+    default), then Helvetica-Bold.
+    """
+    c = canvas.Canvas(BytesIO(), pagesize=A4)
+    c.setFont('Helvetica-Bold', 16)
+    ops = ['q']
+    stripes = _EARNINGS_ROWS[1::2] + _DEDUCTION_ROWS[1:-1:2] + (_YTD_TABLE_ROWS[1::2] if ytd else ())
+    for color, rows in ((_STRIPE, stripes),
+                        (_TOTAL_BACKGROUND, (_DEDUCTION_ROWS[-1], _NET_ROW))):
+        ops.append(f'{fp_str(*color.rgb())} rg')
+        ops.extend(f'{fp_str(_LEFT, bottom, _TABLE_WIDTH, _ROW_HEIGHT)} re f' for bottom, _ in rows)
+    total_top = _DEDUCTION_ROWS[-1][0] + _ROW_HEIGHT
+    ops.append(f'{fp_str(*colors.grey.rgb())} RG {fp_str(0.4)} w '
+               f'{fp_str(_LEFT, total_top)} m {fp_str(_LEFT + _TABLE_WIDTH, total_top)} l S')
+    ops.append('0 0 0 rg')
+
+    text = c.beginText()
+    text.setFont('Helvetica', 9.5)
+    tables = [(_EMPLOYEE_LABELS, _EMPLOYEE_ROWS), (_EARNINGS_LABELS, _EARNINGS_ROWS),
+              (_DEDUCTION_LABELS, _DEDUCTION_ROWS)]
+    if ytd:
+        tables.append(([label for label, _ in _YTD_ROWS], _YTD_TABLE_ROWS))
+    for labels, rows in tables:
+        for label, (_, y) in zip(labels, rows):
+            text.setTextOrigin(_LABEL_X, y)
+            text.textOut(label)
+    headings = [
+        ('Helvetica-Bold', 10, _LEFT, _SECTION_Y, 'Payment Breakdown'),
+        ('Helvetica-Bold', 9.5, _LABEL_X, _DEDUCTION_ROWS[-1][1], 'Total Deductions'),
+        ('Helvetica-Bold', 10.5, _LEFT, _NET_ROW[1], 'Net Pay'),
+    ]
+    if ytd:
+        headings.append(('Helvetica-Bold', 10, _LEFT, _YTD_SECTION_Y, 'Year to Date'))
+    headings.append(('Helvetica', 8, _LEFT, _YTD_FOOTER_Y if ytd else _FOOTER_Y, _FOOTER_TEXT))
+    for font, size, x, y, label in headings:
+        text.setFont(font, size)
+        text.setTextOrigin(x, y)
+        text.textOut(label)
+    ops.append(text.getCode())
+    ops.append('Q')
+    return '\n'.join(ops)
+
+
+_STATIC_LAYER = _static_layer()
+_STATIC_LAYER_YTD = _static_layer(ytd=True)
+
+
+def generate_payslip_pdf(employee, payroll, renderer=None, ytd=None):
+    """Generate PDF payslip with the given renderer ('canvas' or 'platypus', default PAYSLIP_RENDERER).
+
+    ytd, the year's totals up to this period from ytd.ytd_for_period(), adds a Year to Date section.
+    """
+    renderer = renderer or DEFAULT_RENDERER
+    if renderer == 'canvas':
+        return _canvas_payslip(employee, payroll, ytd)
+    if renderer == 'platypus':
+        return _platypus_payslip(employee, payroll, ytd)
+    raise ValueError(f"Unknown payslip renderer {renderer!r}; expected one of {', '.join(RENDERERS)}")
+
+
+def _canvas_payslip(employee, payroll, ytd=None):
+    """Draw the payslip on a canvas: the prebuilt static layer, then this payslip's values."""
+    try:
+        logger.debug("Drawing payslip for employee %s, period %s", employee.id, payroll.period)
+        buffer = BytesIO()
+        c = canvas.Canvas(buffer, pagesize=A4)
+
+        c.setFont('Helvetica-Bold', 16)
+        c.drawString(_LEFT, _TITLE_Y, f"Payslip {payroll.period}")
+        # Wrapped in q/Q, so the canvas's own font and colour state is unaffected
+        c.addLiteral(_STATIC_LAYER if ytd is None else _STATIC_LAYER_YTD)
+
+        employee_values = (
+            employee.id or 'N/A',
+            employee.kra_pin or 'N/A',
+            employee.full_name() or 'Unknown',
+            payroll.period or 'N/A',
+            datetime.now().strftime('%d/%m/%Y'),
+        )
+        c.setFont('Helvetica', 9.5)
+        for value, (_, y) in zip(employee_values, _EMPLOYEE_ROWS):
+            c.drawString(_VALUE_X, y, str(value))
+
+        earnings = (employee.basic_salary, payroll.gross_salary - employee.basic_salary, payroll.gross_salary,
+                    payroll.nssf, payroll.ahl, payroll.shif)
+        for amount, (_, y) in zip(earnings, _EARNINGS_ROWS):
+            c.drawRightString(_EARNINGS_AMOUNT_RIGHT, y, f"{amount:,.2f}")
+        deductions = (payroll.paye, payroll.nssf, payroll.ahl, payroll.shif)
+        for amount, (_, y) in zip(deductions, _DEDUCTION_ROWS):
+            c.drawRightString(_AMOUNT_RIGHT, y, f"{amount:,.2f}")
+        if ytd is not None:
+            for (_, column), (_, y) in zip(_YTD_ROWS, _YTD_TABLE_ROWS):
+                c.drawRightString(_AMOUNT_RIGHT, y, f"{ytd[column]:,.2f}")
+
+        c.setFont('Helvetica-Bold', 9.5)
+        total_deductions = payroll.nssf + payroll.ahl + payroll.paye + payroll.shif
+        c.drawRightString(_AMOUNT_RIGHT, _DEDUCTION_ROWS[-1][1], f"{total_deductions:,.2f}")
+        c.setFont('Helvetica-Bold', 10.5)
+        c.drawRightString(_AMOUNT_RIGHT, _NET_ROW[1], f"{payroll.net_pay:,.2f}")
+
+        c.showPage()
+        c.save()
+        buffer.seek(0)
+        return buffer
+
+    except Exception as e:
+        logger.error("Failed to generate PDF: %s", e, exc_info=True)
+        raise Exception(f"PDF generation failed: {str(e)}")
+
+
+def _platypus_payslip(employee, payroll, ytd=None):
+    """Lay the payslip out with platypus tables."""
     try:
-        logger.debug(f"Generating payslip for employee {employee.id}, period {payroll.period}")
+        logger.debug("Generating payslip for employee %s, period %s", employee.id, payroll.period)
         
         # Initialize BytesIO buffer
         buffer = BytesIO()
@@ -157,12 +324,22 @@ def generate_payslip_pdf(employee, payroll):
         story.append(net_table)
         story.append(Spacer(1, 6))
 
+        # Year to date
+        if ytd is not None:
+            ytd_data = [[label, f"{ytd[column]:,.2f}"] for label, column in _YTD_ROWS]
+            ytd_table = Table(ytd_data, colWidths=[col1, col2], hAlign='LEFT')
+            ytd_table.setStyle(TableStyle([
+                ('ALIGN', (0, 0), (0, -1), 'LEFT'),
+                ('ALIGN', (1, 0), (1, -1), 'RIGHT'),
+                ('FONTSIZE', (0, 0), (-1, -1), 9.5),
+                ('ROWBACKGROUNDS', (0, 0), (-1, -1), [colors.white, _STRIPE]),
+            ]))
+            story.append(Paragraph("Year to Date", section_style))
+            story.append(ytd_table)
+            story.append(Spacer(1, 6))
+
         # Footer
-        footer = Paragraph(
-            "This is a computer-generated payslip. No signature required. | "
-            "For queries contact HR Department.",
-            footer_style
-        )
+        footer = Paragraph(_FOOTER_TEXT, footer_style)
         story.append(footer)
 
         # Build PDF
@@ -173,5 +350,5 @@ def generate_payslip_pdf(employee, payroll):
         return buffer
 
     except Exception as e:
-        logger.error(f"Failed to generate PDF: {str(e)}", exc_info=True)
+        logger.error("Failed to generate PDF: %s", e, exc_info=True)
         raise Exception(f"PDF generation failed: {str(e)}")
\ No newline at end of file
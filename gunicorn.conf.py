@@ -0,0 +1,35 @@
+"""Gunicorn settings.
+
+The app is loaded once in the master (preload_app) and the workers are
+forked from it, so imported modules, compiled templates and the payslip
+renderer are shared copy-on-write rather than loaded again by every worker.
+Set GUNICORN_PRELOAD=0 to load the app in each worker instead, e.g. to pick
+up code changes with a HUP.
+"""
+import gc
+import os
+
+wsgi_app = 'app:create_app()'
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+workers = int(os.getenv('WEB_CONCURRENCY', (os.cpu_count() or 1) * 2 + 1))
+preload_app = os.getenv('GUNICORN_PRELOAD', '1') == '1'
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    # The app loads ReportLab on the first payslip; load it here so workers inherit it instead
+    import generate_pdf  # noqa: F401
+    # Objects from before the fork are never freed by the workers. Freezing them keeps the
+    # garbage collector from writing to, and so copying, the pages they live on
+    gc.freeze()
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+    from models import db
+    # A pooled connection the master may have opened must not be shared with the workers
+    with worker.app.wsgi().app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
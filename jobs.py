@@ -0,0 +1,493 @@
+"""Background jobs for operations too long for a request.
+
+Jobs are rows in the `jobs` table. Worker threads claim them with a
+compare-and-set UPDATE, so any number of gunicorn workers (or a separate
+`flask run-jobs` process) can share the queue. A running job reports
+progress together with a checkpoint and a heartbeat. When a worker dies, its
+job goes stale and another worker claims it again and resumes from the
+checkpoint. Every handler is written so that repeating work it had already
+done changes nothing.
+"""
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import and_, func, or_, select, update
+from sqlalchemy.exc import IntegrityError
+
+from archive import archive_period, ensure_open
+from models import db, ArchivedPeriod, Employee, Job, Payroll, PayrollArchive, PayslipDelivery
+from dashboard import employee_count
+from payroll_run import PERIOD_PATTERN, run_payroll, shard_key_range
+from payslip_email import delivery_counts, distribute_payslips
+from payslip_export import FETCH_SIZE, iter_payslip_zip, payslip_records
+from reports import iter_p10_csv, payroll_count
+from ytd import delete_ytd
+
+logger = logging.getLogger(__name__)
+
+# A running job whose heartbeat is older than this is presumed dead and claimed again
+STALE_AFTER = int(os.getenv('JOB_STALE_SECONDS', 300))
+# Employees handled per step of a payroll run or clear, each committed on its own
+CHUNK_SIZE = 5000
+# Most shards a payroll run is split into; smaller runs get one shard per CHUNK_SIZE employees
+PAYROLL_SHARDS = int(os.getenv('PAYROLL_SHARDS', os.cpu_count() or 1))
+# How often a payroll run checks on shards running elsewhere
+SHARD_POLL_SECONDS = 1.0
+ACTIVE_STATUSES = ('queued', 'running')
+
+HANDLERS = {}
+
+
+class JobLeaseLost(Exception):
+    """The job was claimed by another worker after this one was presumed dead."""
+
+
+def job_handler(kind):
+    """Register a function as the handler for a job kind."""
+    def register(fn):
+        HANDLERS[kind] = fn
+        return fn
+    return register
+
+
+def enqueue(kind, params, user_id=None, max_attempts=3, parent_id=None):
+    """Queue a job and return it.
+
+    If the same job is already queued or running, that one is returned
+    instead, so a double-clicked button does not run it twice. A unique
+    index on active jobs settles two requests that both found none.
+    """
+    if kind not in HANDLERS:
+        raise ValueError(f'Unknown job kind: {kind}')
+    params = json.dumps(params, sort_keys=True)
+    job = _active_job(kind, params)
+    if job is not None:
+        return job
+    job = Job(kind=kind, params=params, user_id=user_id, max_attempts=max_attempts, parent_id=parent_id)
+    db.session.add(job)
+    try:
+        db.session.commit()
+    except IntegrityError:
+        # Another request queued the same job after the check above
+        db.session.rollback()
+        job = _active_job(kind, params)
+        if job is None:
+            raise
+    return job
+
+
+def _active_job(kind, params):
+    return Job.query.filter(Job.kind == kind, Job.params == params, Job.status.in_(ACTIVE_STATUSES)).first()
+
+
+def job_status(job):
+    """JSON-ready view of a job for the polling endpoint and the dashboard."""
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'params': json.loads(job.params or '{}'),
+        'progress': job.progress,
+        'total': job.total,
+        'result': json.loads(job.result) if job.result else None,
+        'error': job.error,
+        'attempts': job.attempts,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'started_at': job.started_at.isoformat() if job.started_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+
+def recent_jobs(user_id=None, limit=10):
+    """Latest jobs, only user_id's when given. Jobs split off another job, such as payroll shards, are left out."""
+    query = Job.query.filter(Job.parent_id.is_(None)).order_by(Job.id.desc())
+    if user_id is not None:
+        query = query.filter(Job.user_id == user_id)
+    return query.limit(limit).all()
+
+
+def output_path(filename):
+    """Where job output files such as exports are written."""
+    directory = current_app.config['JOB_OUTPUT_DIR']
+    os.makedirs(directory, exist_ok=True)
+    return os.path.join(directory, filename)
+
+
+def _claimable(now):
+    jobs = Job.__table__
+    stale = now - timedelta(seconds=STALE_AFTER)
+    return or_(jobs.c.status == 'queued',
+               and_(jobs.c.status == 'running', jobs.c.heartbeat_at < stale))
+
+
+def claim_job(worker_id, job_ids=None):
+    """Atomically claim the oldest runnable job, only among job_ids when given. Returns its id, or None if there is nothing to do."""
+    jobs = Job.__table__
+    # Another worker can win the race for a candidate; try the next one a few times
+    for _ in range(5):
+        now = datetime.utcnow()
+        claimable = _claimable(now)
+        if job_ids is not None:
+            claimable = and_(claimable, jobs.c.id.in_(job_ids))
+        with db.engine.begin() as conn:
+            job_id = conn.execute(
+                select(jobs.c.id).where(claimable).order_by(jobs.c.id).limit(1)
+            ).scalar()
+            if job_id is None:
+                return None
+            claimed = conn.execute(
+                update(jobs)
+                .where(jobs.c.id == job_id, claimable)
+                .values(status='running', locked_by=worker_id, heartbeat_at=now,
+                        started_at=func.coalesce(jobs.c.started_at, now),
+                        attempts=jobs.c.attempts + 1)
+            ).rowcount
+        if claimed:
+            return job_id
+    return None
+
+
+class JobContext:
+    """What a handler gets to report progress and save its resume point.
+
+    A job run inline by another job is given that job's context as parent,
+    whose heartbeat its progress keeps fresh too.
+    """
+
+    def __init__(self, job, worker_id, parent=None):
+        self.job_id = job.id
+        self.worker_id = worker_id
+        self.parent = parent
+        self.user_id = job.user_id
+        self.total = job.total
+        self.checkpoint = json.loads(job.checkpoint) if job.checkpoint else {}
+
+    def _update(self, **values):
+        jobs = Job.__table__
+        with db.engine.begin() as conn:
+            updated = conn.execute(
+                update(jobs)
+                .where(jobs.c.id == self.job_id, jobs.c.locked_by == self.worker_id,
+                       jobs.c.status == 'running')
+                .values(**values)
+            ).rowcount
+        if not updated:
+            raise JobLeaseLost(f'Job {self.job_id} is no longer held by {self.worker_id}')
+
+    def progress(self, done, total=None, checkpoint=None):
+        """Record progress and refresh the heartbeat. checkpoint is saved for a resumed attempt."""
+        values = {'progress': done, 'heartbeat_at': datetime.utcnow()}
+        if total is not None:
+            self.total = values['total'] = total
+        if checkpoint is not None:
+            self.checkpoint = checkpoint
+            values['checkpoint'] = json.dumps(checkpoint)
+        self._update(**values)
+        if self.parent is not None:
+            try:
+                self.parent.heartbeat()
+            except JobLeaseLost:
+                # This job is still ours to finish; the parent finds out when it next reports
+                self.parent = None
+
+    def heartbeat(self):
+        """Refresh the heartbeat alone."""
+        self._update(heartbeat_at=datetime.utcnow())
+
+    def finish(self, result):
+        values = {'status': 'succeeded', 'result': json.dumps(result), 'error': None,
+                  'locked_by': None, 'finished_at': datetime.utcnow()}
+        if self.total is not None:
+            values['progress'] = self.total
+        self._update(**values)
+
+    def fail(self, error, retry):
+        values = {'error': error, 'locked_by': None}
+        if retry:
+            values['status'] = 'queued'
+        else:
+            values.update(status='failed', finished_at=datetime.utcnow())
+        self._update(**values)
+
+
+def run_job(job_id, worker_id, parent=None):
+    """Run a claimed job to completion, or put it back in the queue if it fails and may retry.
+
+    parent is the context of a job running this one inline.
+    """
+    job = db.session.get(Job, job_id)
+    ctx = JobContext(job, worker_id, parent)
+    handler = HANDLERS.get(job.kind)
+    params = json.loads(job.params or '{}')
+    attempts, max_attempts = job.attempts, job.max_attempts
+    # The handler's own queries should not see a stale copy of the job
+    db.session.expunge(job)
+
+    if handler is None:
+        ctx.fail(f'Unknown job kind: {job.kind}', retry=False)
+        return
+    if attempts > max_attempts:
+        ctx.fail(f'Gave up after {max_attempts} attempts: {job.error}', retry=False)
+        return
+
+    try:
+        result = handler(ctx, **params)
+    except JobLeaseLost:
+        db.session.rollback()
+        logger.warning("Job %s was taken over by another worker", job_id)
+        return
+    except Exception as e:
+        db.session.rollback()
+        logger.error("Job %s (%s) failed on attempt %s: %s", job_id, job.kind, attempts, e, exc_info=True)
+        try:
+            ctx.fail(str(e), retry=attempts < max_attempts)
+        except JobLeaseLost:
+            pass
+        return
+    ctx.finish(result)
+
+
+class JobWorker:
+    """Threads that claim and run jobs in the background of an app process."""
+
+    def __init__(self, app, threads=2, poll_interval=1.0):
+        self.app = app
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self._started_pid = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def ensure_started(self):
+        """Start the threads once per process; safe to call on every request."""
+        if not self.threads or self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            self._started_pid = os.getpid()
+            for index in range(self.threads):
+                threading.Thread(target=self._loop, args=(index,), name=f'job-worker-{index}',
+                                 daemon=True).start()
+
+    def run(self):
+        """Run the worker threads in the foreground until interrupted."""
+        self.ensure_started()
+        try:
+            while not self._stop.wait(1.0):
+                pass
+        except KeyboardInterrupt:
+            self._stop.set()
+
+    def _loop(self, index):
+        worker_id = f'{socket.gethostname()}:{os.getpid()}:{index}'
+        while not self._stop.is_set():
+            try:
+                with self.app.app_context():
+                    job_id = claim_job(worker_id)
+                    if job_id is not None:
+                        run_job(job_id, worker_id)
+            except Exception:
+                logger.exception("Job worker %s hit an error", worker_id)
+                job_id = None
+            if job_id is None:
+                self._stop.wait(self.poll_interval)
+
+
+@job_handler('payroll_run')
+def _payroll_run_job(ctx, period, owner=None):
+    """Payroll for a period, split into payroll_shard jobs by employee shard key.
+
+    Every worker thread in every process can claim a shard, so a large run
+    uses all of them. This job works through unclaimed shards itself, with
+    their progress keeping its heartbeat fresh, then waits for the rest and
+    adds up their summaries. A resumed run picks up
+    its existing shards, and puts back any that had failed.
+    """
+    if not PERIOD_PATTERN.match(period or ''):
+        raise ValueError('Period must be in YYYY-MM format')
+    ensure_open(period)
+    shard_ids = ctx.checkpoint.get('shards')
+    if shard_ids is None:
+        total = employee_count(owner)
+        shards = max(1, min(PAYROLL_SHARDS, -(-total // CHUNK_SIZE)))
+        shard_ids = [
+            enqueue('payroll_shard', {'period': period, 'owner': owner, 'shard': shard, 'shards': shards},
+                    ctx.user_id, parent_id=ctx.job_id).id
+            for shard in range(shards)
+        ]
+        ctx.progress(0, total=total, checkpoint={'shards': shard_ids})
+    else:
+        _requeue_failed(shard_ids)
+
+    while True:
+        shard_id = claim_job(ctx.worker_id, shard_ids)
+        if shard_id is not None:
+            run_job(shard_id, ctx.worker_id, parent=ctx)
+        shards = _shard_jobs(shard_ids)
+        # Also keeps this job's heartbeat fresh between shards
+        ctx.progress(sum(shard.progress for shard in shards))
+        if shard_id is not None:
+            continue
+        failed = [shard for shard in shards if shard.status == 'failed']
+        if failed:
+            raise RuntimeError(f'{len(failed)} of {len(shards)} payroll shards failed: {failed[0].error}')
+        if all(shard.status == 'succeeded' for shard in shards):
+            break
+        # The rest are running on other workers; a stale one is claimed again above
+        time.sleep(SHARD_POLL_SECONDS)
+
+    summary = {'period': period, 'employees': 0, 'created': 0, 'updated': 0, 'shards': len(shards)}
+    for shard in shards:
+        result = json.loads(shard.result)
+        for key in ('employees', 'created', 'updated'):
+            summary[key] += result[key]
+    return summary
+
+
+def _shard_jobs(job_ids):
+    jobs = Job.__table__
+    with db.engine.connect() as conn:
+        return conn.execute(
+            select(jobs.c.status, jobs.c.progress, jobs.c.result, jobs.c.error).where(jobs.c.id.in_(job_ids))
+        ).all()
+
+
+def _requeue_failed(job_ids):
+    jobs = Job.__table__
+    with db.engine.begin() as conn:
+        conn.execute(
+            update(jobs).where(jobs.c.id.in_(job_ids), jobs.c.status == 'failed')
+            .values(status='queued', attempts=0, error=None, finished_at=None)
+        )
+
+
+@job_handler('payroll_shard')
+def _payroll_shard_job(ctx, period, shard, shards, owner=None):
+    """One shard of a payroll run in chunks of employees, resuming after the last committed chunk.
+
+    A shard covers a fixed range of shard keys, so no two shards share an
+    employee. Rows are upserted, so repeating a chunk that committed just
+    before a crash only recalculates it.
+    """
+    shard_keys = shard_key_range(shard, shards)
+    summary = ctx.checkpoint.get('summary') or {'period': period, 'employees': 0, 'created': 0, 'updated': 0}
+    after = ctx.checkpoint.get('after')
+    while True:
+        chunk = run_payroll(period, owner, after=after, limit=CHUNK_SIZE, shard_keys=shard_keys)
+        if not chunk['employees']:
+            break
+        for key in ('employees', 'created', 'updated'):
+            summary[key] += chunk[key]
+        after = chunk['last_employee_id']
+        ctx.progress(summary['employees'], checkpoint={'after': after, 'summary': summary})
+    return summary
+
+
+@job_handler('clear_employees')
+def _clear_employees_job(ctx, owner=None):
+    """Delete employees with their payroll, archived payroll, year totals and payslip deliveries in chunks.
+
+    Whatever is left is deleted on a retry.
+    """
+    deleted = ctx.checkpoint.get('deleted', 0)
+    if ctx.total is None:
+        ctx.progress(deleted, total=employee_count(owner))
+    while True:
+        query = db.session.query(Employee.id).order_by(Employee.id).limit(CHUNK_SIZE)
+        if owner is not None:
+            query = query.filter(Employee.user_id == owner)
+        employee_ids = [employee_id for employee_id, in query]
+        if not employee_ids:
+            break
+        try:
+            db.session.query(Payroll).filter(Payroll.employee_id.in_(employee_ids)).delete(synchronize_session=False)
+            db.session.query(PayrollArchive).filter(PayrollArchive.employee_id.in_(employee_ids)).delete(synchronize_session=False)
+            delete_ytd(employee_ids)
+            db.session.query(PayslipDelivery).filter(PayslipDelivery.employee_id.in_(employee_ids)).delete(synchronize_session=False)
+            db.session.query(Employee).filter(Employee.id.in_(employee_ids)).delete(synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        deleted += len(employee_ids)
+        ctx.progress(deleted, checkpoint={'deleted': deleted})
+    return {'deleted': deleted}
+
+
+@job_handler('archive_period')
+def _archive_period_job(ctx, period):
+    """Move a closed period to the archive, resuming from the last copied chunk."""
+    done = ctx.checkpoint.get('done', 0)
+    if ctx.total is None:
+        # Every row is copied once and deleted once
+        ctx.progress(done, total=2 * payroll_count(period))
+    for _, rows, after in archive_period(period, after=ctx.checkpoint.get('after')):
+        done += rows
+        ctx.progress(done, checkpoint={'after': after, 'done': done})
+    return {'period': period, 'rows': db.session.get(ArchivedPeriod, period).rows}
+
+
+def _write_output(filename, chunks, mode='wb'):
+    """Write chunks to a temporary file and move it into place, so a retry never sees half a file."""
+    path = output_path(filename)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, mode) as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp_path, path)
+
+
+@job_handler('p10')
+def _p10_job(ctx, period, owner=None):
+    """Write the P10 CSV to a file for download."""
+    filename = f'job_{ctx.job_id}_P10_Report_{period}.csv'
+    _write_output(filename, iter_p10_csv(period, owner), mode='w')
+    return {'file': filename, 'download_name': f'P10_Report_{period}.csv'}
+
+
+@job_handler('payslips_zip')
+def _payslips_zip_job(ctx, period, owner=None):
+    """Render every payslip for the period into a ZIP file for download.
+
+    Records are read a page at a time, so no cursor stays open while
+    progress is written. The archive is rebuilt from scratch on a retry.
+    """
+    ctx.progress(0, total=payroll_count(period, owner))
+
+    def records():
+        after, done = None, 0
+        while True:
+            page = list(payslip_records(period, owner, after=after, limit=FETCH_SIZE))
+            if not page:
+                return
+            yield from page
+            done += len(page)
+            after = page[-1][0]
+            ctx.progress(done)
+
+    filename = f'job_{ctx.job_id}_payslips_{period}.zip'
+    _write_output(filename, iter_payslip_zip(records()))
+    return {'file': filename, 'download_name': f'payslips_{period}.zip'}
+
+
+@job_handler('payslip_email')
+def _payslip_email_job(ctx, period, owner=None):
+    """Email every payslip for the period, resuming after the last employee handled.
+
+    Employees already sent this period's payslip are skipped, so running the
+    job again only retries failed sends and employees who had no address.
+    """
+    done = ctx.checkpoint.get('done', 0)
+    if ctx.total is None:
+        ctx.progress(done, total=payroll_count(period, owner))
+    for handled, after in distribute_payslips(period, owner, after=ctx.checkpoint.get('after')):
+        done += handled
+        ctx.progress(done, checkpoint={'after': after, 'done': done})
+    return {'period': period, **delivery_counts(period, owner)}
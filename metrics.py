@@ -0,0 +1,175 @@
+"""In-process metrics exposed in the Prometheus text format.
+
+Each gunicorn worker keeps its own counters; scrape every worker or put them
+behind a single port with a shared multiprocess collector if you need totals.
+"""
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+COUNT_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+SIZE_BUCKETS = (1024, 2048, 4096, 8192, 16384, 32768, 65536, 131072, 262144, 1048576)
+ROW_BUCKETS = (10, 100, 1000, 10000, 50000, 100000, 500000)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    pairs.extend(f'{name}="{_escape(value)}"' for name, value in extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labelvalues, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # labelvalues -> [per-bucket counts (last one is +Inf), sum, count]
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labelvalues):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            for labelvalues, (counts, total, count) in sorted(self._series.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                    cumulative += bucket_count
+                    labels = _format_labels(self.labelnames, labelvalues, [('le', _format_value(bound))])
+                    lines.append(f'{self.name}_bucket{labels} {cumulative}')
+                labels = _format_labels(self.labelnames, labelvalues)
+                lines.append(f'{self.name}_sum{labels} {_format_value(total)}')
+                lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+REQUEST_LATENCY = Histogram(
+    'payroll_http_request_duration_seconds', 'Time spent handling a request, including streamed bodies.',
+    ('endpoint', 'method', 'status'))
+REQUEST_SQL_QUERIES = Histogram(
+    'payroll_http_request_sql_queries', 'SQL statements executed per request.',
+    ('endpoint',), COUNT_BUCKETS)
+REQUEST_SQL_SECONDS = Histogram(
+    'payroll_http_request_sql_seconds', 'Time spent in SQL per request.', ('endpoint',))
+SQL_QUERIES = Counter('payroll_sql_queries_total', 'SQL statements executed.')
+SQL_SECONDS = Counter('payroll_sql_seconds_total', 'Time spent executing SQL statements.')
+PDF_RENDER_SECONDS = Histogram(
+    'payroll_pdf_render_seconds', 'Time to render one payslip PDF.', ('source',))
+PDF_SIZE_BYTES = Histogram(
+    'payroll_pdf_size_bytes', 'Size of rendered payslip PDFs.', ('source',), SIZE_BUCKETS)
+P10_ROWS = Histogram('payroll_p10_rows', 'Employee rows written per P10 report.', (), ROW_BUCKETS)
+
+REGISTRY = [
+    REQUEST_LATENCY, REQUEST_SQL_QUERIES, REQUEST_SQL_SECONDS, SQL_QUERIES, SQL_SECONDS,
+    PDF_RENDER_SECONDS, PDF_SIZE_BYTES, P10_ROWS,
+]
+
+
+def render_metrics():
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def observe_pdf_render(seconds, size, source='payslip'):
+    PDF_RENDER_SECONDS.observe(seconds, source)
+    PDF_SIZE_BYTES.observe(size, source)
+
+
+def observe_p10_rows(count):
+    P10_ROWS.observe(count)
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # Kept on the statement's own execution context, so a statement that fails leaves nothing behind
+    context._metrics_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_start
+    SQL_QUERIES.inc()
+    SQL_SECONDS.inc(elapsed)
+    if has_request_context():
+        stats = g.get('request_metrics')
+        if stats is not None:
+            stats['queries'] += 1
+            stats['sql_seconds'] += elapsed
+
+
+def instrument_engine(engine):
+    """Count SQL statements and their time, globally and per request."""
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def init_app(app):
+    """Time every request, including the body of streamed responses."""
+
+    @app.before_request
+    def _start_request_metrics():
+        g.request_metrics = {'start': time.perf_counter(), 'queries': 0, 'sql_seconds': 0.0}
+
+    @app.after_request
+    def _record_request_metrics(response):
+        stats = g.get('request_metrics')
+        if stats is None:
+            return response
+        endpoint = request.endpoint or 'unmatched'
+        method = request.method
+        status = str(response.status_code)
+
+        # Streamed bodies (P10, payslip ZIPs) keep running after this hook,
+        # so the observation waits until the server closes the response
+        def observe():
+            REQUEST_LATENCY.observe(time.perf_counter() - stats['start'], endpoint, method, status)
+            REQUEST_SQL_QUERIES.observe(stats['queries'], endpoint)
+            REQUEST_SQL_SECONDS.observe(stats['sql_seconds'], endpoint)
+
+        response.call_on_close(observe)
+        return response
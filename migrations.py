@@ -0,0 +1,172 @@
+"""Versioned schema migrations for existing databases.
+
+db.create_all() only creates missing tables, so changes to tables that
+already exist live here. upgrade_schema() does both, and is what
+`flask migrate` runs. Each migration runs once, in its own transaction,
+and is recorded in the schema_version table. Migrations must be safe to
+run on a database that create_all() has just built from the current models,
+so they use IF NOT EXISTS and similar guards.
+"""
+import logging
+from datetime import datetime
+
+from sqlalchemy import inspect, text
+from sqlalchemy.exc import IntegrityError
+
+from employee_search import create_search_index, recreate_search_index
+from models import db, employee_shard_key
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for the Postgres advisory lock that serializes migration runs
+ADVISORY_LOCK_KEY = 7315001
+
+
+def _add_lookup_indexes(conn):
+    # Only the newest row of a duplicated (employee_id, period) can stay under the unique index.
+    # The older ones move to payroll_duplicates rather than being dropped, so nothing is lost
+    superseded = ("SELECT id FROM payroll WHERE id NOT IN "
+                  "(SELECT keep_id FROM (SELECT MAX(id) AS keep_id FROM payroll GROUP BY employee_id, period) AS keep)")
+    conn.execute(text("CREATE TABLE IF NOT EXISTS payroll_duplicates AS SELECT * FROM payroll WHERE 1 = 0"))
+    moved = conn.execute(text(f"INSERT INTO payroll_duplicates SELECT * FROM payroll WHERE id IN ({superseded})")).rowcount
+    if moved:
+        logger.warning("Moved %s duplicate payroll rows to payroll_duplicates; the newest row per employee "
+                       "and period was kept", moved)
+        conn.execute(text("DELETE FROM payroll WHERE id IN (SELECT id FROM payroll_duplicates)"))
+    conn.execute(text(
+        "CREATE UNIQUE INDEX IF NOT EXISTS uq_payroll_employee_id_period ON payroll (employee_id, period)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_payroll_period_employee_id ON payroll (period, employee_id)"
+    ))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_employees_user_id_id ON employees (user_id, id)"
+    ))
+
+
+def _add_column(conn, table, column, ddl_type):
+    """ALTER TABLE ADD COLUMN unless create_all() already made the column."""
+    existing = {col['name'] for col in inspect(conn).get_columns(table)}
+    if column not in existing:
+        conn.execute(text(f"ALTER TABLE {table} ADD COLUMN {column} {ddl_type}"))
+
+
+def _add_payroll_inputs(conn):
+    _add_column(conn, 'payroll', 'basic_salary', 'FLOAT')
+    _add_column(conn, 'payroll', 'benefits_total', 'FLOAT')
+    _add_column(conn, 'payroll', 'rate_version', 'VARCHAR(20)')
+    # Existing rows were calculated from the employee's current salary with the 2025-02 rates,
+    # which were hard-coded for every period before rate versions existed. Rows of earlier
+    # periods keep that stamp; they are never recalculated, since no rates cover them
+    conn.execute(text(
+        "UPDATE payroll SET basic_salary = "
+        "(SELECT employees.basic_salary FROM employees WHERE employees.id = payroll.employee_id) "
+        "WHERE basic_salary IS NULL"
+    ))
+    conn.execute(text(
+        "UPDATE payroll SET benefits_total = CASE WHEN gross_salary > basic_salary "
+        "THEN gross_salary - basic_salary ELSE 0 END "
+        "WHERE benefits_total IS NULL AND basic_salary IS NOT NULL"
+    ))
+    conn.execute(text("UPDATE payroll SET rate_version = '2025-02' WHERE rate_version IS NULL"))
+
+
+def _backfill_payroll_ytd(conn):
+    # create_all() has made the table; fill it from the payroll already on record
+    conn.execute(text("DELETE FROM payroll_ytd"))
+    columns = ('basic_salary', 'benefits_total', 'gross_salary', 'nssf', 'shif', 'ahl', 'paye', 'net_pay')
+    conn.execute(text(
+        f"INSERT INTO payroll_ytd (employee_id, year, months, {', '.join(columns)}, updated_at) "
+        f"SELECT employee_id, CAST(SUBSTR(period, 1, 4) AS INTEGER), COUNT(*), "
+        f"{', '.join(f'ROUND(CAST(COALESCE(SUM({column}), 0) AS NUMERIC), 2)' for column in columns)}, CURRENT_TIMESTAMP "
+        f"FROM payroll GROUP BY employee_id, CAST(SUBSTR(period, 1, 4) AS INTEGER)"
+    ))
+
+
+def _add_shard_keys(conn):
+    _add_column(conn, 'employees', 'shard_key', 'INTEGER')
+    _add_column(conn, 'jobs', 'parent_id', 'INTEGER')
+    # crc32 is not available in SQL, so existing employees get their keys from here
+    employee_ids = [row[0] for row in conn.execute(text("SELECT id FROM employees WHERE shard_key IS NULL"))]
+    if employee_ids:
+        conn.execute(text("UPDATE employees SET shard_key = :shard_key WHERE id = :id"),
+                     [{'id': employee_id, 'shard_key': employee_shard_key(employee_id)} for employee_id in employee_ids])
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_employees_shard_key_id ON employees (shard_key, id)"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_jobs_parent_id ON jobs (parent_id)"))
+
+
+def _add_employee_email(conn):
+    _add_column(conn, 'employees', 'email', 'VARCHAR(255)')
+
+
+def _add_active_job_index(conn):
+    # Duplicates queued before the index existed would block it; the oldest of each is kept
+    active = "status IN ('queued', 'running')"
+    failed = conn.execute(text(
+        f"UPDATE jobs SET status = 'failed', error = 'Duplicate of an earlier job', locked_by = NULL, "
+        f"finished_at = CURRENT_TIMESTAMP WHERE {active} AND id NOT IN "
+        f"(SELECT keep_id FROM (SELECT MIN(id) AS keep_id FROM jobs WHERE {active} GROUP BY kind, params) AS keep)"
+    )).rowcount
+    if failed:
+        logger.warning("Marked %s duplicate active jobs as failed; the oldest of each was kept", failed)
+    conn.execute(text(
+        f"CREATE UNIQUE INDEX IF NOT EXISTS uq_jobs_active_kind_params ON jobs (kind, params) WHERE {active}"
+    ))
+
+
+# (version, description, upgrade function taking a connection)
+MIGRATIONS = [
+    (1, 'Payroll and employee lookup indexes, unique payroll per employee and period', _add_lookup_indexes),
+    (2, 'Payroll input columns for incremental recomputation', _add_payroll_inputs),
+    (3, 'Year-to-date payroll totals', _backfill_payroll_ytd),
+    (4, 'Employee search index', create_search_index),
+    (5, 'Employee shard keys and job parents for sharded payroll runs', _add_shard_keys),
+    (6, 'Employee email addresses for payslip delivery', _add_employee_email),
+    (7, 'Employee search index keyed by employee id', recreate_search_index),
+    (8, 'At most one active job per kind and params', _add_active_job_index),
+]
+
+
+def _applied_versions(conn):
+    return {row[0] for row in conn.execute(text("SELECT version FROM schema_version"))}
+
+
+def run_migrations(engine):
+    """Apply every migration not yet recorded in schema_version. Returns the versions applied."""
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_version ("
+            "version INTEGER PRIMARY KEY, "
+            "description VARCHAR(255) NOT NULL, "
+            "applied_at TIMESTAMP NOT NULL)"
+        ))
+        applied = _applied_versions(conn)
+
+    newly_applied = []
+    for version, description, upgrade in MIGRATIONS:
+        if version in applied:
+            continue
+        try:
+            with engine.begin() as conn:
+                if conn.dialect.name == 'postgresql':
+                    conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {'key': ADVISORY_LOCK_KEY})
+                # Another worker may have got here first
+                if version in _applied_versions(conn):
+                    continue
+                logger.info("Applying migration %s: %s", version, description)
+                upgrade(conn)
+                conn.execute(
+                    text("INSERT INTO schema_version (version, description, applied_at) VALUES (:v, :d, :t)"),
+                    {'v': version, 'd': description, 't': datetime.utcnow()}
+                )
+            newly_applied.append(version)
+        except IntegrityError:
+            # Recorded concurrently by another process; its copy of the migration won
+            logger.info("Migration %s was applied by another process", version)
+    return newly_applied
+
+
+def upgrade_schema(engine):
+    """Create missing tables, then apply pending migrations. Returns the versions applied."""
+    db.metadata.create_all(engine)
+    return run_migrations(engine)
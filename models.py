@@ -1,12 +1,29 @@
+import zlib
 from datetime import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
+from sqlalchemy import text
 from werkzeug.security import generate_password_hash, check_password_hash
 
 
 # Create SQLAlchemy instance here
 db = SQLAlchemy()
 
+# Jobs that have not finished; at most one per kind and params may be active
+_ACTIVE_JOB = text("status IN ('queued', 'running')")
+
+# Employees are spread over this many shard keys by a hash of their id; a sharded payroll run takes a range of keys per shard
+SHARD_KEYS = 1024
+
+
+def employee_shard_key(employee_id):
+    return zlib.crc32(str(employee_id).encode('utf-8')) % SHARD_KEYS
+
+
+def _default_shard_key(context):
+    return employee_shard_key(context.get_current_parameters()['id'])
+
+
 # User auth
 class User(UserMixin, db.Model):
     __tablename__ = "user"
@@ -27,6 +44,12 @@ class User(UserMixin, db.Model):
 
 class Employee(db.Model):
     __tablename__ = 'employees'
+    __table_args__ = (
+        # Per-owner listings, paged by id
+        db.Index('ix_employees_user_id_id', 'user_id', 'id'),
+        # One shard of a payroll run, paged by id
+        db.Index('ix_employees_shard_key_id', 'shard_key', 'id'),
+    )
     
     id = db.Column(db.String(20), primary_key=True)
     kra_pin = db.Column(db.String(15), unique=True, nullable=False)
@@ -34,8 +57,11 @@ class Employee(db.Model):
     middle_name = db.Column(db.String(50))
     last_name = db.Column(db.String(50), nullable=False)
     basic_salary = db.Column(db.Float, nullable=False)
+    # Where payslips are emailed; employees without one are skipped
+    email = db.Column(db.String(255))
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    shard_key = db.Column(db.Integer, nullable=False, default=_default_shard_key)
     # owner = db.relationship("User", back_populates="employees")
 
     # Relationship
@@ -53,6 +79,12 @@ class Employee(db.Model):
 
 class Payroll(db.Model):
     __tablename__ = 'payroll'
+    __table_args__ = (
+        # P10, payslip and dashboard lookups all filter by period
+        db.Index('ix_payroll_period_employee_id', 'period', 'employee_id'),
+        # One payroll row per employee per period
+        db.Index('uq_payroll_employee_id_period', 'employee_id', 'period', unique=True),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     employee_id = db.Column(db.String(20), db.ForeignKey('employees.id'), nullable=False)
@@ -63,8 +95,153 @@ class Payroll(db.Model):
     shif = db.Column(db.Float, nullable=False)
     paye = db.Column(db.Float, nullable=False)
     net_pay = db.Column(db.Float, nullable=False)
+    # Inputs the row was calculated from, so changes can be recomputed incrementally
+    basic_salary = db.Column(db.Float)
+    benefits_total = db.Column(db.Float)
+    rate_version = db.Column(db.String(20))
     calculated_at = db.Column(db.DateTime, default=datetime.utcnow)
     employee = db.relationship("Employee", backref="payrolls")
 
     def __repr__(self):
-        return f'<Payroll {self.employee_id} - {self.period}>'
\ No newline at end of file
+        return f'<Payroll {self.employee_id} - {self.period}>'
+
+class PayrollArchive(db.Model):
+    """Payroll rows of archived periods, moved out of the payroll table with their original ids."""
+    __tablename__ = 'payroll_archive'
+    __table_args__ = (
+        # Archived periods are only read whole or one payslip at a time, so one index serves both
+        db.Index('uq_payroll_archive_period_employee_id', 'period', 'employee_id', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    employee_id = db.Column(db.String(20), db.ForeignKey('employees.id'), nullable=False)
+    period = db.Column(db.String(7), nullable=False)
+    gross_salary = db.Column(db.Float, nullable=False)
+    nssf = db.Column(db.Float, nullable=False)
+    ahl = db.Column(db.Float, nullable=False)
+    shif = db.Column(db.Float, nullable=False)
+    paye = db.Column(db.Float, nullable=False)
+    net_pay = db.Column(db.Float, nullable=False)
+    basic_salary = db.Column(db.Float)
+    benefits_total = db.Column(db.Float)
+    rate_version = db.Column(db.String(20))
+    calculated_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<PayrollArchive {self.employee_id} - {self.period}>'
+
+class ArchivedPeriod(db.Model):
+    """A period that is closed to payroll writes and being, or already, moved to payroll_archive."""
+    __tablename__ = 'archived_periods'
+
+    period = db.Column(db.String(7), primary_key=True)
+    # 'archiving' while rows are copied (reads still use payroll), then 'archived'
+    status = db.Column(db.String(20), nullable=False, default='archiving')
+    rows = db.Column(db.Integer)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    archived_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<ArchivedPeriod {self.period} {self.status}>'
+
+class PayslipDelivery(db.Model):
+    """The outcome of emailing one employee their payslip for a period."""
+    __tablename__ = 'payslip_deliveries'
+    __table_args__ = (
+        db.Index('uq_payslip_deliveries_period_employee_id', 'period', 'employee_id', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    employee_id = db.Column(db.String(20), db.ForeignKey('employees.id'), nullable=False)
+    period = db.Column(db.String(7), nullable=False)
+    email = db.Column(db.String(255))
+    # sent, failed or no_email; only sent ones are skipped when the period is sent again
+    status = db.Column(db.String(20), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text)
+    sent_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<PayslipDelivery {self.employee_id} - {self.period} {self.status}>'
+
+class PayrollYTD(db.Model):
+    """Per-employee, per-year payroll totals, updated along with every payroll row written."""
+    __tablename__ = 'payroll_ytd'
+    __table_args__ = (
+        db.Index('uq_payroll_ytd_employee_id_year', 'employee_id', 'year', unique=True),
+        # P9 exports list a year's rows
+        db.Index('ix_payroll_ytd_year_employee_id', 'year', 'employee_id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    employee_id = db.Column(db.String(20), db.ForeignKey('employees.id'), nullable=False)
+    year = db.Column(db.Integer, nullable=False)
+    months = db.Column(db.Integer, nullable=False, default=0)
+    basic_salary = db.Column(db.Float, nullable=False, default=0.0)
+    benefits_total = db.Column(db.Float, nullable=False, default=0.0)
+    gross_salary = db.Column(db.Float, nullable=False, default=0.0)
+    nssf = db.Column(db.Float, nullable=False, default=0.0)
+    shif = db.Column(db.Float, nullable=False, default=0.0)
+    ahl = db.Column(db.Float, nullable=False, default=0.0)
+    paye = db.Column(db.Float, nullable=False, default=0.0)
+    net_pay = db.Column(db.Float, nullable=False, default=0.0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<PayrollYTD {self.employee_id} - {self.year}>'
+
+class ApiToken(db.Model):
+    """A scoped, revocable bearer token for the read API. Only a keyed hash of the token is stored."""
+    __tablename__ = 'api_tokens'
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    name = db.Column(db.String(100), nullable=False)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    # Space-separated, e.g. 'employees:read payroll:read'
+    scopes = db.Column(db.String(200), nullable=False, default='employees:read payroll:read')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime)
+    revoked_at = db.Column(db.DateTime)
+
+    user = db.relationship('User')
+
+    def __repr__(self):
+        return f'<ApiToken {self.id} {self.name}>'
+
+class Job(db.Model):
+    """A long-running operation executed by the background job worker."""
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        # Workers claim the oldest queued job; the dashboard lists a user's latest
+        db.Index('ix_jobs_status_id', 'status', 'id'),
+        db.Index('ix_jobs_user_id_id', 'user_id', 'id'),
+        # enqueue() relies on it to return the active job instead of queueing the same one twice
+        db.Index('uq_jobs_active_kind_params', 'kind', 'params', unique=True,
+                 sqlite_where=_ACTIVE_JOB, postgresql_where=_ACTIVE_JOB),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(50), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, succeeded, failed
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+    # The job that split off this one, e.g. the payroll run a shard belongs to
+    parent_id = db.Column(db.Integer, db.ForeignKey('jobs.id'), nullable=True, index=True)
+    # JSON documents: handler arguments, resume point, and what the job produced
+    params = db.Column(db.Text, nullable=False, default='{}')
+    checkpoint = db.Column(db.Text)
+    result = db.Column(db.Text)
+    error = db.Column(db.Text)
+    progress = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=3)
+    locked_by = db.Column(db.String(100))
+    heartbeat_at = db.Column(db.DateTime)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f'<Job {self.id} {self.kind} {self.status}>'
@@ -1,73 +1,134 @@
-def calculate_nssf(gross_salary):
+from bisect import bisect_left
+
+import numpy as np
+
+from statutory_rates import current_rates, rates_for_period
+
+
+def calculate_nssf(gross_salary, rates=None):
     """Calculate NSSF deduction (employee contribution)"""
-    tier1_limit = 8000
-    tier2_limit = 72000
-    rate = 0.06
+    rates = rates or current_rates()
+    tier1_limit = rates.nssf_tier1_limit
+    tier2_limit = rates.nssf_tier2_limit
+    rate = rates.nssf_rate
     
-    tier1 = min(gross_salary, tier1_limit) * rate  # Max: 480
+    tier1 = min(gross_salary, tier1_limit) * rate
     tier2 = max(0, min(gross_salary - tier1_limit, tier2_limit - tier1_limit)) * rate
-    return round(min((tier1 + tier2)/2, 2160), 2)  # Cap at 4,320
+    return round(min((tier1 + tier2) * rates.nssf_share, rates.nssf_cap), 2)
 
-def calculate_shif(basic_salary):
+def calculate_shif(basic_salary, rates=None):
     """Calculate SHIF deduction - 2.75% of gross, minimum 300"""
-    shif_rate = 0.0275
-    return round(max(basic_salary * shif_rate, 300), 2)
+    rates = rates or current_rates()
+    return round(max(basic_salary * rates.shif_rate, rates.shif_minimum), 2)
 
-def calculate_ahl(gross_salary):
+def calculate_ahl(gross_salary, rates=None):
     """Calculate Affordable Housing Levy - 1.5% of gross"""
-    return round(gross_salary * 0.015, 2)
+    rates = rates or current_rates()
+    return round(gross_salary * rates.ahl_rate, 2)
 
-def calculate_paye(taxable_pay):
+def calculate_paye(taxable_pay, rates=None):
     """Calculate PAYE tax after personal relief """
-    personal_relief = 2400
-    
-    if taxable_pay <= 24000:
-        tax = taxable_pay * 0.1
-    elif taxable_pay <= 32333:
-        tax = 2400 + (taxable_pay - 24000) * 0.25
-    elif taxable_pay <= 500000:
-        tax = 2400 + (32333 - 24000) * 0.25 + (taxable_pay - 32333) * 0.3
-    elif taxable_pay <= 800000:
-        tax = 2400+ (32333-24000) * 0.25 + (500000 - 32333) * 0.3 + (taxable_pay - 500000) * 0.325
-    else:
-        tax = 2400 + (32333-2400) * 0.25 +(500000-32333) * 0.3 + (800000 - 500000)* 0.325 + (taxable_pay - 800000) * 0.35
-    return round(max(tax - personal_relief, 0), 2)
-
-def calculate_payroll(employee_data, period):
+    rates = rates or current_rates()
+    # A value equal to a band's upper limit belongs to that band
+    band = bisect_left(rates.paye_uppers, taxable_pay)
+    tax = rates.paye_cumulative[band] + (taxable_pay - rates.paye_lowers[band]) * rates.paye_rates[band]
+    return round(max(tax - rates.personal_relief, 0), 2)
+
+# Order of the keys returned by calculate_payroll
+PAYROLL_FIELDS = (
+    'gross_salary', 'benefits_total', 'nssf', 'ahl', 'taxable_pay',
+    'paye', 'shif', 'total_deductions', 'net_pay',
+)
+
+
+def calculate_payroll(employee_data, period, rates=None):
     """Calculate complete payroll with all Kenyan statutory deductions"""
-    # Calculate gross salary
-    basic_salary = employee_data['basic_salary']
     benefits_total = sum(benefit['amount'] for benefit in employee_data['benefits'])
-    gross_salary = employee_data['basic_salary'] + benefits_total
-    
+    result = calculate_payroll_batch([employee_data['basic_salary']], [benefits_total], period, rates)
+
+    payroll = {'period': period, 'rate_version': result['rate_version']}
+    for key in PAYROLL_FIELDS:
+        payroll[key] = float(result[key][0])
+    return payroll
+
+
+def _round2(values):
+    """Round an array to cents exactly like round(x, 2).
+
+    np.round works on values * 100, which can land on the wrong side of a
+    half-cent tie, so ties are settled with the builtin round instead.
+    """
+    scaled = values * 100
+    rounded = np.round(scaled) / 100
+    ties = np.flatnonzero(np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6)
+    if ties.size:
+        rounded[ties] = [round(value, 2) for value in values[ties].tolist()]
+    return rounded
+
+
+def _nssf_batch(gross, rates):
+    tier1_limit = rates.nssf_tier1_limit
+    tier2_limit = rates.nssf_tier2_limit
+    rate = rates.nssf_rate
+
+    tier1 = np.minimum(gross, tier1_limit) * rate
+    tier2 = np.clip(gross - tier1_limit, 0, tier2_limit - tier1_limit) * rate
+    return _round2(np.minimum((tier1 + tier2) * rates.nssf_share, rates.nssf_cap))
+
+
+def _shif_batch(basic, rates):
+    return _round2(np.maximum(basic * rates.shif_rate, rates.shif_minimum))
+
+
+def _ahl_batch(gross, rates):
+    return _round2(gross * rates.ahl_rate)
+
+
+def _paye_batch(taxable, rates):
+    # side='left' keeps a value equal to a band limit in the lower band, like calculate_paye
+    band = np.searchsorted(rates.paye_uppers_array, taxable, side='left')
+    tax = rates.paye_cumulative_array[band] + (taxable - rates.paye_lowers_array[band]) * rates.paye_rates_array[band]
+    return _round2(np.maximum(tax - rates.personal_relief, 0))
+
+
+def calculate_payroll_batch(basic_salaries, benefits_totals, period, rates=None):
+    """Calculate payroll for many employees at once.
+
+    Takes sequences of basic salaries and benefit totals (one entry per
+    employee) and returns a dict of NumPy arrays keyed like calculate_payroll.
+    The statutory rates in force for the period are used unless compiled
+    rates are passed in.
+    """
+    rates = rates or rates_for_period(period)
+    basic = np.asarray(basic_salaries, dtype=float)
+    benefits = np.asarray(benefits_totals, dtype=float)
+    gross = basic + benefits
+
     # Statutory deductions
-    nssf = calculate_nssf(gross_salary)
-    ahl = calculate_ahl(gross_salary)
-    shif = calculate_shif(basic_salary)
+    nssf = _nssf_batch(gross, rates)
+    ahl = _ahl_batch(gross, rates)
+    shif = _shif_batch(basic, rates)
 
     # Taxable pay
-    taxable_pay = gross_salary - nssf - ahl - shif
-    
+    taxable_pay = gross - nssf - ahl - shif
+
     # PAYE
-    paye = calculate_paye(taxable_pay)
-    
+    paye = _paye_batch(taxable_pay, rates)
+
     # Net pay
     total_deductions = nssf + ahl + paye + shif
-    net_pay = gross_salary - total_deductions
-    
+    net_pay = gross - total_deductions
+
     return {
         'period': period,
-        'gross_salary': round(gross_salary, 2),
-        'benefits_total': round(benefits_total, 2),
+        'rate_version': rates.version,
+        'gross_salary': _round2(gross),
+        'benefits_total': _round2(benefits),
         'nssf': nssf,
         'ahl': ahl,
-        'taxable_pay': round(taxable_pay, 2),
+        'taxable_pay': _round2(taxable_pay),
         'paye': paye,
         'shif': shif,
-        'total_deductions': round(total_deductions, 2),
-        'net_pay': round(net_pay, 2)
+        'total_deductions': _round2(total_deductions),
+        'net_pay': _round2(net_pay)
     }
-
-
-
-
@@ -0,0 +1,213 @@
+from datetime import datetime
+
+from sqlalchemy import and_, or_, select
+
+from archive import ensure_open, lock_open
+from models import db, Employee, Payroll
+from payroll_calculator import calculate_payroll_batch
+from payroll_run import PERIOD_PATTERN, WRITE_CHUNK_SIZE, payroll_values
+from ytd import add_ytd_change, apply_ytd_deltas
+from statutory_rates import RATE_TABLES, compile_rates, rate_version_for_period
+
+# Result columns compared to decide whether a recomputed row really changed
+RESULT_COLUMNS = ('gross_salary', 'nssf', 'shif', 'ahl', 'paye', 'net_pay')
+
+
+def affected_region(old, new):
+    """Which payroll rows a switch from the old to the new compiled rates can change.
+
+    Returns None when any row may change. Otherwise returns thresholds, each
+    None when unused: only rows with gross pay at or above 'gross_from',
+    taxable pay at or above 'taxable_from' or basic salary at or below
+    'basic_to' can come out differently.
+    """
+    flat_old = (old.nssf_rate, old.nssf_share, old.shif_rate, old.ahl_rate, old.personal_relief)
+    flat_new = (new.nssf_rate, new.nssf_share, new.shif_rate, new.ahl_rate, new.personal_relief)
+    if flat_old != flat_new:
+        return None
+
+    region = {'gross_from': None, 'taxable_from': None, 'basic_to': None}
+
+    # NSSF is rate * share * min(gross, tier 2 limit), capped; below every changed limit both agree
+    points = []
+    if old.nssf_tier1_limit != new.nssf_tier1_limit:
+        points.append(min(old.nssf_tier1_limit, new.nssf_tier1_limit))
+    if old.nssf_tier2_limit != new.nssf_tier2_limit:
+        points.append(min(old.nssf_tier2_limit, new.nssf_tier2_limit))
+    if old.nssf_cap != new.nssf_cap:
+        points.append(min(old.nssf_cap, new.nssf_cap) / (old.nssf_rate * old.nssf_share))
+    if points:
+        region['gross_from'] = min(points)
+
+    # PAYE agrees up to the first band whose limit or rate differs
+    for i in range(max(len(old.paye_rates), len(new.paye_rates))):
+        if i >= len(old.paye_rates) or i >= len(new.paye_rates) or old.paye_rates[i] != new.paye_rates[i]:
+            region['taxable_from'] = old.paye_lowers[min(i, len(old.paye_lowers) - 1)]
+            break
+        old_upper = old.paye_uppers[i] if i < len(old.paye_uppers) else None
+        new_upper = new.paye_uppers[i] if i < len(new.paye_uppers) else None
+        if old_upper != new_upper:
+            region['taxable_from'] = min(upper for upper in (old_upper, new_upper) if upper is not None)
+            break
+
+    # SHIF only differs where the minimum applies
+    if old.shif_minimum != new.shif_minimum:
+        region['basic_to'] = max(old.shif_minimum, new.shif_minimum) / old.shif_rate
+
+    return region
+
+
+def _region_condition(region):
+    taxable_pay = Payroll.gross_salary - Payroll.nssf - Payroll.ahl - Payroll.shif
+    parts = []
+    if region['gross_from'] is not None:
+        parts.append(Payroll.gross_salary >= region['gross_from'])
+    if region['taxable_from'] is not None:
+        parts.append(taxable_pay >= region['taxable_from'])
+    if region['basic_to'] is not None:
+        parts.append(Payroll.basic_salary <= region['basic_to'])
+    return or_(*parts) if parts else None
+
+
+def _check_amounts(amounts, label):
+    checked = {}
+    for employee_id, amount in (amounts or {}).items():
+        try:
+            amount = float(amount)
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid {label} for employee {employee_id}')
+        if amount < 0:
+            raise ValueError(f'{label.capitalize()} cannot be negative for employee {employee_id}')
+        checked[str(employee_id)] = amount
+    return checked
+
+
+def _scoped(query, user_id):
+    if user_id is not None:
+        query = query.filter(Employee.user_id == user_id)
+    return query
+
+
+def recompute_payroll(period, user_id=None, salaries=None, benefits=None):
+    """Recompute only the payroll rows of a period whose inputs or rates changed.
+
+    salaries and benefits optionally map employee ids to a new basic salary
+    or benefits total; salaries are saved on the employee first. A row is
+    recomputed when its basic salary or benefits differ from what it was
+    calculated with, or when it was calculated with another rate version and
+    falls in a part of the tables that changed. Rows on an older version
+    that the change cannot affect only have their rate version updated.
+
+    Returns a report with the rows checked and a diff of old vs new net pay.
+    """
+    if not PERIOD_PATTERN.match(period or ''):
+        raise ValueError('Period must be in YYYY-MM format')
+    ensure_open(period)
+    salaries = _check_amounts(salaries, 'salary')
+    benefits = _check_amounts(benefits, 'benefits total')
+
+    version = rate_version_for_period(period)
+    new_rates = compile_rates(version)
+    now = datetime.utcnow()
+
+    try:
+        if salaries:
+            in_scope = _scoped(db.session.query(Employee.id).filter(Employee.id.in_(list(salaries))), user_id)
+            db.session.bulk_update_mappings(Employee, [
+                {'id': employee_id, 'basic_salary': salaries[employee_id]} for (employee_id,) in in_scope
+            ])
+
+        # Inputs changed
+        conditions = [
+            Payroll.basic_salary.is_(None),
+            Payroll.benefits_total.is_(None),
+            Payroll.rate_version.is_(None),
+            Payroll.basic_salary != Employee.basic_salary,
+        ]
+        if benefits:
+            conditions.append(Payroll.employee_id.in_(list(benefits)))
+
+        # Rates changed, limited to the part of the tables that differs
+        known_versions = [table['version'] for table in RATE_TABLES]
+        stale_versions = [old for old in known_versions if old != version]
+        for old in stale_versions:
+            region = affected_region(compile_rates(old), new_rates)
+            if region is None:
+                conditions.append(Payroll.rate_version == old)
+                continue
+            condition = _region_condition(region)
+            if condition is not None:
+                conditions.append(and_(Payroll.rate_version == old, condition))
+        conditions.append(Payroll.rate_version.notin_(known_versions))
+
+        candidates = _scoped(
+            db.session.query(
+                Payroll.id, Payroll.employee_id, Employee.basic_salary,
+                Payroll.basic_salary, Payroll.benefits_total,
+                Payroll.gross_salary, Payroll.nssf, Payroll.shif, Payroll.ahl, Payroll.paye, Payroll.net_pay,
+            )
+            .join(Employee, Payroll.employee_id == Employee.id)
+            .filter(Payroll.period == period, or_(*conditions)),
+            user_id
+        ).all()
+
+        report = {'period': period, 'rate_version': version, 'checked': len(candidates),
+                  'changed': 0, 'version_updated': 0, 'diff': []}
+
+        if candidates:
+            inputs = []
+            for (_, employee_id, basic_salary, old_basic, old_benefits, gross_salary, *_rest) in candidates:
+                if employee_id in benefits:
+                    benefits_total = benefits[employee_id]
+                elif old_benefits is not None:
+                    benefits_total = old_benefits
+                else:
+                    benefits_total = max(gross_salary - (old_basic if old_basic is not None else basic_salary), 0)
+                inputs.append((basic_salary, benefits_total))
+
+            results = calculate_payroll_batch(
+                [basic for basic, _ in inputs], [total for _, total in inputs], period, new_rates
+            )
+
+            updates, ytd_deltas = [], {}
+            for i, candidate in enumerate(candidates):
+                payroll_id, employee_id = candidate[0], candidate[1]
+                old = dict(zip(RESULT_COLUMNS, candidate[5:]))
+                row = payroll_values(results, i, *inputs[i])
+                row['id'] = payroll_id
+                add_ytd_change(ytd_deltas, employee_id, period,
+                               old={**old, 'basic_salary': candidate[3], 'benefits_total': candidate[4]}, new=row)
+                if any(row[column] != old[column] for column in RESULT_COLUMNS):
+                    row['calculated_at'] = now
+                    report['changed'] += 1
+                    report['diff'].append({
+                        'employee_id': employee_id,
+                        'old_net_pay': old['net_pay'],
+                        'new_net_pay': row['net_pay'],
+                        'delta': round(row['net_pay'] - old['net_pay'], 2),
+                    })
+                else:
+                    # Same figures; only record the inputs they now correspond to
+                    row = {key: row[key] for key in ('id', 'basic_salary', 'benefits_total', 'rate_version')}
+                updates.append(row)
+
+            for start in range(0, len(updates), WRITE_CHUNK_SIZE):
+                db.session.bulk_update_mappings(Payroll, updates[start:start + WRITE_CHUNK_SIZE])
+            apply_ytd_deltas(ytd_deltas)
+
+        # Rows on an older version that the change cannot affect
+        if stale_versions:
+            bump = db.session.query(Payroll).filter(
+                Payroll.period == period, Payroll.rate_version.in_(stale_versions)
+            )
+            if user_id is not None:
+                bump = bump.filter(Payroll.employee_id.in_(select(Employee.id).where(Employee.user_id == user_id)))
+            report['version_updated'] = bump.update({Payroll.rate_version: version}, synchronize_session=False)
+
+        lock_open(period)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return report
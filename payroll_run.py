@@ -0,0 +1,158 @@
+import re
+from datetime import datetime
+
+from sqlalchemy import and_, func, insert
+
+from archive import ensure_open, lock_open
+from models import db, SHARD_KEYS, Employee, Payroll
+from payroll_calculator import calculate_payroll_batch
+from ytd import YTD_COLUMNS, add_ytd_change, apply_ytd_deltas
+
+PERIOD_PATTERN = re.compile(r'^\d{4}-(0[1-9]|1[0-2])$')
+
+# Rows written per executemany round trip
+WRITE_CHUNK_SIZE = 5000
+
+
+def payroll_values(results, i, basic_salary, benefits_total):
+    """Column values for one payroll row from calculate_payroll_batch results, inputs included."""
+    return {
+        'gross_salary': float(results['gross_salary'][i]),
+        'nssf': float(results['nssf'][i]),
+        'shif': float(results['shif'][i]),
+        'ahl': float(results['ahl'][i]),
+        'paye': float(results['paye'][i]),
+        'net_pay': float(results['net_pay'][i]),
+        'basic_salary': float(basic_salary),
+        'benefits_total': float(benefits_total),
+        'rate_version': results['rate_version'],
+    }
+
+
+def shard_key_range(shard, shards):
+    """The [low, high) range of employee shard keys that shard number `shard` of `shards` covers."""
+    return shard * SHARD_KEYS // shards, (shard + 1) * SHARD_KEYS // shards
+
+
+def _in_shard(query, shard_keys):
+    low, high = shard_keys
+    return query.filter(Employee.shard_key >= low, Employee.shard_key < high)
+
+
+def _load_inputs(period, user_id=None, after=None, limit=None, shard_keys=None):
+    """Load every employee's basic salary and carried-forward benefits in one query.
+
+    Benefits are not stored on the employee, so they are taken from the
+    employee's latest payroll at or before the period (or gross minus basic
+    for rows saved before inputs were recorded). Employees without any
+    payroll get no benefits. after and limit select one page of employees
+    in id order, shard_keys a range of employee shard keys.
+    """
+    latest = (
+        db.session.query(Payroll.employee_id, func.max(Payroll.period).label('period'))
+        .filter(Payroll.period <= period)
+        .group_by(Payroll.employee_id)
+        .subquery()
+    )
+    query = (
+        db.session.query(Employee.id, Employee.basic_salary, Payroll.benefits_total, Payroll.gross_salary)
+        .outerjoin(latest, latest.c.employee_id == Employee.id)
+        .outerjoin(Payroll, and_(Payroll.employee_id == latest.c.employee_id,
+                                 Payroll.period == latest.c.period))
+    )
+    if user_id is not None:
+        query = query.filter(Employee.user_id == user_id)
+    if shard_keys is not None:
+        query = _in_shard(query, shard_keys)
+    if after is not None:
+        query = query.filter(Employee.id > after)
+    if limit is not None:
+        query = query.order_by(Employee.id).limit(limit)
+
+    inputs = {}
+    for employee_id, basic_salary, benefits_total, gross_salary in query:
+        if benefits_total is None:
+            benefits_total = max(gross_salary - basic_salary, 0) if gross_salary is not None else 0.0
+        inputs[employee_id] = (basic_salary, benefits_total)
+    return inputs
+
+
+def run_payroll(period, user_id=None, after=None, limit=None, shard_keys=None):
+    """Calculate and save payroll for every employee for a period.
+
+    Only employees owned by user_id are included when it is given, and
+    only those whose shard key is in the [low, high) range shard_keys when
+    that is. Pass after and limit to process one page of employees in id
+    order; the summary's last_employee_id is the cursor for the next page.
+    Existing payroll rows for the period are updated in place, missing ones
+    inserted. Returns a summary with the number of employees, rows created
+    and updated.
+    """
+    if not PERIOD_PATTERN.match(period or ''):
+        raise ValueError('Period must be in YYYY-MM format')
+    ensure_open(period)
+
+    inputs = _load_inputs(period, user_id, after, limit, shard_keys)
+    summary = {'period': period, 'employees': len(inputs), 'created': 0, 'updated': 0,
+               'last_employee_id': None}
+    if not inputs:
+        return summary
+
+    employee_ids = list(inputs)
+    if limit is not None:
+        # Rows came back in database id order, which is the order the cursor follows
+        summary['last_employee_id'] = employee_ids[-1]
+    results = calculate_payroll_batch(
+        [inputs[employee_id][0] for employee_id in employee_ids],
+        [inputs[employee_id][1] for employee_id in employee_ids],
+        period,
+    )
+
+    # Old figures come along so the year-to-date totals can be adjusted by the difference
+    existing_query = (
+        db.session.query(Payroll.employee_id, Payroll.id, *[getattr(Payroll, column) for column in YTD_COLUMNS])
+        .filter(Payroll.period == period)
+    )
+    if user_id is not None or shard_keys is not None:
+        existing_query = existing_query.join(Employee)
+    if user_id is not None:
+        existing_query = existing_query.filter(Employee.user_id == user_id)
+    if shard_keys is not None:
+        existing_query = _in_shard(existing_query, shard_keys)
+    if limit is not None:
+        existing_query = existing_query.filter(Payroll.employee_id <= summary['last_employee_id'])
+        if after is not None:
+            existing_query = existing_query.filter(Payroll.employee_id > after)
+    existing = {employee_id: (payroll_id, dict(zip(YTD_COLUMNS, old)))
+                for employee_id, payroll_id, *old in existing_query}
+
+    now = datetime.utcnow()
+    to_insert, to_update, ytd_deltas = [], [], {}
+    for i, employee_id in enumerate(employee_ids):
+        row = payroll_values(results, i, *inputs[employee_id])
+        row['calculated_at'] = now
+        if employee_id in existing:
+            row['id'], old = existing[employee_id]
+            add_ytd_change(ytd_deltas, employee_id, period, old=old, new=row)
+            to_update.append(row)
+        else:
+            add_ytd_change(ytd_deltas, employee_id, period, new=row)
+            row['employee_id'] = employee_id
+            row['period'] = period
+            to_insert.append(row)
+
+    try:
+        for start in range(0, len(to_insert), WRITE_CHUNK_SIZE):
+            db.session.execute(insert(Payroll), to_insert[start:start + WRITE_CHUNK_SIZE])
+        for start in range(0, len(to_update), WRITE_CHUNK_SIZE):
+            db.session.bulk_update_mappings(Payroll, to_update[start:start + WRITE_CHUNK_SIZE])
+        apply_ytd_deltas(ytd_deltas)
+        lock_open(period)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    summary['created'] = len(to_insert)
+    summary['updated'] = len(to_update)
+    return summary
@@ -0,0 +1,139 @@
+import hashlib
+import logging
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def payslip_cache_key(payroll, employee, ytd=None):
+    """Content address of a rendered payslip: payroll row, its calculation time, the employee details
+    printed on it, year-to-date figures, the template and renderer.
+
+    The employee details and year-to-date figures are part of the key because
+    editing the employee or recalculating an earlier month changes the
+    payslip without touching this payroll row.
+    """
+    # Imported on first use, like the renderer itself, to keep ReportLab out of process startup
+    from generate_pdf import DEFAULT_RENDERER, TEMPLATE_VERSION
+
+    calculated_at = payroll.calculated_at.isoformat() if payroll.calculated_at else ''
+    employee_part = '|'.join(str(value) for value in (
+        employee.id, employee.kra_pin, employee.first_name, employee.middle_name, employee.last_name,
+        employee.basic_salary,
+    ))
+    ytd_part = ','.join(f'{value:.2f}' for value in ytd.values()) if ytd else ''
+    raw = f'{payroll.id}:{calculated_at}:{employee_part}:{ytd_part}:{TEMPLATE_VERSION}:{DEFAULT_RENDERER}'
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class PayslipCache:
+    """Two-tier cache of rendered payslip PDFs keyed by payslip_cache_key.
+
+    The first tier is an in-memory LRU holding up to max_items PDFs. When a
+    directory is given, PDFs are also written there and the least recently
+    used files are deleted once the directory grows past max_disk_bytes.
+    """
+
+    def __init__(self, max_items=256, directory=None, max_disk_bytes=256 * 1024 * 1024):
+        self.max_items = max_items
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+            self._disk_bytes = sum(size for _, _, size in self._disk_entries())
+
+    def get(self, key):
+        with self._lock:
+            data = self._memory.get(key)
+            if data is not None:
+                self._memory.move_to_end(key)
+                return data
+
+        data = self._read_disk(key)
+        if data is not None:
+            self._remember(key, data)
+        return data
+
+    def put(self, key, data):
+        self._remember(key, data)
+        self._write_disk(key, data)
+
+    def _remember(self, key, data):
+        if self.max_items <= 0:
+            return
+        with self._lock:
+            self._memory[key] = data
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    # Disk tier
+
+    def _path(self, key):
+        return os.path.join(self.directory, f'{key}.pdf')
+
+    def _disk_entries(self):
+        """(path, last used, size) for every cached file."""
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.is_file() and entry.name.endswith('.pdf'):
+                stat = entry.stat()
+                entries.append((entry.path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                data = f.read()
+            # mtime doubles as the last-used time for eviction
+            os.utime(path)
+            return data
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logger.warning("Could not read cached payslip %s: %s", path, e)
+            return None
+
+    def _write_disk(self, key, data):
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            # Write to a temp file and rename so other workers never see a partial PDF
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning("Could not write cached payslip %s: %s", path, e)
+            return
+
+        with self._lock:
+            self._disk_bytes += len(data)
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        """Delete least recently used files until the directory is back under budget."""
+        entries = sorted(self._disk_entries(), key=lambda entry: entry[1])
+        total = sum(size for _, _, size in entries)
+        for path, _, size in entries:
+            if total <= self.max_disk_bytes:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                total -= size
+            except OSError as e:
+                logger.warning("Could not evict cached payslip %s: %s", path, e)
+        self._disk_bytes = total
@@ -0,0 +1,212 @@
+"""Email payslips to employees over SMTP.
+
+distribute_payslips() renders each employee's payslip for a period and
+sends it as a PDF attachment. Every message goes over one SMTP connection,
+which is reopened after SMTP_BATCH_SIZE messages or when the server drops
+it, and sends are spaced to at most SMTP_RATE a second. Each employee's
+outcome is recorded in payslip_deliveries. Sending the period again skips
+employees who were sent their payslip and retries failed sends and
+employees who had no email address.
+
+To try it without a mail server, run a local stand-in such as
+`python -m aiosmtpd -n -l localhost:8025` and set SMTP_PORT=8025.
+"""
+import logging
+import os
+import smtplib
+import ssl
+import time
+from datetime import datetime
+from email.message import EmailMessage
+
+from sqlalchemy import func
+
+from metrics import observe_pdf_render
+from models import db, Employee, PayslipDelivery
+from payslip_export import payslip_records, render_payslip
+
+logger = logging.getLogger(__name__)
+
+SMTP_HOST = os.getenv('SMTP_HOST', 'localhost')
+SMTP_PORT = int(os.getenv('SMTP_PORT', 25))
+SMTP_USERNAME = os.getenv('SMTP_USERNAME')
+SMTP_PASSWORD = os.getenv('SMTP_PASSWORD')
+# 'starttls', 'ssl', or empty for a plain connection
+SMTP_SECURITY = os.getenv('SMTP_SECURITY', '')
+SMTP_TIMEOUT = 30
+MAIL_FROM = os.getenv('MAIL_FROM', 'payroll@localhost')
+# Most messages sent per second; 0 sends as fast as the server accepts them
+SMTP_RATE = float(os.getenv('SMTP_RATE', 10))
+# Messages sent over one connection before it is closed and reopened
+SMTP_BATCH_SIZE = int(os.getenv('SMTP_BATCH_SIZE', 100))
+# Tries per message when the connection fails or the server answers with a temporary (4xx) error
+SEND_ATTEMPTS = 3
+RETRY_DELAY = 1.0
+# Employees read from the database per round trip
+PAGE_SIZE = 100
+
+
+class SMTPConnection:
+    """One SMTP session reused for a batch of messages.
+
+    It is opened on the first send, and closed and opened again once
+    batch_size messages have gone over it or the server has dropped it.
+    """
+
+    def __init__(self, host=None, port=None, batch_size=None):
+        self.host = host or SMTP_HOST
+        self.port = port or SMTP_PORT
+        self.batch_size = batch_size or SMTP_BATCH_SIZE
+        self._smtp = None
+        self._sent = 0
+
+    def _open(self):
+        if SMTP_SECURITY == 'ssl':
+            smtp = smtplib.SMTP_SSL(self.host, self.port, timeout=SMTP_TIMEOUT,
+                                    context=ssl.create_default_context())
+        else:
+            smtp = smtplib.SMTP(self.host, self.port, timeout=SMTP_TIMEOUT)
+            if SMTP_SECURITY == 'starttls':
+                smtp.starttls(context=ssl.create_default_context())
+        if SMTP_USERNAME:
+            smtp.login(SMTP_USERNAME, SMTP_PASSWORD or '')
+        self._smtp, self._sent = smtp, 0
+
+    def send(self, message):
+        if self._smtp is not None and self._sent >= self.batch_size:
+            self.close()
+        if self._smtp is None:
+            self._open()
+        self._smtp.send_message(message)
+        self._sent += 1
+
+    def close(self):
+        """Say QUIT if the connection is still up; safe to call at any time."""
+        smtp, self._smtp = self._smtp, None
+        if smtp is None:
+            return
+        try:
+            smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            smtp.close()
+
+
+class _Throttle:
+    """Spaces calls to wait() at least 1/rate seconds apart."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self._next = 0.0
+
+    def wait(self):
+        now = time.monotonic()
+        if now < self._next:
+            time.sleep(self._next - now)
+            now = self._next
+        self._next = now + self.interval
+
+
+def _rejected(error):
+    """The server's code when it refused this one message, or None when the session itself failed."""
+    if isinstance(error, smtplib.SMTPRecipientsRefused):
+        return max(code for code, _ in error.recipients.values())
+    if isinstance(error, smtplib.SMTPDataError):
+        return error.smtp_code
+    return None
+
+
+def _send(connection, message):
+    """Send one message, retrying temporary failures. Returns (attempts, error or None).
+
+    A message the server refuses is reported as the error. When the
+    connection keeps failing the last error is raised instead, since the
+    rest of the batch would fail the same way.
+    """
+    for attempt in range(1, SEND_ATTEMPTS + 1):
+        try:
+            connection.send(message)
+            return attempt, None
+        except (smtplib.SMTPException, OSError) as e:
+            code = _rejected(e)
+            if code is not None and (code >= 500 or attempt == SEND_ATTEMPTS):
+                return attempt, str(e)
+            if code is None:
+                # The session is in an unknown state, so the retry starts a new one
+                connection.close()
+                if attempt == SEND_ATTEMPTS:
+                    raise
+            logger.warning("Sending to %s failed on attempt %s: %s", message['To'], attempt, e)
+            time.sleep(RETRY_DELAY * 2 ** (attempt - 1))
+
+
+def build_message(email, first_name, period, filename, pdf):
+    message = EmailMessage()
+    message['From'] = MAIL_FROM
+    message['To'] = email
+    message['Subject'] = f'Your payslip for {period}'
+    message.set_content(f'Dear {first_name},\n\nPlease find attached your payslip for {period}.\n')
+    message.add_attachment(pdf, maintype='application', subtype='pdf', filename=filename)
+    return message
+
+
+def _record(delivery, status, attempts=0, error=None):
+    delivery.status = status
+    delivery.attempts = (delivery.attempts or 0) + attempts
+    delivery.error = error
+    if status == 'sent':
+        delivery.sent_at = datetime.utcnow()
+    db.session.commit()
+
+
+def distribute_payslips(period, user_id=None, after=None, connection=None):
+    """Email the period's payslips in employee id order, starting after the employee id `after`.
+
+    Yields (employees handled, last employee id handled) after every send
+    and at the end of every page, for a caller to save as its resume point.
+    The connection is closed when the generator finishes.
+    """
+    connection = connection or SMTPConnection()
+    throttle = _Throttle(SMTP_RATE)
+    try:
+        while True:
+            page = list(payslip_records(period, user_id, after=after, limit=PAGE_SIZE))
+            if not page:
+                return
+            ids = [record[0] for record in page]
+            emails = dict(db.session.query(Employee.id, Employee.email).filter(Employee.id.in_(ids)))
+            deliveries = {delivery.employee_id: delivery for delivery in PayslipDelivery.query.filter(
+                PayslipDelivery.period == period, PayslipDelivery.employee_id.in_(ids))}
+            handled = 0
+            for record in page:
+                employee_id, handled = record[0], handled + 1
+                delivery = deliveries.get(employee_id)
+                if delivery is not None and delivery.status == 'sent':
+                    continue
+                if delivery is None:
+                    delivery = PayslipDelivery(employee_id=employee_id, period=period)
+                    db.session.add(delivery)
+                delivery.email = email = emails.get(employee_id)
+                if not email:
+                    _record(delivery, 'no_email')
+                    continue
+
+                filename, pdf, seconds = render_payslip(record)
+                observe_pdf_render(seconds, len(pdf), 'email')
+                throttle.wait()
+                attempts, error = _send(connection, build_message(email, record[2], period, filename, pdf))
+                _record(delivery, 'failed' if error else 'sent', attempts, error)
+                yield handled, employee_id
+                handled = 0
+            after = page[-1][0]
+            yield handled, after
+    finally:
+        connection.close()
+
+
+def delivery_counts(period, user_id=None):
+    """Number of the period's deliveries by status, e.g. {'sent': 10, 'failed': 1, 'no_email': 2}."""
+    query = (db.session.query(PayslipDelivery.status, func.count(PayslipDelivery.id))
+             .filter(PayslipDelivery.period == period).group_by(PayslipDelivery.status))
+    if user_id is not None:
+        query = query.join(Employee, PayslipDelivery.employee_id == Employee.id).filter(Employee.user_id == user_id)
+    return dict(query.all())
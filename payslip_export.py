@@ -0,0 +1,129 @@
+import os
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from archive import payroll_model
+from database import read_session
+from models import Employee, Payroll
+from metrics import observe_pdf_render
+from ytd import YTD_COLUMNS, ytd_columns_for_period
+
+# Rows fetched from the database per round trip
+FETCH_SIZE = 500
+
+
+class _ChunkSink:
+    """Write-only file object that collects what ZipFile writes so it can be yielded.
+
+    It has no seek(), so ZipFile writes entries with data descriptors and never
+    goes back to patch headers, which is what makes streaming possible.
+    """
+
+    def __init__(self):
+        self._chunks = []
+        self._offset = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def payslip_records(period, user_id=None, after=None, limit=None):
+    """Yield plain tuples with everything a payslip needs, one row per employee.
+
+    Each tuple ends with the year-to-date totals in YTD_COLUMNS order. after
+    and limit select one page of employees in id order.
+    """
+    session = read_session()
+    model = payroll_model(period, session)
+    ytd_columns, join_ytd = ytd_columns_for_period(period)
+    query = join_ytd(
+        session.query(
+            Employee.id, Employee.kra_pin, Employee.first_name, Employee.middle_name,
+            Employee.last_name, Employee.basic_salary,
+            model.period, model.gross_salary, model.nssf, model.ahl,
+            model.shif, model.paye, model.net_pay, *ytd_columns,
+        )
+        .join(model, model.employee_id == Employee.id)
+    ).filter(model.period == period).order_by(Employee.id)
+    if user_id is not None:
+        query = query.filter(Employee.user_id == user_id)
+    if after is not None:
+        query = query.filter(Employee.id > after)
+    if limit is not None:
+        query = query.limit(limit)
+    for row in query.yield_per(FETCH_SIZE):
+        yield tuple(row)
+
+
+def render_payslip(record):
+    """Render one payslip from a payslip_records() tuple. Returns (file name, PDF bytes, render seconds)."""
+    (employee_id, kra_pin, first_name, middle_name, last_name, basic_salary,
+     period, gross_salary, nssf, ahl, shif, paye, net_pay, *ytd_values) = record
+    # Transient instances, never added to a session
+    employee = Employee(id=employee_id, kra_pin=kra_pin, first_name=first_name,
+                        middle_name=middle_name, last_name=last_name, basic_salary=basic_salary)
+    payroll = Payroll(employee_id=employee_id, period=period, gross_salary=gross_salary,
+                      nssf=nssf, ahl=ahl, shif=shif, paye=paye, net_pay=net_pay)
+    ytd = dict(zip(YTD_COLUMNS, map(float, ytd_values))) if ytd_values and ytd_values[0] is not None else None
+    # Imported here so that importing this module does not load ReportLab
+    from generate_pdf import generate_payslip_pdf
+    started = time.perf_counter()
+    pdf = generate_payslip_pdf(employee, payroll, ytd=ytd).getvalue()
+    return f'payslip_{employee_id}_{period}.pdf', pdf, time.perf_counter() - started
+
+
+def _add_to_archive(archive, result):
+    name, pdf, seconds = result
+    archive.writestr(name, pdf)
+    # Worker processes have their own metrics, so the render is recorded here
+    observe_pdf_render(seconds, len(pdf), 'zip_export')
+
+
+def iter_payslip_zip(records, max_workers=None):
+    """Render payslips across a process pool and yield a ZIP archive in chunks.
+
+    At most two payslips per worker are in flight at a time and each one is
+    written to the archive as soon as it is done, so memory stays flat no
+    matter how many records there are.
+    """
+    max_workers = max_workers or int(os.getenv('PAYSLIP_EXPORT_WORKERS', 0)) or os.cpu_count() or 1
+    window = max_workers * 2
+    sink = _ChunkSink()
+    # PDFs are already compressed, so deflating them again only costs CPU
+    archive = zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED)
+    pool = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        pending = set()
+        for record in records:
+            pending.add(pool.submit(render_payslip, record))
+            if len(pending) < window:
+                continue
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                _add_to_archive(archive, future.result())
+            yield sink.drain()
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                _add_to_archive(archive, future.result())
+            yield sink.drain()
+
+        archive.close()
+        yield sink.drain()
+    finally:
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,197 @@
+"""On-demand sampling profiler for single requests, available to admins only.
+
+Send `X-Profile: 1` or add `?_profile=1` to a request. The request thread's
+stack is sampled until the response (streamed bodies included) is closed,
+and the collapsed stacks, ready for flamegraph.pl or speedscope, are saved
+with the SQL statements the request issued. Reports live in a bounded
+directory and the oldest are deleted first.
+"""
+import json
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+
+from flask import g, has_request_context, request
+from flask_login import current_user
+from sqlalchemy import event
+
+PROFILE_ID_PATTERN = re.compile(r'^[0-9]{8}T[0-9]{12}-[0-9a-f]{8}$')
+# Longest stack kept per sample; deeper frames are cut from the root side
+MAX_DEPTH = 128
+
+
+class SamplingProfiler:
+    """Samples one thread's Python stack from a background thread."""
+
+    def __init__(self, thread_id, interval=0.001):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='request-profiler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            frames = []
+            while frame is not None and len(frames) < MAX_DEPTH:
+                code = frame.f_code
+                frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if frames:
+                self.stacks[';'.join(reversed(frames))] += 1
+                self.samples += 1
+
+    def collapsed(self):
+        return ''.join(f'{stack} {count}\n' for stack, count in self.stacks.most_common())
+
+
+class ProfileStore:
+    """Directory of saved profiles, trimmed to max_reports and max_bytes."""
+
+    def __init__(self, directory, max_reports=50, max_bytes=50 * 1024 * 1024):
+        self.directory = directory
+        self.max_reports = max_reports
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def _path(self, profile_id, extension):
+        return os.path.join(self.directory, f'{profile_id}.{extension}')
+
+    def save(self, profile_id, collapsed, meta):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self._path(profile_id, 'collapsed'), 'w') as f:
+            f.write(collapsed)
+        with open(self._path(profile_id, 'json'), 'w') as f:
+            json.dump(meta, f, indent=2)
+        self._rotate()
+
+    def _rotate(self):
+        with self._lock:
+            reports = {}
+            for entry in os.scandir(self.directory):
+                profile_id, _, extension = entry.name.rpartition('.')
+                if extension in ('collapsed', 'json') and PROFILE_ID_PATTERN.match(profile_id):
+                    reports.setdefault(profile_id, []).append((entry.path, entry.stat().st_size))
+            # Profile ids start with a timestamp, so sorting puts the oldest first
+            ordered = sorted(reports)
+            total = sum(size for files in reports.values() for _, size in files)
+            while ordered and (len(ordered) > self.max_reports or total > self.max_bytes):
+                for path, size in reports[ordered.pop(0)]:
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+                    total -= size
+
+    def list(self):
+        if not os.path.isdir(self.directory):
+            return []
+        profiles = []
+        for name in sorted(os.listdir(self.directory), reverse=True):
+            profile_id, _, extension = name.rpartition('.')
+            if extension != 'json' or not PROFILE_ID_PATTERN.match(profile_id):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                continue
+            meta.pop('sql', None)
+            profiles.append(meta)
+        return profiles
+
+    def path(self, profile_id, extension):
+        """Path of a saved report file, or None for unknown or malformed ids."""
+        if not PROFILE_ID_PATTERN.match(profile_id or ''):
+            return None
+        path = self._path(profile_id, extension)
+        return path if os.path.exists(path) else None
+
+
+def _profiling_requested():
+    return request.headers.get('X-Profile') == '1' or request.args.get('_profile') == '1'
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and g.get('profile') is not None:
+        context._profile_start = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_request_context() and g.get('profile') is not None:
+        # Profiling may have started between this statement's two events
+        start = getattr(context, '_profile_start', None)
+        elapsed = time.perf_counter() - start if start is not None else 0.0
+        g.profile['sql'].append({'statement': statement, 'ms': round(elapsed * 1000, 3),
+                                 'executemany': executemany})
+
+
+def instrument_engine(engine):
+    """Record the SQL statements of profiled requests."""
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+
+def init_app(app, store):
+    """Profile admin requests that ask for it and save the reports to store."""
+    interval = float(os.getenv('PROFILE_INTERVAL', 0.001))
+
+    @app.before_request
+    def _start_profile():
+        if not _profiling_requested():
+            return
+        if not (current_user.is_authenticated and current_user.is_admin):
+            return
+        sampler = SamplingProfiler(threading.get_ident(), interval)
+        g.profile = {'sampler': sampler, 'sql': [], 'start': time.perf_counter(),
+                     'id': f"{datetime.utcnow():%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}"}
+        sampler.start()
+
+    @app.after_request
+    def _finish_profile(response):
+        profile = g.get('profile')
+        if profile is None:
+            return response
+        meta = {
+            'id': profile['id'],
+            'method': request.method,
+            'path': request.full_path.rstrip('?'),
+            'endpoint': request.endpoint,
+            'status': response.status_code,
+            'user_id': current_user.id,
+            'created_at': datetime.utcnow().isoformat() + 'Z',
+        }
+
+        def save():
+            sampler = profile['sampler']
+            sampler.stop()
+            meta['duration_ms'] = round((time.perf_counter() - profile['start']) * 1000, 3)
+            meta['samples'] = sampler.samples
+            meta['interval_ms'] = sampler.interval * 1000
+            meta['sql_statements'] = len(profile['sql'])
+            meta['sql_ms'] = round(sum(query['ms'] for query in profile['sql']), 3)
+            meta['sql'] = profile['sql']
+            try:
+                store.save(profile['id'], sampler.collapsed(), meta)
+            except OSError:
+                app.logger.exception("Could not save profile %s", profile['id'])
+
+        # Keep sampling through streamed bodies; the report is written once the response is closed
+        response.call_on_close(save)
+        response.headers['X-Profile-Id'] = profile['id']
+        return response
@@ -0,0 +1,167 @@
+import csv
+from io import StringIO
+
+from sqlalchemy import func
+
+from metrics import observe_p10_rows
+from archive import payroll_model
+from database import read_session
+from models import Employee, PayrollYTD
+
+# Rows fetched from the database per round trip
+FETCH_SIZE = 1000
+# CSV rows buffered before a chunk is handed to the response
+FLUSH_ROWS = 500
+
+P10_HEADER = [
+    'PIN', 'Names', 'Gross_Pay', 'PAYE', 'NSSF',
+    'Other_Deductions', 'Taxable_Pay', 'Month_Year'
+]
+
+P9_HEADER = [
+    'PIN', 'Names', 'Year', 'Months', 'Basic_Salary', 'Benefits', 'Gross_Pay',
+    'NSSF', 'SHIF', 'AHL', 'Taxable_Pay', 'PAYE', 'Net_Pay'
+]
+
+
+def _p10_query(period, user_id=None):
+    """Only the columns the P10 needs, employees and payroll (or the archive) joined in one statement."""
+    session = read_session()
+    model = payroll_model(period, session)
+    query = (
+        session.query(
+            Employee.kra_pin, Employee.first_name, Employee.middle_name, Employee.last_name,
+            model.gross_salary, model.paye, model.nssf, model.ahl,
+        )
+        .join(Employee, model.employee_id == Employee.id)
+        .filter(model.period == period)
+        .order_by(Employee.id)
+    )
+    if user_id is not None:
+        query = query.filter(Employee.user_id == user_id)
+    return query
+
+
+def has_payroll(period, user_id=None):
+    """True if there is at least one payroll row for the period."""
+    session = read_session()
+    model = payroll_model(period, session)
+    query = (session.query(model.id).join(Employee, model.employee_id == Employee.id)
+             .filter(model.period == period))
+    if user_id is not None:
+        query = query.filter(Employee.user_id == user_id)
+    return session.query(query.exists()).scalar()
+
+
+def payroll_count(period, user_id=None):
+    """Number of payroll rows for the period."""
+    session = read_session()
+    model = payroll_model(period, session)
+    query = (session.query(func.count(model.id)).join(Employee, model.employee_id == Employee.id)
+             .filter(model.period == period))
+    if user_id is not None:
+        query = query.filter(Employee.user_id == user_id)
+    return query.scalar()
+
+
+def iter_p10_csv(period, user_id=None):
+    """Yield the KRA P10 CSV for a period in chunks.
+
+    Rows are streamed from a server-side cursor and the totals are summed in
+    the same pass, so memory does not grow with the number of employees.
+    """
+    output = StringIO()
+    writer = csv.writer(output)
+
+    def flush():
+        data = output.getvalue()
+        output.seek(0)
+        output.truncate()
+        return data
+
+    writer.writerow(P10_HEADER)
+
+    count = 0
+    total_gross = 0.0
+    total_paye = 0.0
+    for kra_pin, first_name, middle_name, last_name, gross_salary, paye, nssf, ahl in _p10_query(period, user_id).yield_per(FETCH_SIZE):
+        names = ' '.join(name for name in (first_name, middle_name, last_name) if name and name.strip())
+        taxable_pay = gross_salary - nssf - ahl
+        writer.writerow([
+            kra_pin,
+            names,
+            f"{gross_salary:.2f}",
+            f"{paye:.2f}",
+            f"{nssf:.2f}",
+            "0.00",
+            f"{taxable_pay:.2f}",
+            period
+        ])
+        count += 1
+        total_gross += gross_salary
+        total_paye += paye
+        if count % FLUSH_ROWS == 0:
+            yield flush()
+
+    observe_p10_rows(count)
+
+    # Summary row
+    writer.writerow([
+        '', f'TOTAL ({count} employees)',
+        f"{total_gross:.2f}", f"{total_paye:.2f}", '', '', '', ''
+    ])
+    yield flush()
+
+
+def _p9_query(year, user_id=None):
+    """Each employee's totals for the year, read from payroll_ytd rather than summed per month."""
+    query = (
+        read_session().query(
+            Employee.kra_pin, Employee.first_name, Employee.middle_name, Employee.last_name,
+            PayrollYTD.months, PayrollYTD.basic_salary, PayrollYTD.benefits_total, PayrollYTD.gross_salary,
+            PayrollYTD.nssf, PayrollYTD.shif, PayrollYTD.ahl, PayrollYTD.paye, PayrollYTD.net_pay,
+        )
+        .select_from(PayrollYTD)
+        .join(Employee, PayrollYTD.employee_id == Employee.id)
+        .filter(PayrollYTD.year == year, PayrollYTD.months > 0)
+        .order_by(Employee.id)
+    )
+    if user_id is not None:
+        query = query.filter(Employee.user_id == user_id)
+    return query
+
+
+def has_ytd(year, user_id=None):
+    """True if any employee has payroll in the year."""
+    return read_session().query(_p9_query(year, user_id).exists()).scalar()
+
+
+def iter_p9_csv(year, user_id=None):
+    """Yield a P9-style annual summary CSV for a year in chunks, one row per employee plus totals."""
+    output = StringIO()
+    writer = csv.writer(output)
+
+    def flush():
+        data = output.getvalue()
+        output.seek(0)
+        output.truncate()
+        return data
+
+    writer.writerow(P9_HEADER)
+
+    count = 0
+    totals = [0.0] * 9
+    for kra_pin, first_name, middle_name, last_name, months, *amounts in _p9_query(year, user_id).yield_per(FETCH_SIZE):
+        names = ' '.join(name for name in (first_name, middle_name, last_name) if name and name.strip())
+        basic_salary, benefits_total, gross_salary, nssf, shif, ahl, paye, net_pay = amounts
+        taxable_pay = gross_salary - nssf - ahl - shif
+        row = [basic_salary, benefits_total, gross_salary, nssf, shif, ahl, taxable_pay, paye, net_pay]
+        writer.writerow([kra_pin, names, year, months] + [f"{amount:.2f}" for amount in row])
+        count += 1
+        totals = [total + amount for total, amount in zip(totals, row)]
+        if count % FLUSH_ROWS == 0:
+            yield flush()
+
+    # Summary row
+    writer.writerow(['', f'TOTAL ({count} employees)', year, ''] + [f"{total:.2f}" for total in totals])
+    yield flush()
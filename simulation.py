@@ -0,0 +1,200 @@
+"""What-if payroll simulations that never write to the database.
+
+simulate() takes every employee's current inputs for a period, meaning
+basic salary and the benefits a payroll run would carry forward. It
+calculates them twice in memory with calculate_payroll_batch(): once as
+they are under the period's statutory rates, and once with the scenario's
+salary and benefit changes and rate overrides. It reports both sets of
+totals, the change per deduction and how employees' net pay moves.
+
+Loading the inputs is the slow part, so they are kept per period and owner
+for SIMULATION_CACHE_TTL seconds. Several scenarios tried in a row then
+cost only the calculation.
+"""
+import copy
+import math
+import os
+
+import numpy as np
+from sqlalchemy import and_, func, select
+from sqlalchemy.orm import aliased
+
+from auth_cache import TTLCache
+from database import read_session
+from models import Employee, Payroll
+from payroll_calculator import calculate_payroll_batch
+from payroll_run import PERIOD_PATTERN
+from statutory_rates import compile_rate_table, compile_rates, rate_table, rate_version_for_period
+
+SIMULATION_CACHE_TTL = float(os.getenv('SIMULATION_CACHE_TTL', 60))
+
+# Salary and benefit changes a scenario may apply to every employee
+ADJUSTMENTS = ('raise_percent', 'raise_amount', 'benefits_percent', 'benefits_amount')
+# Rate table fields a scenario may override, by section
+RATE_FIELDS = {
+    'nssf': ('tier1_limit', 'tier2_limit', 'rate', 'share', 'cap'),
+    'shif': ('rate', 'minimum'),
+    'ahl': ('rate',),
+    'paye': ('bands', 'personal_relief'),
+}
+TOTAL_FIELDS = ('gross_salary', 'benefits_total', 'nssf', 'shif', 'ahl', 'paye', 'total_deductions', 'net_pay')
+PERCENTILES = (10, 25, 50, 75, 90)
+HISTOGRAM_BINS = 10
+
+# (period, owner) -> (basic salaries, benefit totals) as read-only arrays
+_inputs = TTLCache(ttl=SIMULATION_CACHE_TTL, max_items=16)
+
+
+def load_inputs(period, user_id=None):
+    """Every employee's basic salary and carried-forward benefits as two arrays.
+
+    Benefits come from the employee's latest payroll at or before the
+    period, the same way a payroll run picks them.
+    """
+    key = (period, user_id)
+    cached = _inputs.get(key)
+    if cached is not None:
+        return cached
+    earlier = aliased(Payroll)
+    # A correlated lookup per employee follows the (employee_id, period) index
+    latest = (select(func.max(earlier.period))
+              .where(earlier.employee_id == Employee.id, earlier.period <= period)
+              .scalar_subquery())
+    query = (select(Employee.basic_salary, Payroll.benefits_total, Payroll.gross_salary)
+             .outerjoin(Payroll, and_(Payroll.employee_id == Employee.id, Payroll.period == latest)))
+    if user_id is not None:
+        query = query.where(Employee.user_id == user_id)
+    rows = read_session().execute(query).all()
+    # Column by column: NumPy converts plain tuples far faster than result rows. None becomes NaN,
+    # which marks employees without a payroll and rows saved before inputs were recorded
+    basic, benefits, gross = ([np.array(column, dtype=float) for column in zip(*rows)]
+                              or [np.empty(0), np.empty(0), np.empty(0)])
+    fallback = np.where(np.isnan(gross), 0.0, np.maximum(gross - basic, 0.0))
+    benefits = np.where(np.isnan(benefits), fallback, benefits)
+    for array in (basic, benefits):
+        array.flags.writeable = False
+    _inputs.put(key, (basic, benefits))
+    return basic, benefits
+
+
+def _number(value, name, fraction=False, signed=False):
+    if isinstance(value, bool) or not isinstance(value, (int, float)) or not math.isfinite(value):
+        raise ValueError(f'{name} must be a number')
+    if value < 0 and not signed:
+        raise ValueError(f'{name} cannot be negative')
+    if fraction and value > 1:
+        raise ValueError(f'{name} must be a fraction between 0 and 1')
+    return float(value)
+
+
+def _paye_bands(bands):
+    if not isinstance(bands, list) or not bands:
+        raise ValueError('paye.bands must be a list of [upper limit, rate] pairs')
+    parsed, lower = [], 0.0
+    for i, band in enumerate(bands):
+        if not isinstance(band, (list, tuple)) or len(band) != 2:
+            raise ValueError('paye.bands must be a list of [upper limit, rate] pairs')
+        upper, rate = band
+        if i == len(bands) - 1:
+            if upper is not None:
+                raise ValueError('The last PAYE band must have no upper limit (null)')
+        else:
+            upper = _number(upper, 'A PAYE band upper limit')
+            if upper <= lower:
+                raise ValueError('PAYE band upper limits must increase')
+            lower = upper
+        parsed.append((upper, _number(rate, 'A PAYE band rate', fraction=True)))
+    return parsed
+
+
+def scenario_rates(period, overrides=None):
+    """Compiled rates for the period with overrides applied, e.g. {'shif': {'rate': 0.03}}.
+
+    Raises ValueError for an unknown field or an invalid value.
+    """
+    base = rate_table(rate_version_for_period(period))
+    if not overrides:
+        return compile_rates(base['version'])
+    if not isinstance(overrides, dict):
+        raise ValueError('rates must be an object')
+    table = copy.deepcopy(base)
+    table['version'] = f"{base['version']}+scenario"
+    for section, values in overrides.items():
+        if section not in RATE_FIELDS or not isinstance(values, dict):
+            raise ValueError(f'Unknown rate section: {section}')
+        for field, value in values.items():
+            if field not in RATE_FIELDS[section]:
+                raise ValueError(f'Unknown rate field: {section}.{field}')
+            if field == 'bands':
+                table[section][field] = _paye_bands(value)
+            else:
+                table[section][field] = _number(value, f'{section}.{field}', fraction=field in ('rate', 'share'))
+    if table['nssf']['tier2_limit'] < table['nssf']['tier1_limit']:
+        raise ValueError('nssf.tier2_limit cannot be below nssf.tier1_limit')
+    return compile_rate_table(table)
+
+
+def _adjust(values, percent, amount):
+    return np.maximum(values * (1 + percent / 100) + amount, 0.0)
+
+
+def _net_pay_change(change):
+    """How the change in net pay is spread across employees."""
+    if not change.size:
+        return None
+    counts, edges = np.histogram(change, bins=HISTOGRAM_BINS)
+    unchanged = np.abs(change) < 0.005
+    return {
+        'increased': int(np.count_nonzero((change > 0) & ~unchanged)),
+        'decreased': int(np.count_nonzero((change < 0) & ~unchanged)),
+        'unchanged': int(np.count_nonzero(unchanged)),
+        'mean': round(float(change.mean()), 2),
+        'min': round(float(change.min()), 2),
+        'max': round(float(change.max()), 2),
+        'percentiles': {f'p{p}': round(float(value), 2)
+                        for p, value in zip(PERCENTILES, np.percentile(change, PERCENTILES))},
+        'histogram': [{'from': round(float(edges[i]), 2), 'to': round(float(edges[i + 1]), 2),
+                       'employees': int(count)} for i, count in enumerate(counts)],
+    }
+
+
+def simulate(period, scenario=None, user_id=None):
+    """Evaluate a scenario against the period's payroll inputs without saving anything.
+
+    scenario may hold the ADJUSTMENTS, where percentages are signed
+    percentage changes and amounts are signed KSh per employee per month,
+    and 'rates', a dict of RATE_FIELDS overrides. Only user_id's employees
+    are included when it is given. Raises ValueError for an invalid period
+    or scenario.
+    """
+    if not PERIOD_PATTERN.match(period or ''):
+        raise ValueError('Period must be in YYYY-MM format')
+    scenario = scenario or {}
+    unknown = [key for key in scenario if key not in ADJUSTMENTS and key != 'rates']
+    if unknown:
+        raise ValueError(f"Unknown scenario field: {', '.join(unknown)}")
+    adjustments = {key: _number(scenario.get(key, 0), key, signed=True) for key in ADJUSTMENTS}
+    if adjustments['raise_percent'] < -100 or adjustments['benefits_percent'] < -100:
+        raise ValueError('A percentage change cannot be below -100')
+
+    current_rates = compile_rates(rate_version_for_period(period))
+    rates = scenario_rates(period, scenario.get('rates'))
+    basic, benefits = load_inputs(period, user_id)
+    current = calculate_payroll_batch(basic, benefits, period, current_rates)
+    simulated = calculate_payroll_batch(
+        _adjust(basic, adjustments['raise_percent'], adjustments['raise_amount']),
+        _adjust(benefits, adjustments['benefits_percent'], adjustments['benefits_amount']),
+        period, rates,
+    )
+
+    totals = {}
+    for field in TOTAL_FIELDS:
+        before, after = float(current[field].sum()), float(simulated[field].sum())
+        totals[field] = {'current': round(before, 2), 'scenario': round(after, 2), 'change': round(after - before, 2)}
+    return {
+        'period': period,
+        'employees': int(basic.size),
+        'rate_version': current_rates.version,
+        'totals': totals,
+        'net_pay_change': _net_pay_change(simulated['net_pay'] - current['net_pay']),
+    }
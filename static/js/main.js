@@ -509,3 +509,147 @@ document.addEventListener('DOMContentLoaded', function() {
         });
     }
 });
+
+// Background jobs: poll queued and running jobs until they finish
+document.addEventListener('DOMContentLoaded', function() {
+    var rows = document.querySelectorAll('tr[data-job-id]');
+
+    function poll(row) {
+        fetch('/jobs/' + row.dataset.jobId, { headers: { 'Accept': 'application/json' } })
+            .then(function(response) { return response.ok ? response.json() : null; })
+            .then(function(job) {
+                if (!job) {
+                    return;
+                }
+                row.dataset.jobStatus = job.status;
+                row.querySelector('.job-status').textContent = job.status;
+                row.querySelector('.job-progress').textContent =
+                    job.total ? job.progress + ' / ' + job.total : (job.progress || '—');
+                var result = row.querySelector('.job-result');
+                if (job.status === 'succeeded' && job.download_url) {
+                    result.innerHTML = '<a class="btn btn-outline-primary" title="Download"><i class="fas fa-download"></i></a>';
+                    result.querySelector('a').href = job.download_url;
+                } else if (job.error) {
+                    result.innerHTML = '<span class="text--muted small"></span>';
+                    result.querySelector('span').textContent = job.error;
+                }
+                if (job.status === 'queued' || job.status === 'running') {
+                    setTimeout(function() { poll(row); }, 2000);
+                }
+            })
+            .catch(function() {
+                setTimeout(function() { poll(row); }, 5000);
+            });
+    }
+
+    rows.forEach(function(row) {
+        if (row.dataset.jobStatus === 'queued' || row.dataset.jobStatus === 'running') {
+            poll(row);
+        }
+    });
+});
+
+// Employee search: type-ahead over id, KRA PIN and names
+document.addEventListener('DOMContentLoaded', function() {
+    var input = document.getElementById('employee-search');
+    var list = document.getElementById('employee-search-results');
+    if (!input || !list) {
+        return;
+    }
+    var timer = null;
+    var controller = null;
+    var active = -1;
+
+    function close() {
+        list.hidden = true;
+        list.innerHTML = '';
+        active = -1;
+    }
+
+    function results() {
+        return list.querySelectorAll('li:not(.search-meta)');
+    }
+
+    function highlight(index) {
+        results().forEach(function(item, i) { item.classList.toggle('active', i === index); });
+        active = index;
+    }
+
+    function open(item) {
+        if (item && item.dataset.url) {
+            window.location.href = item.dataset.url;
+        }
+    }
+
+    function render(employees) {
+        list.innerHTML = '';
+        active = -1;
+        if (!employees.length) {
+            list.innerHTML = '<li class="search-meta">No matching employees</li>';
+        }
+        employees.forEach(function(employee) {
+            var item = document.createElement('li');
+            item.innerHTML = '<span><strong></strong> <span class="search-meta"></span></span><span class="search-meta"></span>';
+            item.querySelector('strong').textContent = employee.name;
+            item.querySelectorAll('.search-meta')[0].textContent = employee.id + ' · ' + employee.kra_pin;
+            item.querySelectorAll('.search-meta')[1].textContent = employee.calculated
+                ? 'Net KSh ' + Math.round(employee.net_pay).toLocaleString()
+                : 'Not calculated';
+            if (employee.payslip_url) {
+                item.dataset.url = employee.payslip_url;
+                item.title = 'Download payslip';
+            }
+            item.addEventListener('mousedown', function(e) {
+                e.preventDefault();
+                open(item);
+            });
+            list.appendChild(item);
+        });
+        list.hidden = false;
+    }
+
+    function search() {
+        var query = input.value.trim();
+        if (controller) {
+            controller.abort();
+        }
+        if (query.length < 2) {
+            close();
+            return;
+        }
+        controller = new AbortController();
+        var url = input.dataset.url + '?q=' + encodeURIComponent(query) +
+            '&period=' + encodeURIComponent(input.dataset.period);
+        fetch(url, { headers: { 'Accept': 'application/json' }, signal: controller.signal })
+            .then(function(response) { return response.ok ? response.json() : null; })
+            .then(function(data) {
+                if (data && data.query === input.value.trim()) {
+                    render(data.employees);
+                }
+            })
+            .catch(function() {});
+    }
+
+    input.addEventListener('input', function() {
+        clearTimeout(timer);
+        timer = setTimeout(search, 150);
+    });
+
+    input.addEventListener('keydown', function(e) {
+        var items = results();
+        if (e.key === 'ArrowDown' && items.length) {
+            e.preventDefault();
+            highlight(Math.min(active + 1, items.length - 1));
+        } else if (e.key === 'ArrowUp' && items.length) {
+            e.preventDefault();
+            highlight(Math.max(active - 1, 0));
+        } else if (e.key === 'Enter' && active >= 0) {
+            e.preventDefault();
+            open(items[active]);
+        } else if (e.key === 'Escape') {
+            close();
+        }
+    });
+
+    input.addEventListener('blur', close);
+});
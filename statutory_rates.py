@@ -0,0 +1,107 @@
+from bisect import bisect_right
+from collections import namedtuple
+from functools import lru_cache
+
+import numpy as np
+
+# Statutory rates by version, oldest first. A version applies from its
+# effective_from period (YYYY-MM) until the next version takes over. Periods
+# before the first version are refused: add a version only once its rates and
+# its order of deductions match the law of its time.
+RATE_TABLES = [
+    {
+        'version': '2025-02',
+        'effective_from': '2025-02',
+        # NSSF Act phase 3 limits
+        'nssf': {'tier1_limit': 8000, 'tier2_limit': 72000, 'rate': 0.06, 'share': 0.5, 'cap': 2160},
+        'shif': {'rate': 0.0275, 'minimum': 300},
+        'ahl': {'rate': 0.015},
+        'paye': {
+            # (upper limit, rate); the last band has no upper limit
+            'bands': [(24000, 0.1), (32333, 0.25), (500000, 0.3), (800000, 0.325), (None, 0.35)],
+            'personal_relief': 2400,
+        },
+    },
+]
+
+CompiledRates = namedtuple('CompiledRates', [
+    'version',
+    'nssf_tier1_limit', 'nssf_tier2_limit', 'nssf_rate', 'nssf_share', 'nssf_cap',
+    'shif_rate', 'shif_minimum',
+    'ahl_rate',
+    # PAYE band table as tuples for bisect and as arrays for NumPy
+    'paye_uppers', 'paye_lowers', 'paye_rates', 'paye_cumulative', 'personal_relief',
+    'paye_uppers_array', 'paye_lowers_array', 'paye_rates_array', 'paye_cumulative_array',
+])
+
+
+def compile_rate_table(table):
+    """Turn a rate table dict into CompiledRates with the PAYE cumulative tax precomputed."""
+    bands = table['paye']['bands']
+    lowers, rates, cumulative = [], [], []
+    lower, tax = 0, 0
+    for upper, rate in bands:
+        lowers.append(lower)
+        rates.append(rate)
+        cumulative.append(tax)
+        if upper is not None:
+            tax = tax + (upper - lower) * rate
+            lower = upper
+    uppers = [upper for upper, _ in bands[:-1]]
+
+    nssf = table['nssf']
+    return CompiledRates(
+        version=table['version'],
+        nssf_tier1_limit=nssf['tier1_limit'],
+        nssf_tier2_limit=nssf['tier2_limit'],
+        nssf_rate=nssf['rate'],
+        nssf_share=nssf['share'],
+        nssf_cap=nssf['cap'],
+        shif_rate=table['shif']['rate'],
+        shif_minimum=table['shif']['minimum'],
+        ahl_rate=table['ahl']['rate'],
+        paye_uppers=tuple(uppers),
+        paye_lowers=tuple(lowers),
+        paye_rates=tuple(rates),
+        paye_cumulative=tuple(cumulative),
+        personal_relief=table['paye']['personal_relief'],
+        paye_uppers_array=np.array(uppers, dtype=float),
+        paye_lowers_array=np.array(lowers, dtype=float),
+        paye_rates_array=np.array(rates, dtype=float),
+        paye_cumulative_array=np.array(cumulative, dtype=float),
+    )
+
+
+_TABLES_BY_VERSION = {table['version']: table for table in RATE_TABLES}
+_EFFECTIVE_FROM = [table['effective_from'] for table in RATE_TABLES]
+
+
+def rate_table(version):
+    """The rate table dict of a version. Raises ValueError for an unknown one."""
+    try:
+        return _TABLES_BY_VERSION[version]
+    except KeyError:
+        raise ValueError(f'Unknown rate version: {version}')
+
+
+@lru_cache(maxsize=None)
+def compile_rates(version):
+    """Compiled rates for a version, built once per process."""
+    return compile_rate_table(rate_table(version))
+
+
+def rate_version_for_period(period):
+    """Version of the rates in force for a YYYY-MM period. Raises ValueError if no version covers it."""
+    index = bisect_right(_EFFECTIVE_FROM, period or '') - 1
+    if index < 0:
+        raise ValueError(f'No statutory rates are on record for {period}; '
+                         f'payroll can be calculated from {_EFFECTIVE_FROM[0]}')
+    return RATE_TABLES[index]['version']
+
+
+def rates_for_period(period):
+    return compile_rates(rate_version_for_period(period))
+
+
+def current_rates():
+    return compile_rates(RATE_TABLES[-1]['version'])
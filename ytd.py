@@ -0,0 +1,182 @@
+"""Year-to-date payroll totals per employee.
+
+Every code path that inserts, updates or deletes payroll rows collects the
+change with add_ytd_change() and calls apply_ytd_deltas() in the same
+transaction, so the payroll_ytd rows always match the payroll table without
+re-reading the year's months. `flask rebuild-ytd` recomputes them from
+scratch if they are ever suspected to have drifted.
+"""
+from datetime import datetime
+
+from sqlalchemy import Numeric, bindparam, cast, delete, func, insert, select, union_all, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from database import read_session
+from models import db, Employee, Payroll, PayrollArchive, PayrollYTD
+
+YTD_COLUMNS = ('basic_salary', 'benefits_total', 'gross_salary', 'nssf', 'shif', 'ahl', 'paye', 'net_pay')
+# Employee ids per IN lookup and rows per executemany round trip
+CHUNK_SIZE = 5000
+
+
+def period_year(period):
+    return int(period[:4])
+
+
+def add_ytd_change(deltas, employee_id, period, old=None, new=None):
+    """Record in deltas how a payroll row going from old to new changes its year's totals.
+
+    old and new map payroll column names to values; pass None for old when
+    the row is inserted and None for new when it is deleted.
+    """
+    delta = deltas.get((employee_id, period_year(period)))
+    if delta is None:
+        delta = deltas[(employee_id, period_year(period))] = dict.fromkeys(YTD_COLUMNS + ('months',), 0)
+    for values, sign in ((old, -1), (new, 1)):
+        if values is None:
+            continue
+        for column in YTD_COLUMNS:
+            delta[column] += sign * (values.get(column) or 0.0)
+        delta['months'] += sign
+
+
+def _insert_missing(table):
+    """INSERT of zeroed year rows that skips any another writer has just created."""
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        return postgresql.insert(table).on_conflict_do_nothing(index_elements=['employee_id', 'year'])
+    if dialect == 'sqlite':
+        return sqlite.insert(table).on_conflict_do_nothing(index_elements=['employee_id', 'year'])
+    return insert(table)
+
+
+def apply_ytd_deltas(deltas):
+    """Add recorded changes to the year totals in the current transaction, creating missing rows.
+
+    The additions happen in SQL (total = total + change), so concurrent
+    writers for different months of the same year do not overwrite each other.
+    Missing rows are inserted with ON CONFLICT DO NOTHING, so when two writers
+    both create an employee's first row of the year, neither fails.
+    """
+    changed = {key: delta for key, delta in deltas.items() if any(delta.values())}
+    if not changed:
+        return
+    table = PayrollYTD.__table__
+    now = datetime.utcnow()
+
+    employee_ids = list({employee_id for employee_id, _ in changed})
+    existing = set()
+    for start in range(0, len(employee_ids), CHUNK_SIZE):
+        existing.update(
+            db.session.query(PayrollYTD.employee_id, PayrollYTD.year)
+            .filter(PayrollYTD.employee_id.in_(employee_ids[start:start + CHUNK_SIZE]))
+        )
+    missing = [
+        {'employee_id': employee_id, 'year': year, 'months': 0, 'updated_at': now,
+         **dict.fromkeys(YTD_COLUMNS, 0.0)}
+        for employee_id, year in changed if (employee_id, year) not in existing
+    ]
+    for start in range(0, len(missing), CHUNK_SIZE):
+        db.session.execute(_insert_missing(table), missing[start:start + CHUNK_SIZE])
+
+    # Rounded to cents on every update so float error cannot build up over the year
+    statement = (
+        update(table)
+        .where(table.c.employee_id == bindparam('key_employee_id'), table.c.year == bindparam('key_year'))
+        .values(
+            months=table.c.months + bindparam('change_months'),
+            updated_at=now,
+            **{column: func.round(cast(table.c[column] + bindparam(f'change_{column}'), Numeric), 2)
+               for column in YTD_COLUMNS}
+        )
+    )
+    params = [
+        {'key_employee_id': employee_id, 'key_year': year,
+         **{f'change_{key}': value for key, value in delta.items()}}
+        for (employee_id, year), delta in changed.items()
+    ]
+    for start in range(0, len(params), CHUNK_SIZE):
+        db.session.execute(statement, params[start:start + CHUNK_SIZE])
+
+
+def delete_ytd(employee_ids):
+    """Remove the year totals of employees that are being deleted."""
+    db.session.query(PayrollYTD).filter(PayrollYTD.employee_id.in_(employee_ids)).delete(synchronize_session=False)
+
+
+def _payroll_rows():
+    """Every payroll row, hot and archived, with the columns the totals are built from."""
+    return union_all(*[
+        select(table.c.employee_id, table.c.period, *[table.c[column] for column in YTD_COLUMNS])
+        for table in (Payroll.__table__, PayrollArchive.__table__)
+    ]).subquery()
+
+
+def _later_months(period, employee_id=None):
+    """Per-employee sums of the months after period in the same year, usually none."""
+    year = period_year(period)
+    parts = []
+    for table in (Payroll.__table__, PayrollArchive.__table__):
+        part = (select(table.c.employee_id, *[table.c[column] for column in YTD_COLUMNS])
+                .where(table.c.period > period, table.c.period <= f'{year}-12'))
+        if employee_id is not None:
+            part = part.where(table.c.employee_id == employee_id)
+        parts.append(part)
+    months = union_all(*parts).subquery()
+    return (
+        read_session().query(months.c.employee_id,
+                             *[func.sum(months.c[column]).label(column) for column in YTD_COLUMNS])
+        .group_by(months.c.employee_id)
+    )
+
+
+def ytd_for_period(employee_id, period):
+    """Totals for the year up to and including period, or None before any payroll that year.
+
+    The year's row already holds the sum; only months after period (when an
+    older payslip is printed) are subtracted, which is a short index range.
+    """
+    row = read_session().query(PayrollYTD).filter_by(employee_id=employee_id, year=period_year(period)).first()
+    if row is None:
+        return None
+    later = _later_months(period, employee_id).first()
+    return {column: round(getattr(row, column) - ((getattr(later, column) or 0.0) if later else 0.0), 2)
+            for column in YTD_COLUMNS}
+
+
+def ytd_columns_for_period(period):
+    """Columns that give each employee's totals as of period, for queries over many employees.
+
+    Returns (columns, join): add the columns to a query on Employee and call
+    join(query) to attach the tables they come from.
+    """
+    later = _later_months(period).subquery()
+    columns = [
+        func.round(cast(getattr(PayrollYTD, column) - func.coalesce(later.c[column], 0.0), Numeric), 2)
+        for column in YTD_COLUMNS
+    ]
+
+    def join(query):
+        return (query
+                .outerjoin(PayrollYTD, (PayrollYTD.employee_id == Employee.id)
+                           & (PayrollYTD.year == period_year(period)))
+                .outerjoin(later, later.c.employee_id == Employee.id))
+
+    return columns, join
+
+
+def rebuild_ytd(conn):
+    """Recompute every year total from the payroll and archive tables on a Core connection. Returns the row count."""
+    table = PayrollYTD.__table__
+    payroll = _payroll_rows()
+    year = cast(func.substr(payroll.c.period, 1, 4), db.Integer)
+    source = (
+        select(payroll.c.employee_id, year, func.count(),
+               *[func.round(cast(func.coalesce(func.sum(payroll.c[column]), 0.0), Numeric), 2)
+                 for column in YTD_COLUMNS],
+               func.current_timestamp())
+        .group_by(payroll.c.employee_id, year)
+    )
+    conn.execute(delete(table))
+    conn.execute(insert(table).from_select(['employee_id', 'year', 'months', *YTD_COLUMNS, 'updated_at'], source))
+    return conn.execute(select(func.count()).select_from(table)).scalar()